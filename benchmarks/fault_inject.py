@@ -0,0 +1,619 @@
+"""Fault-injection scenarios for the retry and rate-limit paths.
+
+Runs a real Downloader engine's sync() against benchmarks/mock_gelbooru.py,
+with a requests adapter (FaultAdapter) between the two. The adapter injects
+faults on a schedule into the favourites, post detail, tag and image requests:
+429 bursts, 5xx, timeouts, slow bodies, truncated bodies and HTML pages served
+in place of images. The engine runs on a VirtualClock, so backoff, cooldowns
+and injected timeouts cost no real time. A run with minutes of back-off takes
+seconds.
+
+Each scenario checks the outcome and the time lost:
+  - every post that should be downloaded is on disk, complete, in the folder a
+    clean run puts it in
+  - nothing else is on disk: no HTML saved as an image, no leftover .part files
+  - the failed cache holds exactly the posts expected to fail
+  - the engine counted one 429 per injected 429
+  - the virtual seconds lost, compared with the clean run, stay within the
+    scenario's budget plus its margin. The budget is worked out from the
+    engine's retry constants and config.yaml.example's rate_limiting section
+    (see RetryCosts), not fitted to earlier runs, so a back-off regression
+    shows up as a failure
+
+--check exits 1 if any scenario fails.
+
+Run with:
+  python benchmarks/fault_inject.py
+  python benchmarks/fault_inject.py --scenario image_truncated --scenario detail_429_burst --check
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import yaml
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPResponse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SCRIPT = os.path.join(REPO_DIR, "gelbooru_favorite_downloader.py")
+
+sys.path.insert(0, BENCH_DIR)
+from mock_gelbooru import MockGelbooru, MockSettings  # noqa: E402
+
+FAULT_KINDS = ("429", "5xx", "timeout", "slow", "truncated", "html")
+
+# What a hotlink-protected or error image URL serves instead of the bytes
+HTML_PAGE = b"<!DOCTYPE html><html><head><title>Gelbooru</title></head><body>Access denied</body></html>"
+
+
+class VirtualClock:
+    """Engine clock whose sleeps return at once.
+
+    Each thread keeps its own virtual time: the real time elapsed plus what it
+    has slept. A thread's first reading starts from the furthest any thread has
+    got, because the engine starts its worker threads where the run already is.
+    So sleeps on different workers overlap, as they would for real. lost() is
+    how far the furthest thread got ahead of the real clock: the time a real run
+    would have spent asleep.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.base = time.time()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.horizon = 0.0
+
+    def _offset(self):
+        offset = getattr(self.local, "offset", None)
+        if offset is None:
+            with self.lock:
+                offset = self.local.offset = self.horizon
+        return offset
+
+    def time(self):
+        return self.base + (time.monotonic() - self.started) + self._offset()
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        offset = self.local.offset = self._offset() + seconds
+        with self.lock:
+            self.horizon = max(self.horizon, offset)
+
+    def lost(self):
+        with self.lock:
+            return self.horizon
+
+
+def request_endpoint(url):
+    """The engine endpoint a request URL belongs to (favourites, detail, tag, download, login)"""
+    if "/images/" in url:
+        return "download"
+    if "page=favorites" in url:
+        return "favourites"
+    if "s=post" in url:
+        return "detail"
+    if "s=tag" in url:
+        return "tag"
+    return "login"
+
+
+class Fault:
+    """Inject kind into an endpoint's requests on a schedule.
+
+    Counting only the requests to endpoint whose URL contains match, the fault
+    hits request number first, then every every-th one after it, count times in
+    all (None = no limit). seconds is how long a slow body takes.
+    """
+
+    def __init__(self, endpoint, kind, first=0, every=1, count=1, match=None, seconds=20.0):
+        if kind not in FAULT_KINDS:
+            raise ValueError(f"unknown fault kind {kind!r}")
+        self.endpoint = endpoint
+        self.kind = kind
+        self.first = first
+        self.every = every
+        self.count = count
+        self.match = match
+        self.seconds = seconds
+        self.seen = 0
+        self.injected = 0
+
+    def hits(self, endpoint, url):
+        """Count a request and say whether this fault applies to it"""
+        if endpoint != self.endpoint or (self.match and self.match not in url):
+            return False
+        n = self.seen
+        self.seen += 1
+        if n < self.first or (n - self.first) % self.every:
+            return False
+        if self.count is not None and self.injected >= self.count:
+            return False
+        self.injected += 1
+        return True
+
+
+class FaultAdapter(HTTPAdapter):
+    """requests transport that passes requests on to the server, except where a Fault says otherwise.
+
+    Faults are built from real urllib3 responses, so the engine sees what
+    requests would raise or return: a short body raises ChunkedEncodingError when
+    read, and a timeout raises ReadTimeout after the request's read timeout
+    (slept on the virtual clock).
+    """
+
+    def __init__(self, faults, clock):
+        super().__init__(pool_maxsize=32)
+        self.faults = faults
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.injected = dict.fromkeys(FAULT_KINDS, 0)
+        # (endpoint, fault kind or None) of every request past the login, in order
+        self.requests = []
+
+    def send(self, request, stream=False, timeout=None, **kwargs):
+        endpoint = request_endpoint(request.url)
+        with self.lock:
+            fault = next((f for f in self.faults if f.hits(endpoint, request.url)), None)
+            if fault is not None:
+                self.injected[fault.kind] += 1
+            if endpoint != "login":
+                self.requests.append((endpoint, fault.kind if fault else None))
+        if fault is None:
+            return super().send(request, stream=stream, timeout=timeout, **kwargs)
+
+        if fault.kind == "429":
+            return self.respond(request, 429, b"Too Many Requests", "text/plain")
+        if fault.kind == "5xx":
+            return self.respond(request, 503, b"<html>503 Service Unavailable</html>", "text/html")
+        if fault.kind == "timeout":
+            read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+            self.clock.sleep(read_timeout or 30)
+            raise requests.exceptions.ReadTimeout(f"injected read timeout ({read_timeout}s)", request=request)
+
+        response = super().send(request, stream=True, timeout=timeout, **kwargs)
+        body = response.raw.read()
+        content_type = response.headers.get("Content-Type", "")
+        if fault.kind == "slow":
+            self.clock.sleep(fault.seconds)
+            return self.respond(request, response.status_code, body, content_type)
+        if fault.kind == "truncated":
+            # Content-Length still promises the whole body
+            return self.respond(request, response.status_code, body[: len(body) // 2], content_type, length=len(body))
+        return self.respond(request, 200, HTML_PAGE, "text/html; charset=utf-8")
+
+    def respond(self, request, status, body, content_type, length=None):
+        raw = HTTPResponse(
+            body=io.BytesIO(body),
+            headers={"Content-Type": content_type, "Content-Length": str(len(body) if length is None else length)},
+            status=status,
+            preload_content=False,
+            enforce_content_length=True,
+            request_method=request.method,
+        )
+        return self.build_response(request, raw)
+
+
+def load_downloader():
+    spec = importlib.util.spec_from_file_location("gelbooru_favorite_downloader", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def build_config(site_url, workdir, posts_per_page):
+    """config.yaml.example pointed at the mock and workdir, walking every favourites page"""
+    with open(os.path.join(REPO_DIR, "config.yaml.example"), "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+    config["settings"].update({
+        "site_url": site_url,
+        "base_dir": os.path.join(workdir, "library"),
+        "posts_per_page": posts_per_page,
+        "max_consecutive_empty_pages": 1_000_000,
+    })
+    for key, name in config["cache"].items():
+        if key.endswith("_file") and name:
+            config["cache"][key] = os.path.join(workdir, name)
+    config["rate_limiting"]["remember_limits"] = False
+    return config
+
+
+class RetryCosts:
+    """Virtual seconds the engine's retry and rate-limit paths may spend, worked out from their constants.
+
+    The fetchers' read timeouts and first back-off delays are fixed in the
+    engine (get_favorite_post_ids, get_post_details, fetch_tag_data,
+    download_image), so they are mirrored here. A retry waits
+    base * 2**attempt. The spacing controller takes its values from the
+    config's rate_limiting section.
+    """
+
+    TIMEOUT = {"favourites": 30, "detail": 30, "tag": 10, "download": 30}
+    BACKOFF = {"favourites": 5, "detail": 5, "tag": 2, "download": 2}
+
+    def __init__(self, rate_limiting):
+        self.min_delay = rate_limiting.get("min_delay", 0.25)
+        self.max_delay = rate_limiting.get("max_delay", 5.0)
+        self.delay_increase_factor = rate_limiting.get("delay_increase_factor", 1.5)
+        self.delay_decrease_factor = rate_limiting.get("delay_decrease_factor", 0.95)
+        self.success_threshold = rate_limiting.get("success_threshold", 15)
+        # Requests per endpoint in the clean run; set once it has run
+        self.reference = {}
+
+    def backoff(self, endpoint, retries=1):
+        """Back-off before the next retries attempts of one request"""
+        return sum(self.BACKOFF[endpoint] * 2**i for i in range(retries))
+
+    def timeout(self, endpoint):
+        """A hung request: its read timeout, then the back-off before the retry"""
+        return self.TIMEOUT[endpoint] + self.backoff(endpoint)
+
+    def hits(self, endpoint, first, every):
+        """Requests a Fault(first, every, count=None) hits when each hit is retried once"""
+        total, hits, n = self.reference[endpoint], 0, first
+        while n < total:
+            hits += 1
+            total += 1
+            n += every
+        return hits
+
+    def pacing(self, requests):
+        """Spacing and cooldown seconds beyond the clean run for a run's request log.
+
+        Replays the adaptive delay: a 429 multiplies it by delay_increase_factor
+        and is followed by a cooldown of twice the new delay. Every
+        success_threshold clean requests multiply it by delay_decrease_factor,
+        back down to min_delay, and every request in between is spaced by it.
+        Requests beyond the clean run's count cost min_delay each.
+        """
+        delay, successes, seconds = self.min_delay, 0, 0.0
+        for _, fault in requests:
+            seconds += delay - self.min_delay
+            if fault == "429":
+                delay = min(delay * self.delay_increase_factor, self.max_delay)
+                successes = 0
+                seconds += delay * 2
+            elif fault in (None, "slow"):
+                successes += 1
+                if successes >= self.success_threshold:
+                    delay = max(delay * self.delay_decrease_factor, self.min_delay)
+                    successes = 0
+        extra_requests = len(requests) - sum(self.reference.values())
+        return seconds + max(0, extra_requests) * self.min_delay
+
+
+# Scenarios: name -> (description, build). build(mock) returns (faults, expect), where
+# expect may hold "failed" ({post id: failure type}), "not_downloaded" (post ids left
+# alone without a failure, e.g. past a page that could not be fetched) and
+# "stopped_early". It always holds "budget", the timeouts, back-off and slow bodies
+# the faults add to the clean run (RetryCosts.pacing adds the spacing and 429
+# cooldowns from the run's request log), and "margin", the seconds a run may go over
+# it by. Sleeps on different workers overlap, so the budget is an upper bound and
+# the margins only cover scheduling noise in the request pacing.
+def _post(mock, index):
+    post_id = mock.favourite_ids[index]
+    return post_id, mock.posts[post_id]
+
+
+def scenario_clean(mock, costs):
+    return [], {"budget": 0, "margin": 0}
+
+
+def scenario_favourites_retry(mock, costs):
+    # Page 2 fails twice, then loads.
+    pid = mock.settings.posts_per_page
+    return [Fault("favourites", "5xx", count=2, match=f"&pid={pid}")], {
+        "budget": costs.backoff("favourites", 2), "margin": 2,
+    }
+
+
+def scenario_favourites_down(mock, costs):
+    # Page 2 never loads: four back-offs, then the run stops rather than treat the
+    # page as the end of the favourites.
+    per_page = mock.settings.posts_per_page
+    later = mock.favourite_ids[per_page:]
+    return [Fault("favourites", "5xx", count=None, match=f"&pid={per_page}")], {
+        "not_downloaded": later, "stopped_early": True, "budget": costs.backoff("favourites", 4), "margin": 2,
+    }
+
+
+def scenario_detail_429_burst(mock, costs):
+    # Six 429s in a row, each on a different post: one back-off per post, plus the
+    # cooldowns and wider spacing that pacing() replays.
+    return [Fault("detail", "429", count=6)], {"budget": 6 * costs.backoff("detail"), "margin": 5}
+
+
+def scenario_detail_5xx(mock, costs):
+    # Every 10th detail request fails once.
+    hits = costs.hits("detail", 3, 10)
+    return [Fault("detail", "5xx", first=3, every=10, count=None)], {
+        "budget": hits * costs.backoff("detail"), "margin": 2,
+    }
+
+
+def scenario_detail_timeouts(mock, costs):
+    # Three detail requests hang for their read timeout.
+    return [Fault("detail", "timeout", first=2, every=7, count=3)], {
+        "budget": 3 * costs.timeout("detail"), "margin": 2,
+    }
+
+
+def scenario_detail_down(mock, costs):
+    # One post's details never load: four back-offs, then it is recorded as an
+    # API failure for --retry-failed.
+    post_id, _ = _post(mock, 7)
+    return [Fault("detail", "5xx", count=None, match=f"&id={post_id}&")], {
+        "failed": {post_id: "api"}, "budget": costs.backoff("detail", 4), "margin": 2,
+    }
+
+
+def scenario_tag_5xx(mock, costs):
+    # Every 9th tag lookup fails once; folders must not change.
+    hits = costs.hits("tag", 4, 9)
+    return [Fault("tag", "5xx", first=4, every=9, count=None)], {
+        "budget": hits * costs.backoff("tag"), "margin": 2,
+    }
+
+
+def scenario_image_timeouts(mock, costs):
+    # Four downloads hang for their read timeout, then a clean retry.
+    return [Fault("download", "timeout", first=1, every=5, count=4)], {
+        "budget": 4 * costs.timeout("download"), "margin": 2,
+    }
+
+
+def scenario_image_5xx(mock, costs):
+    return [Fault("download", "5xx", first=2, every=6, count=5)], {
+        "budget": 5 * costs.backoff("download"), "margin": 2,
+    }
+
+
+def scenario_image_slow(mock, costs):
+    # Five bodies take 20s each; slow is not an error, so nothing is retried.
+    return [Fault("download", "slow", first=0, every=4, count=5, seconds=20.0)], {"budget": 5 * 20, "margin": 2}
+
+
+def scenario_image_truncated(mock, costs):
+    # Five connections drop mid-body: the short read must be retried, never saved.
+    return [Fault("download", "truncated", first=1, every=4, count=5)], {
+        "budget": 5 * costs.backoff("download"), "margin": 2,
+    }
+
+
+def scenario_image_html(mock, costs):
+    # Three images are always served as an HTML page (hotlink protection or an
+    # error page): they must not be saved, retried or slept on, and are recorded
+    # as download failures.
+    posts = [_post(mock, i) for i in (2, 11, 23)]
+    faults = [Fault("download", "html", count=None, match=post["md5"]) for _, post in posts]
+    return faults, {"failed": {post_id: "download" for post_id, _ in posts}, "budget": 0, "margin": 2}
+
+
+def scenario_image_429_burst(mock, costs):
+    # Three images get two 429s each, and the third attempt succeeds. A download
+    # 429 is retried straight after its cooldown, so all of the cost is pacing().
+    posts = [_post(mock, i) for i in (4, 15, 31)]
+    return [Fault("download", "429", count=2, match=post["md5"]) for _, post in posts], {"budget": 0, "margin": 5}
+
+
+def scenario_image_429_exhausted(mock, costs):
+    # One image gets a 429 on every attempt: after three it is recorded as a
+    # download failure, to go first in the next run's priority pass.
+    post_id, post = _post(mock, 9)
+    return [Fault("download", "429", count=None, match=post["md5"])], {
+        "failed": {post_id: "download"}, "budget": 0, "margin": 5,
+    }
+
+
+def scenario_mixed(mock, costs):
+    # A bit of everything at once.
+    budget = (
+        costs.backoff("favourites")
+        + 3 * costs.backoff("detail")
+        + 2 * costs.timeout("detail")
+        + costs.hits("tag", 2, 13) * costs.backoff("tag")
+        + 3 * costs.backoff("download")
+        + 2 * costs.timeout("download")
+        + 2 * 10
+    )
+    return [
+        Fault("favourites", "5xx", first=1, count=1),
+        Fault("detail", "429", first=5, every=17, count=3),
+        Fault("detail", "timeout", first=9, every=23, count=2),
+        Fault("tag", "5xx", first=2, every=13, count=None),
+        Fault("download", "truncated", first=3, every=11, count=3),
+        Fault("download", "timeout", first=6, every=19, count=2),
+        Fault("download", "slow", first=8, every=13, count=2, seconds=10.0),
+    ], {"budget": budget, "margin": 5}
+
+
+SCENARIOS = {
+    "clean": ("no faults; the reference run", scenario_clean),
+    "favourites_retry": ("a favourites page fails twice, then loads", scenario_favourites_retry),
+    "favourites_down": ("a favourites page never loads", scenario_favourites_down),
+    "detail_429_burst": ("six 429s in a row on post details", scenario_detail_429_burst),
+    "detail_5xx": ("every 10th post detail request gets a 503", scenario_detail_5xx),
+    "detail_timeouts": ("three post detail requests time out", scenario_detail_timeouts),
+    "detail_down": ("one post's details never load", scenario_detail_down),
+    "tag_5xx": ("every 9th tag lookup gets a 503", scenario_tag_5xx),
+    "image_timeouts": ("four image downloads time out", scenario_image_timeouts),
+    "image_5xx": ("five image downloads get a 503", scenario_image_5xx),
+    "image_slow": ("five image bodies take 20s", scenario_image_slow),
+    "image_truncated": ("five image bodies are cut off halfway", scenario_image_truncated),
+    "image_html": ("three images are served as HTML pages", scenario_image_html),
+    "image_429_burst": ("three images get two 429s each", scenario_image_429_burst),
+    "image_429_exhausted": ("one image gets a 429 on every attempt", scenario_image_429_exhausted),
+    "mixed": ("all of the above, sparser", scenario_mixed),
+}
+
+
+def library_files(base_dir):
+    """relative path -> absolute path of every file under base_dir"""
+    files = {}
+    for root, _, names in os.walk(base_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            files[os.path.relpath(path, base_dir)] = path
+    return files
+
+
+def is_html(path):
+    with open(path, "rb") as f:
+        return f.read(64).lstrip().lower().startswith((b"<!doctype html", b"<html"))
+
+
+def run_scenario(module, mock, name, args, costs):
+    """Sync the mock account through the scenario's faults; returns the run's report"""
+    faults, expect = SCENARIOS[name][1](mock, costs)
+    workdir = tempfile.mkdtemp(prefix=f"gelbooru-fault-{name}-")
+    try:
+        config = build_config(mock.url, workdir, args.posts_per_page)
+        clock = VirtualClock()
+        adapter = FaultAdapter(faults, clock)
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            engine = module.Downloader(config, credentials=("fault", "1", "fault", "fault"), clock=clock, transport=adapter)
+            result = engine.sync()
+            engine.close()
+        wall = time.perf_counter() - started
+        files = library_files(config["settings"]["base_dir"])
+        failed = {}
+        if os.path.exists(config["cache"]["failed_posts_cache_file"]):
+            with open(config["cache"]["failed_posts_cache_file"], "r", encoding="utf-8") as f:
+                failed = json.load(f)
+        return {
+            "name": name,
+            "expect": expect,
+            "files": {rel: os.path.getsize(path) for rel, path in files.items()},
+            "html_files": [rel for rel, path in files.items() if is_html(path)],
+            "failed": {post_id: (info.get("type") if isinstance(info, dict) else None) for post_id, info in failed.items()},
+            "outcomes": result["outcomes"],
+            "stopped": result["stopped"],
+            "pages": result["pages"],
+            "retries": engine.rate_stats["retries"],
+            "rate_limit_429s": engine.rate_stats["rate_limit_429s"],
+            "injected": {kind: n for kind, n in adapter.injected.items() if n},
+            "requests": adapter.requests,
+            "lost_seconds": clock.lost(),
+            "wall_seconds": wall,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def check_run(run, reference, mock, costs):
+    """Problems with a scenario run, judged against the clean reference run"""
+    problems = []
+    expect = run["expect"]
+    run["budget"] = expect["budget"] + costs.pacing(run["requests"])
+    failed_expected = expect.get("failed", {})
+    left_alone = set(expect.get("not_downloaded", ()))
+    expected_paths = {
+        rel for rel in reference["files"]
+        if os.path.basename(rel).split(".")[0] not in {
+            mock.posts[post_id]["md5"] for post_id in set(failed_expected) | left_alone
+        }
+    }
+
+    missing = expected_paths - set(run["files"])
+    extra = set(run["files"]) - expected_paths
+    if missing:
+        problems.append(f"{len(missing)} expected files missing, e.g. {sorted(missing)[0]}")
+    if extra:
+        problems.append(f"{len(extra)} unexpected files, e.g. {sorted(extra)[0]}")
+    short = [rel for rel in expected_paths & set(run["files"]) if run["files"][rel] != reference["files"][rel]]
+    if short:
+        problems.append(f"{len(short)} files with the wrong size, e.g. {short[0]}")
+    if run["html_files"]:
+        problems.append(f"HTML saved as an image: {run['html_files'][0]}")
+    if run["failed"] != failed_expected:
+        problems.append(f"failed cache {run['failed']} != expected {failed_expected}")
+    if run["stopped"] is not False:
+        problems.append("sync reported stopped")
+    if expect.get("stopped_early") and run["pages"] >= reference["pages"]:
+        problems.append(f"walked {run['pages']} pages past a page that never loaded")
+    injected_429s = run["injected"].get("429", 0)
+    if run["rate_limit_429s"] != injected_429s:
+        problems.append(f"engine counted {run['rate_limit_429s']} 429s for {injected_429s} injected")
+    extra_seconds = run["lost_seconds"] - reference["lost_seconds"]
+    if extra_seconds > run["budget"] + expect["margin"]:
+        problems.append(
+            f"lost {extra_seconds:.1f}s to retries, budget {run['budget']:.1f}s + {expect['margin']}s margin"
+        )
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fault-injection scenarios for the retry and rate-limit paths")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="run only these (repeatable)")
+    parser.add_argument("--list", action="store_true", help="list the scenarios and exit")
+    parser.add_argument("--favourites", type=int, default=60)
+    parser.add_argument("--posts-per-page", type=int, default=20)
+    parser.add_argument("--check", action="store_true", help="exit non-zero if any scenario fails")
+    parser.add_argument("--output", help="write the results JSON here")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, (description, _) in SCENARIOS.items():
+            print(f"  {name:<20s} {description}")
+        return
+
+    names = [name for name in SCENARIOS if name != "clean" and (not args.scenario or name in args.scenario)]
+    settings = MockSettings(
+        favourites=args.favourites, posts_per_page=args.posts_per_page, tag_pool=300,
+        api_latency_ms=0.0, image_latency_ms=0.0, latency_jitter_ms=0.0,
+        bandwidth_bps=0, size_median_bytes=20_000, size_sigma=0.3,
+    )
+    with open(os.path.join(REPO_DIR, "config.yaml.example"), "r", encoding="utf-8") as f:
+        costs = RetryCosts(yaml.safe_load(f)["rate_limiting"])
+    module = load_downloader()
+    mock = MockGelbooru(settings).start()
+    try:
+        reference = run_scenario(module, mock, "clean", args, costs)
+        for endpoint, _ in reference["requests"]:
+            costs.reference[endpoint] = costs.reference.get(endpoint, 0) + 1
+        results = [reference]
+        print(f"  {'scenario':<20s} {'result':>6s} {'files':>6s} {'failed':>6s} {'429s':>5s} "
+              f"{'retries':>7s} {'lost':>8s} {'budget':>7s} {'wall':>6s}")
+        failures = 0
+        for name in ["clean"] + names:
+            run = reference if name == "clean" else run_scenario(module, mock, name, args, costs)
+            problems = check_run(run, reference, mock, costs)
+            failures += bool(problems)
+            extra_seconds = run["lost_seconds"] - reference["lost_seconds"]
+            print(f"  {name:<20s} {'FAIL' if problems else 'ok':>6s} {len(run['files']):>6d} {len(run['failed']):>6d} "
+                  f"{run['rate_limit_429s']:>5d} {run['retries']:>7d} {extra_seconds:>+7.1f}s "
+                  f"{run['budget']:>6.0f}s {run['wall_seconds']:>5.1f}s")
+            for problem in problems:
+                print(f"      - {problem}")
+            run["problems"] = problems
+            run["requests"] = len(run["requests"])
+            if name != "clean":
+                results.append(run)
+    finally:
+        mock.stop()
+
+    print(f"\n  lost: virtual seconds spent asleep beyond the clean run's "
+          f"{reference['lost_seconds']:.1f}s of request pacing")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2, default=str)
+    if args.check and failures:
+        print(f"\n{failures} scenario(s) failed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
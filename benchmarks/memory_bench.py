@@ -0,0 +1,205 @@
+"""Peak memory of a sync as the favourites list grows.
+
+For each account size this starts benchmarks/mock_gelbooru.py with that many
+favourites and seeds the caches as if an earlier run had downloaded all but one
+post in every --new-every. The tag cache holds every tag the posts use plus a
+share of unrelated ones, as a real account's cache does after a long history.
+It then runs a full sync in a fresh process, with max_consecutive_empty_pages
+high enough that every favourites page is walked. The peak RSS of that process
+is reported for each cache backend.
+
+The JSON backend loads the posts and tag caches whole and grows with the
+account. The SQLite backend (cache.backend: sqlite) should stay flat. Seeding
+the SQLite file, including its one-off import of the JSON caches, happens in a
+separate process so it doesn't count towards the figure.
+
+--check fails (exit 1) when the SQLite backend's peak at the largest size
+exceeds its peak at the smallest by more than --max-growth-mb.
+
+Run with:
+  python benchmarks/memory_bench.py
+  python benchmarks/memory_bench.py --sizes 1000,20000 --backends sqlite --check
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SCRIPT = os.path.join(REPO_DIR, "gelbooru_favorite_downloader.py")
+
+sys.path.insert(0, BENCH_DIR)
+from mock_gelbooru import MockGelbooru, MockSettings  # noqa: E402
+
+# Unrelated tag cache entries seeded per favourite
+EXTRA_TAGS_PER_FAVOURITE = 0.5
+
+
+def build_config(site_url, workdir, backend, posts_per_page):
+    """config.yaml.example pointed at the mock and workdir, walking every favourites page"""
+    with open(os.path.join(REPO_DIR, "config.yaml.example"), "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+    config["settings"].update({
+        "site_url": site_url,
+        "base_dir": os.path.join(workdir, "library"),
+        "posts_per_page": posts_per_page,
+        "max_consecutive_empty_pages": 1_000_000,
+    })
+    for key, name in config["cache"].items():
+        if key.endswith("_file") and name:
+            config["cache"][key] = os.path.join(workdir, name)
+    config["cache"]["backend"] = backend
+    config["cache"]["sqlite_file"] = os.path.join(workdir, "cache.sqlite3")
+    config["rate_limiting"].update({"min_delay": 0.0, "remember_limits": False})
+    return config
+
+
+def seed_caches(mock, config, new_every):
+    """Write the JSON caches of an account whose favourites are all downloaded but every new_every-th"""
+    posts_cache = {post_id: True for i, post_id in enumerate(mock.favourite_ids) if i % new_every}
+    tag_cache = dict(mock.tags)
+    for i in range(int(len(mock.favourite_ids) * EXTRA_TAGS_PER_FAVOURITE)):
+        name = f"unrelated_tag_{i}"
+        tag_cache[name] = {"id": 10_000_000 + i, "name": name, "count": i % 5000, "type": 0, "ambiguous": 0}
+    with open(config["cache"]["posts_cache_file"], "w", encoding="utf-8") as f:
+        json.dump(posts_cache, f)
+    with open(config["cache"]["tag_cache_file"], "w", encoding="utf-8") as f:
+        json.dump(tag_cache, f)
+    return len(mock.favourite_ids) - len(posts_cache)
+
+
+def run_child(mode, config_path):
+    """Run this script as a fresh process in mode (seed or sync) and return its JSON report"""
+    result = subprocess.run(
+        [sys.executable, __file__, "--child", mode, config_path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{mode} child exited {result.returncode}: {result.stderr[-800:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def peak_rss_kib():
+    """This process's peak RSS in KiB.
+
+    On Linux ru_maxrss carries over the parent's RSS at fork time, and the parent
+    holds the mock's whole favourites list, so VmHWM is read instead.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    return peak / 1024 if sys.platform == "darwin" else peak
+
+
+def child(mode, config_path):
+    """Body of the child process: seed the SQLite file, or sync and report the peak RSS"""
+    import contextlib
+    import importlib.util
+    import io
+
+    with open(config_path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    spec = importlib.util.spec_from_file_location("gelbooru_favorite_downloader", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine = module.Downloader(config, credentials=("bench", "1", "bench", "bench"))
+        if mode == "seed":
+            # Opening the caches imports the JSON files into the SQLite file.
+            engine.load_posts_cache()
+            engine.load_cache()
+            engine.close()
+            report = {}
+        else:
+            started = time.perf_counter()
+            result = engine.sync()
+            engine.close()
+            report = {"wall_seconds": round(time.perf_counter() - started, 2), "outcomes": result["outcomes"]}
+    report["peak_rss_mb"] = round(peak_rss_kib() / 1024, 1)
+    print(json.dumps(report))
+
+
+def measure(size, backend, args):
+    settings = MockSettings(
+        favourites=size, posts_per_page=args.posts_per_page, tag_pool=args.tag_pool,
+        api_latency_ms=0.0, image_latency_ms=0.0, latency_jitter_ms=0.0,
+        bandwidth_bps=0, size_median_bytes=2_000, size_sigma=0.1,
+    )
+    mock = MockGelbooru(settings).start()
+    try:
+        workdir = tempfile.mkdtemp(prefix="gelbooru-memory-")
+        config = build_config(mock.url, workdir, backend, args.posts_per_page)
+        new_posts = seed_caches(mock, config, args.new_every)
+        config_path = os.path.join(workdir, "config.json")
+        with open(config_path, "w", encoding="utf-8") as f:
+            json.dump(config, f)
+        if backend == "sqlite":
+            run_child("seed", config_path)
+        report = run_child("sync", config_path)
+    finally:
+        mock.stop()
+    report.update(size=size, backend=backend, new_posts=new_posts)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak memory of a sync as the favourites list grows")
+    parser.add_argument("--sizes", default="1000,10000,50000,200000", help="comma-separated favourites counts")
+    parser.add_argument("--backends", default="json,sqlite", help="comma-separated cache backends")
+    parser.add_argument("--posts-per-page", type=int, default=100)
+    parser.add_argument("--tag-pool", type=int, default=2000)
+    parser.add_argument("--new-every", type=int, default=500, help="one favourite in this many is not yet downloaded")
+    parser.add_argument("--max-growth-mb", type=float, default=15.0,
+                        help="--check fails when the SQLite peak grows by more than this across the sizes")
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--output", help="write the results JSON here")
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "CONFIG"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        return
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    backends = [backend.strip() for backend in args.backends.split(",")]
+    results = []
+    print(f"  {'favourites':>10s} {'backend':>8s} {'new':>5s} {'peak RSS':>10s} {'wall':>8s}")
+    for size in sizes:
+        for backend in backends:
+            r = measure(size, backend, args)
+            results.append(r)
+            print(f"  {size:>10d} {backend:>8s} {r['new_posts']:>5d} {r['peak_rss_mb']:>8.1f}MB {r['wall_seconds']:>7.1f}s")
+            if r["outcomes"]["downloaded"] != r["new_posts"]:
+                print(f"    (downloaded {r['outcomes']['downloaded']} of {r['new_posts']} new posts)")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=2)
+
+    sqlite = [r for r in results if r["backend"] == "sqlite"]
+    if args.check and len(sqlite) > 1:
+        growth = sqlite[-1]["peak_rss_mb"] - sqlite[0]["peak_rss_mb"]
+        if growth > args.max_growth_mb:
+            print(f"\nSQLite peak grew {growth:.1f} MB from {sqlite[0]['size']} to {sqlite[-1]['size']} "
+                  f"favourites (> {args.max_growth_mb:.0f} MB)")
+            sys.exit(1)
+        print(f"\nSQLite peak grew {growth:.1f} MB from {sqlite[0]['size']} to {sqlite[-1]['size']} favourites.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+"""Microbenchmarks for the per-post CPU hot paths.
+
+Every post goes through resolve_download_url, get_sensitivity, the tag-type lookups,
+sanitize_for_path, build_destination_dir and the posts/tag cache lookups. This
+times each of them over synthetic posts and tag caches at realistic scales, without
+any network.
+
+Timings are divided by a reference loop measured in the same process, so the
+thresholds in microbench_thresholds.json carry across machines. --check fails
+(exit 1) when any case is slower than its threshold.
+
+Run with:
+  python benchmarks/microbench.py                # 10k and 100k tags, 100k posts
+  python benchmarks/microbench.py --large        # also 1M tags
+  python benchmarks/microbench.py --check
+  python benchmarks/microbench.py --update-thresholds
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SCRIPT = os.path.join(REPO_DIR, "gelbooru_favorite_downloader.py")
+THRESHOLDS_FILE = os.path.join(BENCH_DIR, "microbench_thresholds.json")
+
+# Thresholds are written at this multiple of the measured cost, leaving room for noise.
+# Regenerate them on an otherwise idle machine.
+THRESHOLD_HEADROOM = 2.5
+
+RATINGS = ("general", "sensitive", "questionable", "explicit")
+
+
+def load_downloader(workdir):
+    """Import the script and build an engine with config.yaml.example's settings and a library in workdir"""
+    with open(os.path.join(REPO_DIR, "config.yaml.example"), "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+    config["settings"]["base_dir"] = os.path.join(workdir, "library")
+    os.chdir(workdir)  # cache files are relative to the working directory
+
+    spec = importlib.util.spec_from_file_location("gelbooru_favorite_downloader", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module, module.Downloader(config)
+
+
+def synthetic_tag_cache(tag_count, rng):
+    """Tag cache shaped like the real one: ~8% characters, ~2% copyrights"""
+    cache = {}
+    for i in range(tag_count):
+        roll = rng.random()
+        if roll < 0.08:
+            name, tag_type = f"character_{i}_(series_{i % 500})", 4
+        elif roll < 0.10:
+            name, tag_type = f"series_{i}", 3
+        else:
+            name, tag_type = f"tag_{i}", 0
+        cache[name] = {"id": i, "name": name, "count": rng.randint(1, 50_000), "type": tag_type, "ambiguous": 0}
+    return cache
+
+
+def synthetic_posts(post_count, tag_names, rng, tags_per_post=25):
+    posts = []
+    for i in range(post_count):
+        md5 = f"{rng.getrandbits(128):032x}"
+        video = rng.random() < 0.05
+        posts.append({
+            "id": 5_000_000 + i,
+            "md5": md5,
+            "directory": f"{md5[:2]}/{md5[2:4]}",
+            "image": f"{md5}.{'mp4' if video else 'jpg'}",
+            "file_url": (
+                f"https://video-cdn3.gelbooru.com/images/{md5[:2]}/{md5[2:4]}/{md5}.mp4" if video
+                else f"https://img3.gelbooru.com/images/{md5[:2]}/{md5[2:4]}/{md5}.jpg"
+            ),
+            "preview_url": f"https://img3.gelbooru.com/thumbnails/{md5[:2]}/{md5[2:4]}/thumbnail_{md5}.jpg",
+            "rating": rng.choice(RATINGS),
+            "tags": " ".join(rng.sample(tag_names, tags_per_post)),
+        })
+    return posts
+
+
+def reference_ns():
+    """Cost of a fixed dict-and-string workload, used to normalise timings across machines"""
+    data = {f"k{i}": i for i in range(1000)}
+    keys = list(data) * 20
+    best = float("inf")
+    for _ in range(5):
+        started = time.perf_counter_ns()
+        total = 0
+        for key in keys:
+            total += data[key] + len(key.split("k"))
+        best = min(best, time.perf_counter_ns() - started)
+    return best / len(keys)
+
+
+def time_per_op(func, items, repeat=3):
+    """Best-of-repeat nanoseconds per call of func over items"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter_ns()
+        for item in items:
+            func(item)
+        best = min(best, time.perf_counter_ns() - started)
+    return best / len(items)
+
+
+def run_scale(module, engine, tag_count, post_count, sample_size, rng):
+    """Benchmark every hot path with a tag_count-sized tag cache and post_count posts"""
+    tag_cache = synthetic_tag_cache(tag_count, rng)
+    tag_names = list(tag_cache)
+    posts = synthetic_posts(post_count, tag_names, rng)
+    sample = posts[:sample_size]
+
+    started = time.perf_counter()
+    engine.save_cache(tag_cache)
+    engine.save_posts_cache({str(p["id"]): True for p in posts})
+    setup_seconds = time.perf_counter() - started
+
+    # First load parses the JSON; later loads are what every post pays.
+    engine._parsed_json_cache.clear()
+    started = time.perf_counter()
+    engine.load_cache()
+    engine.load_posts_cache()
+    cold_load_ms = (time.perf_counter() - started) * 1000
+
+    classified = [
+        (engine.get_character_tags(p["tags"]), engine.get_copyright_tag(p["tags"]), module.get_sensitivity(p))
+        for p in sample
+    ]
+    names = [tag for p in sample for tag in p["tags"].split()[:3]]
+    post_ids = [str(p["id"]) for p in sample] + [str(i) for i in range(len(sample))]
+
+    cases = {
+        "resolve_download_url": time_per_op(module.resolve_download_url, sample),
+        "get_sensitivity": time_per_op(module.get_sensitivity, sample),
+        "get_character_tags": time_per_op(engine.get_character_tags, [p["tags"] for p in sample]),
+        "get_copyright_tag": time_per_op(engine.get_copyright_tag, [p["tags"] for p in sample]),
+        "sanitize_for_path": time_per_op(module.sanitize_for_path, names),
+        "build_destination_dir": time_per_op(lambda c: engine.build_destination_dir(*c), classified),
+        "posts_cache_lookup": time_per_op(lambda pid: pid in engine.load_posts_cache(), post_ids),
+        "tag_cache_lookup": time_per_op(lambda name: engine.load_cache().get(name), names),
+    }
+    return {
+        "tags": tag_count,
+        "posts": post_count,
+        "setup_seconds": round(setup_seconds, 2),
+        "cold_load_ms": round(cold_load_ms, 1),
+        "ns_per_op": {name: round(ns, 1) for name, ns in cases.items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the per-post hot paths")
+    parser.add_argument("--posts", type=int, default=100_000)
+    parser.add_argument("--sample", type=int, default=20_000, help="posts timed per case")
+    parser.add_argument("--large", action="store_true", help="include the 1M-tag scale")
+    parser.add_argument("--check", action="store_true", help="fail if any case exceeds its threshold")
+    parser.add_argument("--update-thresholds", action="store_true")
+    parser.add_argument("--output", help="write the results JSON here")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    tag_scales = [10_000, 100_000] + ([1_000_000] if args.large else [])
+    workdir = tempfile.mkdtemp(prefix="gelbooru-microbench-")
+    previous_cwd = os.getcwd()
+    try:
+        module, engine = load_downloader(workdir)
+        rng = random.Random(args.seed)
+        ref = reference_ns()
+        results = [run_scale(module, engine, tags, args.posts, min(args.sample, args.posts), rng) for tags in tag_scales]
+    finally:
+        os.chdir(previous_cwd)
+
+    for result in results:
+        result["relative"] = {name: round(ns / ref, 2) for name, ns in result["ns_per_op"].items()}
+
+    print(f"Reference loop: {ref:.1f} ns/op (timings below are also shown as multiples of it)")
+    for result in results:
+        print(f"\n{result['tags']:,} tags / {result['posts']:,} posts "
+              f"(cold cache load {result['cold_load_ms']:.0f} ms)")
+        for name, ns in result["ns_per_op"].items():
+            print(f"  {name:<22s} {ns:10.1f} ns/op  x{result['relative'][name]:.2f}")
+
+    thresholds = {}
+    if os.path.exists(THRESHOLDS_FILE):
+        with open(THRESHOLDS_FILE, "r", encoding="utf-8") as f:
+            thresholds = json.load(f)
+
+    failures = []
+    if args.check:
+        for result in results:
+            limits = thresholds.get(str(result["tags"]), {})
+            for name, rel in result["relative"].items():
+                if name in limits and rel > limits[name]:
+                    failures.append(f"{result['tags']:,} tags: {name} x{rel:.2f} > threshold x{limits[name]:.2f}")
+
+    if args.update_thresholds:
+        for result in results:
+            thresholds[str(result["tags"])] = {
+                name: round(rel * THRESHOLD_HEADROOM, 2) for name, rel in result["relative"].items()
+            }
+        with open(THRESHOLDS_FILE, "w", encoding="utf-8") as f:
+            json.dump(thresholds, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nUpdated {THRESHOLDS_FILE}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"reference_ns": ref, "results": results}, f, indent=2)
+
+    if failures:
+        print("\nRegressions:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+    if args.check:
+        print("\nAll cases within thresholds.")
+
+
+if __name__ == "__main__":
+    main()
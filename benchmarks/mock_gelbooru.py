@@ -0,0 +1,366 @@
+"""Local stand-in for the parts of Gelbooru the downloader talks to.
+
+Serves the login form, favourites HTML pages, post/tag dapi JSON and image bytes
+for a synthetic account, with configurable latency, bandwidth, file sizes and 429
+behaviour, and counts every request per endpoint. Used by run_benchmark.py; can
+also be run on its own and pointed at with settings.site_url in config.yaml.
+
+Run with: python benchmarks/mock_gelbooru.py --port 8080 --favourites 500
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Gelbooru tag types the downloader cares about.
+TAG_TYPE_GENERAL = 0
+TAG_TYPE_COPYRIGHT = 3
+TAG_TYPE_CHARACTER = 4
+
+RATINGS = ("general", "sensitive", "questionable", "explicit")
+
+ENDPOINTS = ("login", "favourites", "post", "tag", "image", "other")
+
+
+class TokenBucket:
+    """Requests allowed at `rate` per second with bursts up to `burst`; rate <= 0 disables it"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        if self.rate <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class MockSettings:
+    """Knobs for the synthetic account and the server's behaviour"""
+
+    def __init__(
+        self,
+        favourites=200,
+        posts_per_page=50,
+        tags_per_post=12,
+        tag_pool=2000,
+        character_share=0.1,
+        copyright_share=0.03,
+        api_latency_ms=40.0,
+        image_latency_ms=60.0,
+        latency_jitter_ms=20.0,
+        bandwidth_bps=8_000_000,
+        size_median_bytes=400_000,
+        size_sigma=0.8,
+        video_share=0.0,
+        video_size_factor=1.0,
+        api_rate=0.0,
+        api_burst=10.0,
+        image_rate=0.0,
+        image_burst=10.0,
+        retry_after=None,
+        seed=1,
+    ):
+        self.favourites = favourites
+        self.posts_per_page = posts_per_page
+        self.tags_per_post = tags_per_post
+        self.tag_pool = tag_pool
+        self.character_share = character_share
+        self.copyright_share = copyright_share
+        self.api_latency_ms = api_latency_ms
+        self.image_latency_ms = image_latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.bandwidth_bps = bandwidth_bps
+        self.size_median_bytes = size_median_bytes
+        self.size_sigma = size_sigma
+        self.video_share = video_share
+        self.video_size_factor = video_size_factor
+        self.api_rate = api_rate
+        self.api_burst = api_burst
+        self.image_rate = image_rate
+        self.image_burst = image_burst
+        self.retry_after = retry_after
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class MockGelbooru:
+    """Deterministic synthetic account plus the HTTP server that serves it"""
+
+    def __init__(self, settings=None, host="127.0.0.1", port=0):
+        self.settings = settings or MockSettings()
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.mock = self
+        self.api_bucket = TokenBucket(self.settings.api_rate, self.settings.api_burst)
+        self.image_bucket = TokenBucket(self.settings.image_rate, self.settings.image_burst)
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+        self._thread = None
+        self._build_account()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _build_account(self):
+        s = self.settings
+        rng = random.Random(s.seed)
+        self.tags = {}
+        for i in range(s.tag_pool):
+            roll = rng.random()
+            if roll < s.character_share:
+                name, tag_type = f"character_{i}_(series_{i % 40})", TAG_TYPE_CHARACTER
+            elif roll < s.character_share + s.copyright_share:
+                name, tag_type = f"series_{i}", TAG_TYPE_COPYRIGHT
+            else:
+                name, tag_type = f"tag_{i}", TAG_TYPE_GENERAL
+            self.tags[name] = {"id": i, "name": name, "count": rng.randint(1, 100_000), "type": tag_type, "ambiguous": 0}
+        tag_names = list(self.tags)
+
+        # Newest favourite first, as on the real favourites page.
+        self.favourite_ids = [str(1_000_000 + i) for i in range(s.favourites, 0, -1)]
+        self.posts = {}
+        for post_id in self.favourite_ids:
+            md5 = hashlib.md5(f"{s.seed}:{post_id}".encode()).hexdigest()
+            ext = "mp4" if rng.random() < s.video_share else "jpg"
+            size = max(1024, int(rng.lognormvariate(0, s.size_sigma) * s.size_median_bytes))
+            if ext == "mp4":
+                size = int(size * s.video_size_factor)
+            self.posts[post_id] = {
+                "id": int(post_id),
+                "md5": md5,
+                "directory": f"{md5[:2]}/{md5[2:4]}",
+                "image": f"{md5}.{ext}",
+                "rating": rng.choice(RATINGS),
+                "score": rng.randint(0, 500),
+                "width": rng.choice((800, 1200, 1920, 2480, 4096)),
+                "height": rng.choice((600, 1080, 1754, 3508)),
+                "tags": " ".join(rng.sample(tag_names, min(s.tags_per_post, len(tag_names)))),
+                "_size": size,
+            }
+        self.posts_by_md5 = {post["md5"]: post for post in self.posts.values()}
+
+    def post_json(self, post_id):
+        post = self.posts[post_id]
+        public = {k: v for k, v in post.items() if not k.startswith("_")}
+        public["file_url"] = f"{self.url}/images/{post['directory']}/{post['image']}"
+        public["preview_url"] = f"{self.url}/thumbnails/{post['directory']}/thumbnail_{post['md5']}.jpg"
+        return public
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.requests = dict.fromkeys(ENDPOINTS, 0)
+            self.responses_429 = dict.fromkeys(ENDPOINTS, 0)
+            self.bytes_sent = 0
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                "requests": dict(self.requests),
+                "responses_429": dict(self.responses_429),
+                "bytes_sent": self.bytes_sent,
+            }
+
+    def count(self, endpoint, throttled=False, sent=0):
+        with self.stats_lock:
+            self.requests[endpoint] += 1
+            if throttled:
+                self.responses_429[endpoint] += 1
+            self.bytes_sent += sent
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="mock-gelbooru", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass  # keep the benchmark output clean
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def _sleep_latency(self, base_ms):
+        jitter = self.mock.settings.latency_jitter_ms
+        delay = base_ms + (random.uniform(-jitter, jitter) if jitter else 0)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+    def _send(self, endpoint, status, body=b"", content_type="text/html; charset=utf-8", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+        self.mock.count(endpoint, throttled=status == 429, sent=len(body))
+
+    def _throttled(self, endpoint, bucket):
+        if bucket.take():
+            return False
+        headers = {}
+        if self.mock.settings.retry_after is not None:
+            headers["Retry-After"] = str(self.mock.settings.retry_after)
+        self._send(endpoint, 429, b"Too Many Requests", "text/plain", headers)
+        return True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        query = parse_qs(urlparse(self.path).query)
+        if query.get("page") == ["account"]:
+            self._sleep_latency(self.mock.settings.api_latency_ms)
+            self._send("login", 200, b'<html><a href="index.php?page=account&s=logout">Logout</a></html>')
+            return
+        self._send("other", 404, b"not found", "text/plain")
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        settings = self.mock.settings
+
+        if parsed.path.startswith("/images/"):
+            self._serve_image(parsed.path)
+            return
+        if parsed.path == "/_stats":
+            self._send("other", 200, json.dumps(self.mock.stats()).encode(), "application/json")
+            return
+
+        page = query.get("page")
+        if page == "favorites":
+            if self._throttled("favourites", self.mock.api_bucket):
+                return
+            self._sleep_latency(settings.api_latency_ms)
+            self._serve_favourites(int(query.get("pid", 0)))
+        elif page == "dapi" and query.get("s") == "post":
+            if self._throttled("post", self.mock.api_bucket):
+                return
+            self._sleep_latency(settings.api_latency_ms)
+            post_id = query.get("id")
+            if post_id in self.mock.posts:
+                body = {"@attributes": {"limit": 100, "offset": 0, "count": 1}, "post": [self.mock.post_json(post_id)]}
+            else:
+                body = {"@attributes": {"limit": 100, "offset": 0, "count": 0}}
+            self._send("post", 200, json.dumps(body).encode(), "application/json")
+        elif page == "dapi" and query.get("s") == "tag":
+            if self._throttled("tag", self.mock.api_bucket):
+                return
+            self._sleep_latency(settings.api_latency_ms)
+            tag = self.mock.tags.get(query.get("name", ""))
+            body = {"@attributes": {"limit": 100, "offset": 0, "count": 1 if tag else 0}}
+            if tag:
+                body["tag"] = [tag]
+            self._send("tag", 200, json.dumps(body).encode(), "application/json")
+        else:
+            self._send("other", 404, b"not found", "text/plain")
+
+    def _serve_favourites(self, pid):
+        settings = self.mock.settings
+        ids = self.mock.favourite_ids[pid : pid + settings.posts_per_page]
+        thumbs = []
+        for post_id in ids:
+            post = self.mock.posts[post_id]
+            title = f"{post['tags']} score:{post['score']} rating:{post['rating']}"
+            thumbs.append(
+                f'<span class="thumb" id="s{post_id}"><a href="index.php?page=post&amp;s=view&amp;id={post_id}">'
+                f'<img src="{self.mock.post_json(post_id)["preview_url"]}" title="{title}" /></a></span>'
+            )
+        body = "<html><body><div>" + "".join(thumbs) + "</div></body></html>"
+        self._send("favourites", 200, body.encode())
+
+    def _serve_image(self, path):
+        settings = self.mock.settings
+        if self._throttled("image", self.mock.image_bucket):
+            return
+        self._sleep_latency(settings.image_latency_ms)
+        md5 = path.rsplit("/", 1)[-1].split(".")[0]
+        post = self.mock.posts_by_md5.get(md5)
+        if post is None:
+            self._send("image", 404, b"<html>not found</html>")
+            return
+
+        size = post["_size"]
+        content_type = "video/mp4" if post["image"].endswith(".mp4") else "image/jpeg"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+
+        chunk = 64 * 1024
+        block = (md5.encode() * (chunk // len(md5) + 1))[:chunk]
+        sent = 0
+        started = time.monotonic()
+        while sent < size:
+            n = min(chunk, size - sent)
+            self.wfile.write(block[:n])
+            sent += n
+            if settings.bandwidth_bps > 0:
+                ahead = sent / settings.bandwidth_bps - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+        self.mock.count("image", sent=sent)
+
+
+def add_settings_arguments(parser):
+    """Add a --flag for every MockSettings knob"""
+    defaults = MockSettings().to_dict()
+    for name, default in defaults.items():
+        flag = "--" + name.replace("_", "-")
+        kind = type(default) if default is not None else float
+        parser.add_argument(flag, dest=name, type=kind, default=default)
+
+
+def settings_from_args(args):
+    return MockSettings(**{name: getattr(args, name) for name in MockSettings().to_dict()})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local stand-in Gelbooru server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+
+    mock = MockGelbooru(settings_from_args(args), args.host, args.port)
+    print(f"Mock Gelbooru serving {args.favourites} favourites on {mock.url} (Ctrl+C to stop)")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(mock.stats(), indent=2))
+        mock.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""Deterministic simulator for the adaptive rate-limit controller.
+
+Runs a real Downloader engine's rate_limit_api_call / handle_rate_limit_response /
+reset_adaptive_delay against a model server on a virtual clock. An hour of
+traffic takes well under a second, and the same seed always gives the same
+answer. Each run reports throughput, 429 count and idle time for a config.
+--grid searches min_delay, delay_increase_factor, success_threshold and
+max_workers.
+
+The server is either a token bucket (--rate/--burst, with latency and an
+optional lock-out after each 429) or one fitted to a recorded trace (--trace).
+A trace is JSONL with one request per line and at least "ts" (epoch seconds)
+and "status"; "latency" (seconds) is used when present. The downloader's --trace
+output works as is (only its "request" records are used, optionally for one
+endpoint via --trace-endpoint).
+
+Workers are simulated as a discrete-event loop: the worker with the earliest
+virtual time runs next, and sleeps advance only that worker's time. Workers above
+current_max_workers are parked until the controller ramps back up. The real
+downloader only resizes its pools between batches, so the simulator reacts to
+worker changes slightly faster than the real tool.
+
+Run with:
+  python benchmarks/ratelimit_sim.py --rate 4 --burst 10 --requests 2000
+  python benchmarks/ratelimit_sim.py --rate 4 --grid --output grid.json
+  python benchmarks/ratelimit_sim.py --trace run-trace.jsonl --grid
+"""
+
+import argparse
+import contextlib
+import heapq
+import importlib.util
+import io
+import itertools
+import json
+import os
+import random
+import sys
+
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SCRIPT = os.path.join(REPO_DIR, "gelbooru_favorite_downloader.py")
+
+# How long a parked worker waits before checking current_max_workers again.
+PARKED_POLL_SECONDS = 1.0
+
+DEFAULT_GRID = {
+    "min_delay": [0.1, 0.25, 0.5],
+    "delay_increase_factor": [1.25, 1.5, 2.0],
+    "success_threshold": [5, 15, 30],
+    "max_workers": [2, 4, 8],
+}
+
+
+class VirtualClock:
+    """Per-worker virtual time: time() and sleep() act on whichever worker is running"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+
+class TokenBucketServer:
+    """Allows `rate` requests/s with bursts of `burst`; a 429 can lock the client out for `penalty` s"""
+
+    def __init__(self, rate, burst, latency=0.15, jitter=0.05, penalty=0.0, seed=1):
+        self.rate = rate
+        self.burst = burst
+        self.latency = latency
+        self.jitter = jitter
+        self.penalty = penalty
+        self.rng = random.Random(seed)
+        self.tokens = burst
+        self.updated = 0.0
+        self.locked_until = 0.0
+
+    def request(self, t):
+        """Return (status, latency) for a request arriving at virtual time t"""
+        latency = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+        if t < self.locked_until:
+            return 429, latency
+        if t > self.updated:
+            self.tokens = min(self.burst, self.tokens + (t - self.updated) * self.rate)
+            self.updated = t
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 200, latency
+        self.locked_until = t + self.penalty
+        return 429, latency
+
+
+def load_trace(path, endpoint=None):
+    with open(path, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return [
+        r for r in records
+        if "ts" in r and r.get("status") is not None and r.get("kind", "request") == "request"
+        and (endpoint is None or r.get("endpoint") == endpoint)
+    ]
+
+
+def fit_trace(records, seed=1):
+    """Build a TokenBucketServer whose limits match what the recorded server tolerated.
+
+    rate is the best 10-second window of successful requests that saw no 429;
+    burst is the most successful requests seen within one second; latency is
+    the median recorded latency.
+    """
+    if not records:
+        raise SystemExit("Trace has no usable records (need 'ts' and 'status').")
+    records = sorted(records, key=lambda r: r["ts"])
+    start = records[0]["ts"]
+    window = 10.0
+    best_rate = 0.0
+    burst = 1
+    ok_times = [r["ts"] - start for r in records if r["status"] != 429]
+    bad_times = [r["ts"] - start for r in records if r["status"] == 429]
+    for i, t in enumerate(ok_times):
+        in_window = [u for u in ok_times[i:] if u < t + window]
+        if not any(t <= u < t + window for u in bad_times):
+            best_rate = max(best_rate, len(in_window) / window)
+        burst = max(burst, sum(1 for u in in_window if u < t + 1.0))
+    latencies = sorted(r["latency"] for r in records if isinstance(r.get("latency"), (int, float)))
+    latency = latencies[len(latencies) // 2] if latencies else 0.15
+    return TokenBucketServer(max(best_rate, 0.1), burst, latency=latency, jitter=latency / 3, seed=seed)
+
+
+def load_downloader():
+    """A Downloader engine with config.yaml.example's settings; the simulator never touches the network"""
+    with open(os.path.join(REPO_DIR, "config.yaml.example"), "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+    spec = importlib.util.spec_from_file_location("gelbooru_favorite_downloader", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.Downloader(config)
+
+
+def simulate(engine, server, params, requests_total, endpoint="detail", max_seconds=86_400, learned=None):
+    """Drive the controller until requests_total requests succeed; return the run's metrics.
+
+    learned carries the per-endpoint limits of an earlier run over, as
+    rate_limit_state.json does between real runs.
+    """
+    for name, value in params.items():
+        setattr(engine, name, value)
+    engine.reset_rate_limit_state()
+    # The virtual clock restarts at 0, so carried-over limits look fresh (an immediate rerun).
+    engine.start_limits.update({ep: dict(v, updated=0.0) for ep, v in (learned or {}).items()})
+    clock = VirtualClock()
+    engine.clock = clock
+
+    workers = params["max_workers"]
+    events = [(0.0, w) for w in range(workers)]
+    heapq.heapify(events)
+    done = 0
+    attempts = 0
+    parked_seconds = 0.0
+    makespan = 0.0
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        while done < requests_total and events:
+            t, worker = heapq.heappop(events)
+            if t > max_seconds:
+                break
+            if worker >= engine.current_max_workers:
+                parked_seconds += PARKED_POLL_SECONDS
+                heapq.heappush(events, (t + PARKED_POLL_SECONDS, worker))
+                continue
+            clock.now = t
+            engine.rate_limit_api_call(endpoint)
+            status, latency = server.request(clock.now)
+            clock.sleep(latency)
+            attempts += 1
+            if status == 429:
+                engine.handle_rate_limit_response(endpoint)
+            else:
+                engine.reset_adaptive_delay()
+                done += 1
+            makespan = max(makespan, clock.now)
+            heapq.heappush(events, (clock.now, worker))
+
+    stats = engine.rate_stats
+    idle = stats["throttle_wait_seconds"] + stats["cooldown_seconds"] + parked_seconds
+    return {
+        "params": dict(params),
+        "completed": done,
+        "attempts": attempts,
+        "virtual_seconds": round(makespan, 2),
+        "throughput": round(done / makespan, 3) if makespan else 0.0,
+        "responses_429": stats["rate_limit_429s"],
+        "idle_seconds": round(idle, 2),
+        "idle_share": round(idle / (makespan * workers), 3) if makespan else 0.0,
+        "peak_delay": round(stats["peak_delay_seconds"], 3),
+        "final_delay": round(engine.adaptive_delay, 3),
+        "min_workers": stats["min_workers"],
+        "learned": {ep: dict(v) for ep, v in {**engine.start_limits, **engine.learned_limits}.items()},
+    }
+
+
+def base_params(engine, args):
+    return {
+        "min_delay": args.min_delay if args.min_delay is not None else engine.min_delay,
+        "max_delay": engine.max_delay,
+        "delay_increase_factor": args.delay_increase_factor if args.delay_increase_factor is not None else engine.delay_increase_factor,
+        "delay_decrease_factor": engine.delay_decrease_factor,
+        "success_threshold": args.success_threshold if args.success_threshold is not None else engine.success_threshold,
+        "max_workers": args.max_workers if args.max_workers is not None else engine.max_workers,
+    }
+
+
+def make_server(args):
+    if args.trace:
+        return fit_trace(load_trace(args.trace, args.trace_endpoint), seed=args.seed)
+    return TokenBucketServer(args.rate, args.burst, args.latency, args.jitter, args.penalty, args.seed)
+
+
+def score(result, penalty_per_429):
+    """Throughput, docked for every 429 so that noisy configs don't win on raw speed alone"""
+    if not result["virtual_seconds"]:
+        return 0.0
+    return result["throughput"] - penalty_per_429 * result["responses_429"] / result["virtual_seconds"]
+
+
+def print_result(result):
+    p = result["params"]
+    print(
+        f"  min_delay={p['min_delay']:<5} inc={p['delay_increase_factor']:<5} "
+        f"threshold={p['success_threshold']:<3} workers={p['max_workers']:<2} | "
+        f"{result['throughput']:7.3f} req/s  {result['responses_429']:4d} x 429  "
+        f"idle {result['idle_share'] * 100:5.1f}%  ({result['virtual_seconds']:.0f}s virtual)"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline simulator for the adaptive rate limiter")
+    parser.add_argument("--requests", type=int, default=2000, help="successful requests to simulate")
+    parser.add_argument("--rate", type=float, default=4.0, help="server token-bucket rate (req/s)")
+    parser.add_argument("--burst", type=float, default=10.0, help="server token-bucket size")
+    parser.add_argument("--latency", type=float, default=0.15, help="mean response latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.05, help="+/- latency jitter (s)")
+    parser.add_argument("--penalty", type=float, default=0.0, help="seconds every request is refused after a 429")
+    parser.add_argument("--trace", help="fit the server model to a recorded JSONL trace instead")
+    parser.add_argument("--trace-endpoint", help="only fit to this endpoint's requests (e.g. detail or tag)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=1,
+                        help="back-to-back runs, each starting from the limits the previous one learned")
+    parser.add_argument("--min-delay", type=float)
+    parser.add_argument("--delay-increase-factor", type=float)
+    parser.add_argument("--success-threshold", type=int)
+    parser.add_argument("--max-workers", type=int)
+    parser.add_argument("--grid", action="store_true", help="grid-search the four tuning knobs")
+    parser.add_argument("--grid-file", help="JSON object of knob -> list of values, replacing the default grid")
+    parser.add_argument("--penalty-per-429", type=float, default=0.5,
+                        help="req/s of score docked per 429/s when ranking grid results")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--output", help="write all results as JSON here")
+    args = parser.parse_args()
+
+    engine = load_downloader()
+    params = base_params(engine, args)
+
+    if not args.grid:
+        results = []
+        learned = None
+        for run in range(args.runs):
+            result = simulate(engine, make_server(args), params, args.requests, learned=learned)
+            learned = result["learned"]
+            if args.runs > 1:
+                print(f"Run {run + 1}:")
+            print_result(result)
+            results.append(result)
+    else:
+        grid = DEFAULT_GRID
+        if args.grid_file:
+            with open(args.grid_file, "r", encoding="utf-8") as f:
+                grid = json.load(f)
+        names = list(grid)
+        results = []
+        for values in itertools.product(*(grid[name] for name in names)):
+            run_params = dict(params, **dict(zip(names, values)))
+            # A fresh server per run so every config faces the same conditions.
+            results.append(simulate(engine, make_server(args), run_params, args.requests))
+        results.sort(key=lambda r: score(r, args.penalty_per_429), reverse=True)
+        print(f"Top {min(args.top, len(results))} of {len(results)} configs (ranked by throughput, "
+              f"docked {args.penalty_per_429} per 429/s):")
+        for result in results[: args.top]:
+            print_result(result)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,196 @@
+"""End-to-end throughput benchmark against the local mock Gelbooru server.
+
+Starts benchmarks/mock_gelbooru.py in-process and builds a Downloader engine
+pointed at it, with config.yaml.example's settings plus the options below. It
+then calls engine.sync(), which is what a normal run does, and reports the
+engine's own per-stage wall times next to the request counts seen by the server.
+Results are printed and saved as JSON, so runs can be compared across versions
+and settings.
+
+Run with:
+  python benchmarks/run_benchmark.py --favourites 300 --max-workers 4 --download-workers 3
+  python benchmarks/run_benchmark.py --output new.json --compare old.json
+"""
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SCRIPT = os.path.join(REPO_DIR, "gelbooru_favorite_downloader.py")
+
+sys.path.insert(0, BENCH_DIR)
+from mock_gelbooru import MockGelbooru, add_settings_arguments, settings_from_args  # noqa: E402
+
+def build_config(args, site_url, base_dir):
+    """Engine config for the run, from the example file plus CLI overrides"""
+    with open(os.path.join(REPO_DIR, "config.yaml.example"), "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+    config["settings"].update({
+        "site_url": site_url,
+        "base_dir": base_dir,
+        "posts_per_page": args.posts_per_page,
+        "max_consecutive_empty_pages": 1,
+    })
+    config["threading"].update({
+        "max_workers": args.max_workers,
+        "download_workers": args.download_workers,
+        "tag_batch_size": args.tag_batch_size,
+        "large_file_workers": args.large_file_workers,
+    })
+    for key in (
+        "min_delay", "max_delay", "delay_increase_factor", "delay_decrease_factor", "success_threshold",
+        "max_download_bytes_per_second",
+    ):
+        value = getattr(args, key)
+        if value is not None:
+            config["rate_limiting"][key] = value
+    return config
+
+
+def import_downloader():
+    spec = importlib.util.spec_from_file_location("gelbooru_favorite_downloader", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "-C", REPO_DIR, "describe", "--always", "--dirty"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    mock = MockGelbooru(settings_from_args(args)).start()
+    workdir = tempfile.mkdtemp(prefix="gelbooru-bench-")
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)  # cache files are relative to the working directory
+
+    captured = io.StringIO()
+    try:
+        module = import_downloader()
+        engine = module.Downloader(
+            build_config(args, mock.url, os.path.join(workdir, "library")),
+            credentials=("bench", "1", "bench", "bench"),
+        )
+        if args.trace:
+            engine.open_trace(args.trace)
+        mock.reset_stats()
+        started = time.perf_counter()
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(captured)
+        with output:
+            result = engine.sync()
+            engine.close()
+        wall = time.perf_counter() - started
+    finally:
+        os.chdir(previous_cwd)
+        mock.stop()
+
+    server = mock.stats()
+    posts_cache_path = os.path.join(workdir, engine.posts_cache_file)
+    posts_done = 0
+    if os.path.exists(posts_cache_path):
+        with open(posts_cache_path, "r") as f:
+            posts_done = len(json.load(f))
+    tuning = build_config(args, mock.url, "library")
+    metrics = result["metrics"]
+
+    return {
+        "version": git_revision(),
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "mock": mock.settings.to_dict(),
+        "config": {"threading": tuning["threading"], "rate_limiting": tuning["rate_limiting"]},
+        "results": {
+            "wall_seconds": round(wall, 3),
+            "posts": posts_done,
+            "posts_per_second": round(posts_done / wall, 3) if wall else 0.0,
+            "bytes": server["bytes_sent"],
+            "bytes_per_second": round(server["bytes_sent"] / wall, 1) if wall else 0.0,
+            "requests": server["requests"],
+            "responses_429": server["responses_429"],
+            "stage_seconds": {k: round(v, 3) for k, v in metrics["stage_seconds"].items()},
+            "stage_calls": metrics["stage_calls"],
+            "outcomes": result["outcomes"],
+            "rate_stats": metrics["rate_stats"],
+        },
+        "workdir": workdir,
+    }
+
+
+def print_report(report, baseline=None):
+    r = report["results"]
+    base = baseline["results"] if baseline else None
+
+    def delta(key, value):
+        if not base or not base.get(key):
+            return ""
+        change = (value - base[key]) / base[key] * 100
+        return f"  ({change:+.1f}% vs baseline)"
+
+    print("=" * 60)
+    print(f"  Benchmark {report['version'] or ''} - {report['mock']['favourites']} favourites")
+    print("=" * 60)
+    print(f"  Wall time:     {r['wall_seconds']:.2f}s{delta('wall_seconds', r['wall_seconds'])}")
+    print(f"  Posts:         {r['posts']} ({r['posts_per_second']:.2f}/s){delta('posts_per_second', r['posts_per_second'])}")
+    print(f"  Bytes:         {r['bytes'] / 1e6:.1f} MB ({r['bytes_per_second'] / 1e6:.2f} MB/s){delta('bytes_per_second', r['bytes_per_second'])}")
+    print("  Requests:      " + ", ".join(f"{k}={v}" for k, v in r["requests"].items() if v))
+    if any(r["responses_429"].values()):
+        print("  429s:          " + ", ".join(f"{k}={v}" for k, v in r["responses_429"].items() if v))
+    print("  Stage wall time (summed across calls):")
+    for stage, seconds in r["stage_seconds"].items():
+        print(f"    - {stage:<8s} {seconds:8.2f}s over {r['stage_calls'][stage]} calls")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput benchmark against a local mock Gelbooru")
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument("--download-workers", type=int, default=3)
+    parser.add_argument("--tag-batch-size", type=int, default=20)
+    parser.add_argument("--min-delay", type=float, default=None)
+    parser.add_argument("--max-delay", type=float, default=None)
+    parser.add_argument("--delay-increase-factor", type=float, default=None)
+    parser.add_argument("--delay-decrease-factor", type=float, default=None)
+    parser.add_argument("--success-threshold", type=int, default=None)
+    parser.add_argument("--max-download-bytes-per-second", type=float, default=None)
+    parser.add_argument("--large-file-workers", type=int, default=1)
+    parser.add_argument("--output", help="write the result JSON here")
+    parser.add_argument("--compare", help="baseline result JSON to compare against")
+    parser.add_argument("--verbose", action="store_true", help="show the downloader's own output")
+    parser.add_argument("--trace", help="also have the downloader write a request trace here")
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+
+    if args.trace:
+        args.trace = os.path.abspath(args.trace)
+    report = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
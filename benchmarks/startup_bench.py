@@ -0,0 +1,168 @@
+"""Start-up time of the offline commands.
+
+--list-failed, --analyze-trace and --help never touch the network, so they should
+not pay for requests, bs4 or the credential check. This runs each of them as a
+fresh process against a throwaway config (with no credentials in the
+environment) and compares the median wall time with a bare `python -c pass`.
+It also reports which of the heavy modules each command ended up importing.
+
+--check fails (exit 1) when a command imports a heavy module it does not need,
+or starts more than --max-overhead-ms slower than the bare interpreter.
+
+Run with:
+  python benchmarks/startup_bench.py
+  python benchmarks/startup_bench.py --runs 30 --check
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SCRIPT = os.path.join(REPO_DIR, "gelbooru_favorite_downloader.py")
+
+# Modules only the network paths (or a config file) need
+HEAVY_MODULES = ("requests", "bs4", "yaml", "dotenv", "sqlite3", "http.server", "concurrent.futures")
+
+# Runs the script as __main__ and reports the heavy modules it imported on stderr
+MODULE_PROBE = """
+import json, runpy, sys
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+except SystemExit:
+    pass
+finally:
+    loaded = [name for name in {heavy!r} if name in sys.modules]
+    sys.stderr.write("HEAVY_MODULES " + json.dumps(loaded) + "\\n")
+"""
+
+
+def prepare_workdir():
+    """Throwaway config, failed-posts caches and a two-request trace in a temp dir"""
+    workdir = tempfile.mkdtemp(prefix="gelbooru-startup-")
+    with open(os.path.join(REPO_DIR, "config.yaml.example"), "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f)
+    config["settings"]["base_dir"] = os.path.join(workdir, "library")
+    with open(os.path.join(workdir, "config.yaml"), "w", encoding="utf-8") as f:
+        yaml.safe_dump(config, f)
+
+    failed = {str(1000 + i): {"type": "download", "error": "HTTP 503"} for i in range(200)}
+    with open(os.path.join(workdir, config["cache"]["failed_posts_cache_file"]), "w", encoding="utf-8") as f:
+        json.dump(failed, f)
+    with open(os.path.join(workdir, config["cache"]["rate_limited_posts_file"]), "w", encoding="utf-8") as f:
+        json.dump([str(2000 + i) for i in range(50)], f)
+
+    trace_path = os.path.join(workdir, "trace.jsonl")
+    now = time.time()
+    with open(trace_path, "w", encoding="utf-8") as f:
+        for i, endpoint in enumerate(("detail", "tag")):
+            f.write(json.dumps({
+                "ts": now + i, "kind": "request", "thread": "worker", "endpoint": endpoint,
+                "status": 200, "latency": 0.2, "ttfb": 0.1, "bytes": 512, "wait": 0.0,
+            }) + "\n")
+    return workdir, trace_path
+
+
+def command_env(workdir):
+    """Environment for the child: the throwaway config and no Gelbooru credentials"""
+    env = {k: v for k, v in os.environ.items() if not k.startswith("GELBOORU_")}
+    env["GELBOORU_CONFIG"] = os.path.join(workdir, "config.yaml")
+    return env
+
+
+def time_command(argv, env, cwd, runs):
+    """Median and minimum wall milliseconds of runs fresh processes"""
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run(argv, env=env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        samples.append((time.perf_counter() - started) * 1000)
+        if result.returncode != 0:
+            raise RuntimeError(f"{' '.join(argv)} exited {result.returncode}: {result.stderr.decode()[-500:]}")
+    return statistics.median(samples), min(samples)
+
+
+def heavy_modules_loaded(script_args, env, cwd):
+    probe = MODULE_PROBE.format(heavy=HEAVY_MODULES)
+    result = subprocess.run(
+        [sys.executable, "-c", probe, SCRIPT, *script_args],
+        env=env, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    )
+    for line in result.stderr.splitlines():
+        if line.startswith("HEAVY_MODULES "):
+            return json.loads(line.split(" ", 1)[1])
+    raise RuntimeError(f"module probe failed: {result.stderr[-500:]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start-up time of the offline commands")
+    parser.add_argument("--runs", type=int, default=15, help="processes timed per command")
+    parser.add_argument("--max-overhead-ms", type=float, default=120.0,
+                        help="--check fails when a command's median exceeds the bare interpreter's by more")
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--output", help="write the results JSON here")
+    args = parser.parse_args()
+
+    workdir, trace_path = prepare_workdir()
+    env = command_env(workdir)
+    # name -> (script arguments, heavy modules it may import)
+    commands = {
+        "--help": (["--help"], ()),
+        "--list-failed": (["--list-failed"], ("yaml",)),
+        "--analyze-trace": (["--analyze-trace", trace_path], ()),
+    }
+
+    baseline, _ = time_command([sys.executable, "-c", "pass"], env, workdir, args.runs)
+    results = {}
+    failures = []
+    for name, (script_args, allowed) in commands.items():
+        median, fastest = time_command([sys.executable, SCRIPT, *script_args], env, workdir, args.runs)
+        cached, _ = time_command(
+            [sys.executable, "-m", "gelbooru_favorite_downloader", *script_args],
+            dict(env, PYTHONPATH=REPO_DIR), workdir, args.runs,
+        )
+        loaded = heavy_modules_loaded(script_args, env, workdir)
+        results[name] = {
+            "median_ms": round(median, 1),
+            "min_ms": round(fastest, 1),
+            "overhead_ms": round(median - baseline, 1),
+            "module_median_ms": round(cached, 1),
+            "heavy_modules": loaded,
+        }
+        unexpected = [module for module in loaded if module not in allowed]
+        if unexpected:
+            failures.append(f"{name} imported {', '.join(unexpected)}")
+        if median - baseline > args.max_overhead_ms:
+            failures.append(f"{name} overhead {median - baseline:.0f} ms > {args.max_overhead_ms:.0f} ms")
+
+    print(f"Bare interpreter (python -c pass): {baseline:.1f} ms median over {args.runs} runs")
+    print(f"\n  {'command':<16s} {'median':>8s} {'overhead':>9s} {'-m':>8s}  heavy imports")
+    for name, r in results.items():
+        print(f"  {name:<16s} {r['median_ms']:6.1f}ms {r['overhead_ms']:+7.1f}ms "
+              f"{r['module_median_ms']:6.1f}ms  {', '.join(r['heavy_modules']) or '-'}")
+    print("\n  (-m: run as `python -m gelbooru_favorite_downloader`, which reuses the cached bytecode)")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "baseline_ms": round(baseline, 1), "results": results}, f, indent=2)
+
+    if failures:
+        print("\nRegressions:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+    if args.check:
+        print("\nAll commands within budget.")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,37 +8,76 @@ with adaptive rate limiting. Progress is cached so reruns skip already-downloade
 
 Run with: python gelbooru_favorite_downloader.py
 
+Or embed it: the Downloader class is the whole engine, with sync() and
+retry_failed() returning structured results; the command line is a thin wrapper.
+
 Flags:
   -logtofile        also append console output to log.txt (and debug_log.txt with --debug)
   -r/--retry-failed retry posts recorded in the failed-posts cache instead of paging favourites
   --list-failed     print failed and rate-limited posts, then exit without downloading
   --debug           emit verbose rate-limit telemetry
+  --watch           keep running and sync whenever new favourites appear
+  --profiles a,b    sync several accounts from the profiles section of config.yaml
+  --shard-db PATH   backfill worker claiming favourites pages from a shared SQLite file
+                    (--shard-merge folds the results into posts_cache.json)
+  --worker-id ID    name of this backfill worker (default: hostname-pid)
+  --plan [FILE]     print what a sync would download and roughly how long it would take,
+                    without downloading or writing anything (FILE gets the per-post plan)
+  --reshard         move existing images into the settings.fanout_levels folder layout
+  --changes [C]     print the change manifest entries after cursor C as JSON lines
+  --metrics-json P  write latency percentiles, throughput and stage times to P at exit
+  --metrics-port N  serve Prometheus metrics on 127.0.0.1:N for the length of the run
+  --trace FILE      write a JSONL record per request, 429 and stage (--analyze-trace FILE reports on it)
+  --profile [P]     sampling profile with per-stage CPU and lock waits, written to P.txt / P.folded
 """
 
 import argparse
+import atexit
+import bisect
+import collections
+import functools
+import glob
+import heapq
 import html
 import json
 import os
+import queue
+import random
+import re
+import shutil
 import signal
 import sys
 import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import quote, urlparse
 
-import requests
-import yaml
-from bs4 import BeautifulSoup
-from colorama import init, Fore, Style
-from dotenv import load_dotenv
-
-# Initialise colorama for Windows compatibility
-init(autoreset=True)
+# requests, bs4, yaml, dotenv, sqlite3, http.server, concurrent.futures, socket,
+# hashlib and colorama are imported inside the functions that use them, and
+# config.yaml / .env are only read by run_cli, so importing this module has no side
+# effects and offline commands (--list-failed, --analyze-trace, --help) start in
+# about interpreter start-up time. See benchmarks/startup_bench.py.
 
 
 # =============================================================================
 # Colour Helpers
 # =============================================================================
+# The ANSI codes colorama's Fore and Style stand for. main() imports colorama only
+# for init(), which makes Windows consoles understand them.
+class Fore:
+    RED = "\033[31m"
+    GREEN = "\033[32m"
+    YELLOW = "\033[33m"
+    MAGENTA = "\033[35m"
+    CYAN = "\033[36m"
+    WHITE = "\033[37m"
+
+
+class Style:
+    BRIGHT = "\033[1m"
+    DIM = "\033[2m"
+    RESET_ALL = "\033[0m"
+
+
 def c_success(text):
     """Green - for successful operations"""
     return f"{Fore.GREEN}{text}{Style.RESET_ALL}"
@@ -72,12 +111,10 @@ def c_dim(text):
 # Configuration Loading
 # =============================================================================
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-CONFIG_FILE = os.path.join(SCRIPT_DIR, "config.yaml")
+# GELBOORU_CONFIG lets benchmarks and test harnesses point at another config file.
+CONFIG_FILE = os.environ.get("GELBOORU_CONFIG") or os.path.join(SCRIPT_DIR, "config.yaml")
 DOTENV_FILE = os.path.join(SCRIPT_DIR, ".env")
 
-# override=False (default) so a real exported env var wins over the .env file.
-load_dotenv(DOTENV_FILE)
-
 # Placeholder values shipped in .env.example; treated as "not set".
 CREDENTIAL_ENV_VARS = {
     "GELBOORU_API_KEY": "your-api-key-here",
@@ -88,53 +125,65 @@ CREDENTIAL_ENV_VARS = {
 
 
 def load_config():
-    """Load configuration from config.yaml file."""
+    """Load configuration from config.yaml file; raises ValueError if it is missing or invalid."""
+    import yaml
+
     if not os.path.exists(CONFIG_FILE):
-        print(f"Error: Configuration file not found: {CONFIG_FILE}")
-        print("Please create a config.yaml file with your tuning settings.")
-        print("See config.yaml.example for reference. (Credentials go in .env - see .env.example.)")
-        sys.exit(1)
+        raise ValueError(
+            f"Configuration file not found: {CONFIG_FILE}\n"
+            "Please create a config.yaml file with your tuning settings.\n"
+            "See config.yaml.example for reference. (Credentials go in .env - see .env.example.)"
+        )
 
     try:
         with open(CONFIG_FILE, "r", encoding="utf-8") as f:
             config = yaml.safe_load(f)
     except yaml.YAMLError as e:
-        print(f"Error: Invalid YAML in configuration file: {e}")
-        sys.exit(1)
+        raise ValueError(f"Invalid YAML in configuration file: {e}") from e
 
     # Check for empty config file
     if config is None:
-        print("Error: Configuration file is empty.")
-        print("Please copy config.yaml.example to config.yaml and fill in your tuning settings.")
-        print("(Credentials go in .env - see .env.example.)")
-        sys.exit(1)
+        raise ValueError(
+            "Configuration file is empty.\n"
+            "Please copy config.yaml.example to config.yaml and fill in your tuning settings.\n"
+            "(Credentials go in .env - see .env.example.)"
+        )
 
     # Validate required sections
     required_sections = ["settings", "cache", "threading", "rate_limiting"]
     for section in required_sections:
         if section not in config:
-            print(f"Error: Missing required section '{section}' in config.yaml")
-            sys.exit(1)
+            raise ValueError(f"Missing required section '{section}' in config.yaml")
 
     return config
 
 
-def load_credentials():
-    """Load and validate the four Gelbooru credentials from the environment."""
+def load_credentials(env=None, source=DOTENV_FILE):
+    """Load and validate the four Gelbooru credentials.
+
+    Reads the process environment (after loading .env into it) by default, or
+    env (e.g. a profile's parsed .env file) when given; source names the file
+    in error messages. Raises ValueError if any of them is missing.
+    """
+    if env is None:
+        from dotenv import load_dotenv
+
+        # override=False (default) so a real exported env var wins over the .env file.
+        load_dotenv(DOTENV_FILE)
+        env = os.environ
     missing = []
     values = {}
     for name, placeholder in CREDENTIAL_ENV_VARS.items():
-        value = (os.getenv(name) or "").strip()
+        value = (env.get(name) or "").strip()
         if not value or value == placeholder:
             missing.append(name)
         values[name] = value
 
     if missing:
-        print(f"Error: Missing Gelbooru credentials in {DOTENV_FILE}")
-        print("Copy .env.example to .env and fill in the following:")
-        for name in missing:
-            print(f"  - {name} is not set in .env")
-        sys.exit(1)
+        env_name = os.path.basename(source)
+        lines = [f"Missing Gelbooru credentials in {source}", f"Copy .env.example to {env_name} and fill in the following:"]
+        lines.extend(f"  - {name} is not set in {env_name}" for name in missing)
+        raise ValueError("\n".join(lines))
 
     return (
         values["GELBOORU_API_KEY"],
@@ -144,292 +193,927 @@ def load_credentials():
     )
 
 
-# Load configuration
-config = load_config()
-API_KEY, USER_ID, USERNAME, PASSWORD = load_credentials()
+def new_rate_stats(min_delay, max_workers):
+    return {
+        "throttle_waits": 0,
+        "throttle_wait_seconds": 0.0,
+        "rate_limit_429s": 0,
+        "cooldown_seconds": 0.0,
+        "retries": 0,
+        "peak_delay_seconds": min_delay,
+        "min_workers": max_workers,
+        "waits_by_endpoint": {"favourites": 0, "detail": 0, "tag": 0, "download": 0},
+        "wait_seconds_by_endpoint": {"favourites": 0.0, "detail": 0.0, "tag": 0.0, "download": 0.0},
+    }
+
 
-# General Settings
-POSTS_PER_PAGE = config["settings"].get("posts_per_page", 50)
-MAX_CONSECUTIVE_EMPTY_PAGES = config["settings"].get("max_consecutive_empty_pages", 10)
-_base_dir = config["settings"].get("base_dir", "")
-BASE_DIR = _base_dir if _base_dir else SCRIPT_DIR
+# Upper bounds of the latency buckets: 1 ms growing by 25% per bucket up to ~2 minutes.
+LATENCY_BUCKETS = tuple(0.001 * 1.25**i for i in range(53))
 
-# Cache Files
-CACHE_FILE = config["cache"].get("tag_cache_file", "tag_cache.json")
-POSTS_CACHE_FILE = config["cache"].get("posts_cache_file", "posts_cache.json")
-FAILED_POSTS_CACHE_FILE = config["cache"].get(
-    "failed_posts_cache_file", "failed_posts_cache.json"
-)
-RATE_LIMITED_POSTS_FILE = config["cache"].get(
-    "rate_limited_posts_file", "rate_limited_posts.json"
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram; recording is one bisect, percentiles are approximate.
+
+    Percentiles report the upper bound of the bucket they fall in, so they are at
+    most 25% high. That is plenty for telling a slow API from a slow CDN.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(LATENCY_BUCKETS[i], self.max) if i < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+METRIC_STAGES = ("scrape", "detail", "tag", "download", "flush")
+
+
+def new_request_metrics():
+    """Per-endpoint request latency/size and per-stage wall time, guarded by stats_lock.
+
+    latency is the whole request; ttfb is until the response headers arrived
+    (requests' response.elapsed) and transfer is the remainder, spent reading the body.
+    """
+    return {
+        "started": time.perf_counter(),
+        "endpoints": {},
+        "stage_seconds": dict.fromkeys(METRIC_STAGES, 0.0),
+        "stage_calls": dict.fromkeys(METRIC_STAGES, 0),
+        "files_downloaded": 0,
+        "outcomes": {},  # POST_OUTCOMES key -> count
+        # Items submitted to a stage's pool and not finished yet
+        "queue_depth": {"detail": 0, "tag": 0, "download": 0},
+    }
+
+
+def timed_stage(stage):
+    """Decorator adding a Downloader method's wall time to its request_metrics["stage_seconds"][stage]"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            wall_started = time.time()
+            started = time.perf_counter()
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self.stats_lock:
+                    self.request_metrics["stage_seconds"][stage] += elapsed
+                    self.request_metrics["stage_calls"][stage] += 1
+                self.trace_event("stage", ts=wall_started, stage=stage, duration=round(elapsed, 4))
+        return wrapper
+    return decorator
+
+
+# Every PROMETHEUS_BUCKET_STRIDE-th latency bucket is exported, so a histogram series is
+# ~20 lines per endpoint rather than 54.
+PROMETHEUS_BUCKET_STRIDE = 3
+
+
+# =============================================================================
+# Profiling (--profile)
+# =============================================================================
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# Downloader locks swapped for ProfiledLock wrappers while --profile is on
+PROFILED_LOCKS = (
+    "api_call_lock", "cache_update_lock", "failed_cache_lock", "file_lock", "workers_lock",
+    "rate_limited_lock", "stats_lock", "_parsed_json_cache_lock", "_tag_type_index_lock",
 )
 
-# Threading and Performance Settings
-MAX_WORKERS = config["threading"].get("max_workers", 4)
-DOWNLOAD_WORKERS = config["threading"].get("download_workers", 3)
-TAG_BATCH_SIZE = config["threading"].get("tag_batch_size", 20)
-
-file_lock = threading.Lock()
-failed_cache_lock = threading.Lock()
-
-# Rate Limiting Settings
-MIN_DELAY = config["rate_limiting"].get("min_delay", 0.25)
-MAX_DELAY = config["rate_limiting"].get("max_delay", 5.0)
-DELAY_INCREASE_FACTOR = config["rate_limiting"].get("delay_increase_factor", 1.5)
-DELAY_DECREASE_FACTOR = config["rate_limiting"].get("delay_decrease_factor", 0.95)
-SUCCESS_THRESHOLD = config["rate_limiting"].get("success_threshold", 15)
-
-# Dynamic concurrency control
-current_max_workers = MAX_WORKERS  # This will be reduced when we hit rate limits
-workers_lock = threading.Lock()
-
-last_api_call_time = 0
-api_call_lock = threading.Lock()
-adaptive_delay = MIN_DELAY  # Start with minimum delay
-successful_requests = 0  # Counter for successful requests
-rate_limited_posts = set()  # Track currently rate-limited posts
-rate_limited_lock = threading.Lock()
-
-# Cache buffers for batch operations
-pending_posts_cache = {}
-pending_tag_cache = {}
-cache_update_lock = threading.Lock()
-
-rate_stats = {
-    "throttle_waits": 0,
-    "throttle_wait_seconds": 0.0,
-    "rate_limit_429s": 0,
-    "cooldown_seconds": 0.0,
-    "retries": 0,
-    "peak_delay_seconds": MIN_DELAY,
-    "min_workers": MAX_WORKERS,
-    "waits_by_endpoint": {"detail": 0, "tag": 0, "download": 0},
-    "wait_seconds_by_endpoint": {"detail": 0.0, "tag": 0.0, "download": 0.0},
+# Innermost matching frame decides the stage a sample is charged to, so a worker
+# inside get_post_details counts as "detail" and the main thread waiting on the
+# pool inside fetch_post_details_parallel does too.
+PROFILE_STAGE_FUNCTIONS = {
+    "get_favorite_post_ids": "scrape",
+    "poll_favourites_first_page": "scrape",
+    "fetch_post_details_parallel": "detail",
+    "get_post_details": "detail",
+    "batch_fetch_tag_details": "tag",
+    "get_tag_details_single": "tag",
+    "download_posts_parallel": "download",
+    "download_next_post": "download",
+    "process_post": "download",
+    "write_files": "write",
+    "flush_cache_buffers": "flush",
+    "login": "login",
 }
-stats_lock = threading.Lock()
 
-# Logging settings
-log_to_file = False  # Will be set to True if -logtofile flag is used
-debug_enabled = False  # Will be set to True if --debug flag is used
 
+class ProfiledLock:
+    """Wraps a lock and records acquisitions, contended waits and hold time.
 
-# Logging functions
-def log_message(message, log_file="log.txt"):
-    print(message)
-    if log_to_file:
-        with open(log_file, "a") as file:
-            file.write(message + "\n")
+    Statistics are updated while the wrapped lock is held, so they need no lock of
+    their own.
+    """
 
+    def __init__(self, name, lock):
+        self.name = name
+        self._lock = lock
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.hold_seconds = 0.0
+        self._acquired_at = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        waited = 0.0
+        if not self._lock.acquire(False):
+            if not blocking:
+                return False
+            started = time.perf_counter()
+            if not self._lock.acquire(True, timeout):
+                return False
+            waited = time.perf_counter() - started
+        if waited:
+            self.contended += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        self.acquisitions += 1
+        self._acquired_at = time.perf_counter()
+        return True
 
-def debug_log(message):
-    """Emit verbose rate-limit telemetry, prefixed with time and thread. Gated on --debug."""
-    if not debug_enabled:
-        return
-    now = time.time()
-    timestamp = time.strftime("%H:%M:%S", time.localtime(now)) + f".{int((now % 1) * 1000):03d}"
-    line = f"[DEBUG {timestamp} {threading.current_thread().name}] {message}"
-    print(c_dim(line), flush=True)
-    if log_to_file:
-        with open("debug_log.txt", "a", encoding="utf-8") as f:
-            f.write(line + "\n")
-
-
-def countdown_sleep(seconds, reason="Waiting", show_done=True):
-    """Sleep with a visible countdown timer so users know the script is still working."""
-    total = int(seconds)
-    if total >= 1:
-        for remaining in range(total, 0, -1):
-            print(f"\r{reason}: {remaining}s remaining...  ", end="", flush=True)
-            time.sleep(1)
-        # Clear the countdown line
-        if show_done:
-            print(f"\r{reason}: Done.{' ' * 20}")
-        else:
-            print(f"\r{' ' * 60}\r", end="", flush=True)
-    # Sleep any fractional remainder (or full time if < 1 second)
-    remainder = seconds - total if total >= 1 else seconds
-    if remainder > 0:
-        time.sleep(remainder)
+    def release(self):
+        self.hold_seconds += time.perf_counter() - self._acquired_at
+        self._lock.release()
 
+    def locked(self):
+        return self._lock.locked()
 
-# Login function
-def login():
-    LOGIN_SUCCESS_MARKER = ">Logout</a>"
-    session = requests.Session()
-    login_url = "https://gelbooru.com/index.php?page=account&s=login&code=00"
-    login_data = {"user": USERNAME, "pass": PASSWORD, "submit": "Log in"}
+    def __enter__(self):
+        return self.acquire()
 
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def _thread_cpu_seconds(ident):
+    """CPU time of another thread (POSIX only); None where the platform can't tell"""
     try:
-        response = session.post(login_url, data=login_data, timeout=30)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(c_error(f"Could not reach Gelbooru to log in: {e}"))
-        sys.exit(1)
-
-    if LOGIN_SUCCESS_MARKER not in response.text:
-        log_message(f"Login response (first 200 chars): {response.text[:200]}")
-        print(c_error(
-            "Login failed: check GELBOORU_USERNAME / GELBOORU_PASSWORD in .env"
-        ))
-        sys.exit(1)
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
 
-    return session
 
+class SamplingProfiler:
+    """Samples every thread's stack every PROFILE_SAMPLE_INTERVAL seconds.
 
-# Functions related to fetching post data
+    Each sample is charged to a stage (see PROFILE_STAGE_FUNCTIONS) along with the
+    CPU time the thread used since its previous sample. The samples are kept as
+    folded stacks for flamegraph.pl / speedscope.
+    """
 
-# Distinct from an empty list (end of favourites) so a failed fetch is not treated as the end.
-FETCH_FAILED = object()
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.folded = {}  # "stage;file:func;..." -> samples
+        self.self_samples = {}  # innermost "file:func" -> samples
+        self.stage_samples = {}
+        self.stage_cpu = {}
+        self.last_cpu = {}
+        self.locks = []
+        self.started = None
+        self.wall = 0.0
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self, engine):
+        self.engine = engine
+        for name in PROFILED_LOCKS:
+            lock = ProfiledLock(name, getattr(engine, name))
+            setattr(engine, name, lock)
+            self.locks.append(lock)
+        self.started = time.perf_counter()
+        self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.thread.join()
+        self.wall = time.perf_counter() - self.started
+        for lock in self.locks:
+            setattr(self.engine, lock.name, lock._lock)
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            threads = {t.ident: t for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                thread = threads.get(ident)
+                if ident != own and thread is not None:
+                    self._sample(thread, frame)
+
+    def _sample(self, thread, frame):
+        stack = []
+        stage = None
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+            if stage is None and code.co_name in PROFILE_STAGE_FUNCTIONS:
+                stage = PROFILE_STAGE_FUNCTIONS[code.co_name]
+            frame = frame.f_back
+        if stage is None:
+            # Pool workers between tasks, writer threads, the metrics server...
+            if thread.name.startswith("ThreadPoolExecutor"):
+                stage = "idle"
+            else:
+                stage = "other:" + "".join(c for c in thread.name if not c.isdigit()).replace("-", "")
+
+        cpu = _thread_cpu_seconds(thread.ident)
+        if cpu is not None:
+            # Keyed by native id too: idents are reused once a thread exits.
+            key = (thread.ident, thread.native_id)
+            previous = self.last_cpu.get(key)
+            self.last_cpu[key] = cpu
+            if previous is not None and cpu >= previous:
+                self.stage_cpu[stage] = self.stage_cpu.get(stage, 0.0) + cpu - previous
+
+        key = ";".join([stage] + stack[::-1])
+        self.folded[key] = self.folded.get(key, 0) + 1
+        self.self_samples[stack[0]] = self.self_samples.get(stack[0], 0) + 1
+        self.stage_samples[stage] = self.stage_samples.get(stage, 0) + 1
+
+    def report(self):
+        lines = [f"Profile: {self.wall:.1f}s wall, one sample per thread every {self.interval * 1000:.0f} ms", ""]
+        lines.append("Per stage (thread-seconds sampled, CPU seconds used)")
+        for stage, samples in sorted(self.stage_samples.items(), key=lambda item: -item[1])[:12]:
+            cpu = self.stage_cpu.get(stage)
+            cpu_str = f"{cpu:8.2f}s CPU" if cpu is not None else "     n/a CPU"
+            lines.append(f"  {stage[:34]:<34s} {samples * self.interval:8.2f}s sampled {cpu_str}")
+
+        lines.append("")
+        lines.append("Hottest functions (samples with the function on top of the stack)")
+        total = sum(self.self_samples.values()) or 1
+        for func, samples in sorted(self.self_samples.items(), key=lambda item: -item[1])[:15]:
+            lines.append(f"  {samples / total * 100:5.1f}%  {func}")
+
+        lines.append("")
+        lines.append("Locks              acquisitions  contended   wait total   wait max   held total")
+        for lock in sorted(self.locks, key=lambda lock: -lock.wait_seconds):
+            if lock.acquisitions:
+                lines.append(
+                    f"  {lock.name:<24s} {lock.acquisitions:>8d} {lock.contended:>9d} "
+                    f"{lock.wait_seconds:>10.3f}s {lock.max_wait_seconds * 1000:>8.1f}ms {lock.hold_seconds:>10.3f}s"
+                )
+        return "\n".join(lines)
 
-# Distinct from a fetch failure so a deleted post is not reported as an error.
-POST_MISSING = object()
+    def write(self, prefix):
+        with open(f"{prefix}.folded", "w", encoding="utf-8") as f:
+            for stack, samples in sorted(self.folded.items()):
+                f.write(f"{stack} {samples}\n")
+        report = self.report()
+        with open(f"{prefix}.txt", "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+        return report
 
 
-def get_favorite_post_ids(session, pid):
-    """Scrape one page of favourite post ids starting at offset pid.
+class SystemClock:
+    """Wall-clock time source for the rate-limit controller and retry backoff.
 
-    Returns a list of post id strings (empty when the page is past the last
-    favourite), or the FETCH_FAILED sentinel if the page could not be retrieved
-    after all retries. The empty-list and FETCH_FAILED cases are kept distinct so
-    a transient failure is not mistaken for the end of the favourites.
+    benchmarks/ratelimit_sim.py swaps in a virtual clock (anything with the same
+    time() and sleep() methods) to replay hours of traffic in seconds.
     """
-    url = f"https://gelbooru.com/index.php?page=favorites&s=view&id={USER_ID}&pid={pid}"
-    max_retries = 5
-    base_delay = 5
 
-    for i in range(max_retries):
-        try:
-            response = session.get(url, timeout=30)
-            if response.status_code == 429:
-                handle_rate_limit_response()
-                raise requests.exceptions.RequestException("Too Many Requests")
+    def time(self):
+        return time.time()
 
-            response.raise_for_status()
+    def sleep(self, seconds):
+        time.sleep(seconds)
 
-            soup = BeautifulSoup(response.text, "html.parser")
-            post_spans = soup.find_all("span", class_="thumb")
-            post_ids = [span.find("a")["href"].split("=")[-1] for span in post_spans]
-            reset_adaptive_delay()
-            debug_log(f"[favourites pid={pid}] fetched {len(post_ids)} post ids on attempt {i + 1}")
-            if i > 0:
-                log_message(
-                    f"Successfully retrieved favourite page pid={pid} after {i + 1} attempts"
-                )
-            return post_ids
 
-        except requests.exceptions.RequestException as e:
-            if "Too Many Requests" in str(e):
-                handle_rate_limit_response()
-
-            if i < max_retries - 1:
-                delay = base_delay * (2**i)
-                with stats_lock:
-                    rate_stats["retries"] += 1
-                debug_log(f"[favourites pid={pid}] retry {i + 1}/{max_retries} in {delay}s: {str(e)[:60]}")
-                log_message(
-                    f"Favourite page pid={pid}: {e!s}. Retrying after {delay}s (attempt {i + 1}/{max_retries})"
-                )
-                countdown_sleep(delay, f"Retry backoff for favourite page pid={pid}")
-            else:
-                debug_log(f"[favourites pid={pid}] gave up after {max_retries} attempts: {str(e)[:60]}")
-                log_message(
-                    f"Failed to get favourite page pid={pid} after {max_retries} attempts: {e!s}"
-                )
-                return FETCH_FAILED
+class DownloadQueue:
+    """Hands posts to download workers so small files keep finishing while large ones transfer.
+
+    Small files go smallest first. Files estimated at large_file_bytes or more go
+    largest first, to at most large_slots workers at a time, so they start early
+    (the page is not left waiting on one video at the end) without ever holding
+    every worker. Once no small files are left, any free worker takes a large one.
+    """
+
+    def __init__(self, posts, large_file_bytes, large_slots):
+        sized = sorted(((estimated_download_bytes(post), post) for post in posts), key=lambda item: item[0])
+        self.small = collections.deque(post for size, post in sized if size < large_file_bytes)
+        self.large = collections.deque(post for size, post in reversed(sized) if size >= large_file_bytes)
+        self.large_slots = max(0, large_slots)
+        self.large_running = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Return (post, is_large) for the next download, or (None, False) when none are left"""
+        with self.lock:
+            if self.large and (self.large_running < self.large_slots or not self.small):
+                self.large_running += 1
+                return self.large.popleft(), True
+            if self.small:
+                return self.small.popleft(), False
+            return None, False
+
+    def done(self, large):
+        if large:
+            with self.lock:
+                self.large_running -= 1
+
+    def remaining(self):
+        """Posts not handed out yet"""
+        with self.lock:
+            return list(self.small) + list(self.large)
+
+
+class TokenBucket:
+    """Byte-rate limiter shared by the download workers (rate_limiting.max_download_bytes_per_second).
+
+    consume(n) takes n tokens straight away, going into debt if the bucket is short,
+    and then sleeps until the debt would be paid off at rate tokens a second. Taking
+    before sleeping keeps concurrent callers in line: each waits behind the bytes
+    already promised to the others. The bucket holds at most burst tokens (one
+    second's worth by default).
+    """
+
+    def __init__(self, rate, burst=None, clock=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.clock = clock or SystemClock()
+        self.tokens = self.burst
+        self.updated = self.clock.time()
+        self.lock = threading.Lock()
+        self.wait_seconds = 0.0  # Total sleep handed out, for the run summary
+
+    def consume(self, amount):
+        """Take amount tokens and sleep off any debt; returns the seconds slept"""
+        with self.lock:
+            now = self.clock.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.wait_seconds += wait
+        if wait > 0:
+            self.clock.sleep(wait)
+        return wait
+
+
+class CappedResponse:
+    """A streamed requests.Response whose body was read through a TokenBucket.
+
+    content is the body read under the cap; everything else (status_code,
+    headers, elapsed, raise_for_status, ...) comes from the wrapped response.
+    """
+
+    def __init__(self, response, content):
+        self.response = response
+        self.content = content
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
 
-    # Defensive: only reachable if max_retries ever becomes 0 or negative.
-    return FETCH_FAILED
+class BufferedLineWriter:
+    """Appends lines to a file from a background thread, one write per burst of lines.
 
+    Callers only pay for a queue put, so per-request logging doesn't open the file
+    or wait on disk. close() drains whatever is still queued.
+    """
+
+    _CLOSE = object()
+
+    def __init__(self, path):
+        self.path = path
+        self.lines = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name=f"writer-{os.path.basename(path)}", daemon=True)
+        self.thread.start()
+
+    def write(self, line):
+        self.lines.put(line)
+
+    def _run(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                batch = [self.lines.get()]
+                while True:
+                    try:
+                        batch.append(self.lines.get_nowait())
+                    except queue.Empty:
+                        break
+                closing = batch[-1] is self._CLOSE
+                if closing:
+                    batch.pop()
+                if batch:
+                    f.write("\n".join(batch) + "\n")
+                    f.flush()
+                if closing:
+                    return
+
+    def close(self):
+        self.lines.put(self._CLOSE)
+        self.thread.join(timeout=5)
+
+
+# path -> BufferedLineWriter for log.txt / debug_log.txt (-logtofile). Per file rather
+# than per Downloader, so engines sharing a process append to one writer.
+_log_file_writers = {}
+_log_writers_lock = threading.Lock()
+
+
+def log_file_writer(path):
+    writer = _log_file_writers.get(path)
+    if writer is None:
+        with _log_writers_lock:
+            writer = _log_file_writers.get(path)
+            if writer is None:
+                writer = _log_file_writers[path] = BufferedLineWriter(path)
+    return writer
+
+
+def close_log_writers():
+    """Flush and close the log file writers; safe to call more than once"""
+    with _log_writers_lock:
+        writers = list(_log_file_writers.values())
+        _log_file_writers.clear()
+    for writer in writers:
+        writer.close()
+
+
+atexit.register(close_log_writers)
+
+
+# Change manifest (cache.manifest_file): one JSON line per file a run writes, links,
+# finds already on disk, moves (--reshard) or fails to download, so indexing and
+# backup jobs can pick up what changed without rescanning base_dir.
+MANIFEST_EVENTS = ("written", "linked", "on_disk", "moved", "failed")
+
+
+def read_manifest(path, cursor=0):
+    """Yield (cursor, entry) for each manifest line after byte offset cursor.
+
+    The cursor yielded with an entry is the offset just past it, so a consumer
+    that stores the last one it handled resumes from there next time. A line
+    still being written (no newline yet) is left for the next read. Raises
+    ValueError if cursor is not the start of a line, e.g. after the file was
+    rotated.
+    """
+    if not os.path.exists(path):
+        if cursor:
+            raise ValueError(f"cursor {cursor} is past the end of {path}, which does not exist")
+        return
+    with open(path, "rb") as f:
+        if cursor:
+            f.seek(cursor - 1)
+            if f.read(1) != b"\n":
+                raise ValueError(f"cursor {cursor} is not the start of an entry in {path} (was it rotated?)")
+        for line in f:
+            if not line.endswith(b"\n"):
+                return
+            cursor += len(line)
+            try:
+                entry = json.loads(line)
+            except json.decoder.JSONDecodeError:
+                continue  # A torn line from a killed run
+            yield cursor, entry
+
+
+def fsync_directory(directory):
+    """fsync a directory so renames into it survive a crash; False where unsupported (Windows)"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        os.fsync(fd)
+        return True
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
 
-def get_post_details(post_id):
-    """Fetch a post's details from the API.
 
-    Returns the string "SKIP" if the post is already in the posts cache, a
-    single-element list holding the post dict on success, the POST_MISSING
-    sentinel if the API no longer returns the post (deleted or hidden), or None
-    if it could not be fetched after all retries. POST_MISSING and None are kept
-    distinct so a deleted favourite is not counted as a fetch failure.
+class DiskWriter:
+    """Bounded pool of threads that write downloaded files, so network workers never wait on disk.
+
+    submit() hands over a downloaded body and returns at once unless queue_size
+    files are already waiting, in which case the downloader blocks until a writer
+    catches up. A slow disk therefore throttles downloads through this queue instead
+    of holding network slots and looking like a slow server to the adaptive
+    controller. Files are written as <path>.part and renamed once complete.
+
+    With fsync_batch > 0 a writer keeps up to fsync_batch written files open, then
+    fsyncs them, renames them into place and fsyncs each directory it touched once,
+    before reporting them done. A partial batch is committed as soon as the queue
+    runs dry, so drain() never waits for a batch to fill.
     """
-    posts_cache = load_posts_cache()
 
-    if post_id in posts_cache:
-        return "SKIP"
+    _CLOSE = object()
+
+    def __init__(self, workers=2, queue_size=16, fsync_batch=0):
+        self.fsync_batch = fsync_batch
+        self.jobs = queue.Queue(maxsize=max(1, queue_size))
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            "files": 0, "bytes": 0, "errors": 0, "write_seconds": 0.0, "fsyncs": 0,
+            # Submits that found the queue full, and how long downloaders waited on them
+            "blocked_submits": 0, "blocked_seconds": 0.0,
+        }
+        # Directories already known to exist, so makedirs runs once per directory
+        self.created_dirs = set()
+        self.created_dirs_lock = threading.Lock()
+        # .part files being written; see remove_partial_files
+        self.partial_files = set()
+        self.partial_files_lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self.write_files, name=f"disk-writer-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self.threads:
+            thread.start()
 
-    rate_limit_api_call("detail")
-    url = f"https://gelbooru.com/index.php?page=dapi&s=post&q=index&id={post_id}&json=1&api_key={API_KEY}&user_id={USER_ID}"
-    max_retries = 5
-    base_delay = 5  # Increased base delay for rate limiting
+    def submit(self, path, data, done):
+        """Queue data to be written to path; done(error) runs on a writer thread afterwards.
 
-    for i in range(max_retries):
+        error is None once the file is in place, or the OSError that stopped it.
+        """
+        job = (path, data, done)
         try:
-            response = requests.get(url, timeout=30)
-            if response.status_code == 429:
-                handle_rate_limit_response()
-                add_rate_limited_post(post_id)  # Track rate-limited post
-                raise requests.exceptions.RequestException("Too Many Requests")
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            started = time.perf_counter()
+            self.jobs.put(job)
+            with self.stats_lock:
+                self.stats["blocked_submits"] += 1
+                self.stats["blocked_seconds"] += time.perf_counter() - started
+
+    def ensure_dir(self, directory):
+        if directory in self.created_dirs:
+            return
+        os.makedirs(directory, exist_ok=True)
+        with self.created_dirs_lock:
+            self.created_dirs.add(directory)
+
+    def drain(self):
+        """Wait until every submitted file is written (or has failed) and reported"""
+        self.jobs.join()
+
+    def close(self):
+        """Write what is still queued, then stop the threads; safe to call twice"""
+        for thread in self.threads:
+            if thread.is_alive():
+                self.jobs.put(self._CLOSE)
+        for thread in self.threads:
+            thread.join(timeout=30)
+
+    def remove_partial_files(self):
+        """Delete the .part files of writes still in progress; returns how many"""
+        with self.partial_files_lock:
+            paths = list(self.partial_files)
+            self.partial_files.clear()
+        removed = 0
+        for path in paths:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def snapshot(self):
+        with self.stats_lock:
+            snapshot = dict(self.stats)
+        snapshot["queued"] = self.jobs.qsize()
+        snapshot["workers"] = len(self.threads)
+        return snapshot
+
+    def write_files(self):
+        pending = []  # (open file, part path, path, done) waiting to be committed
+        while True:
+            try:
+                job = self.jobs.get(block=not pending)
+            except queue.Empty:
+                self.commit(pending)
+                pending = []
+                continue
+            if job is self._CLOSE:
+                self.commit(pending)
+                self.jobs.task_done()
+                return
+
+            path, data, done = job
+            part_path = path + ".part"
+            started = time.perf_counter()
+            try:
+                self.ensure_dir(os.path.dirname(path))
+                with self.partial_files_lock:
+                    self.partial_files.add(part_path)
+                f = open(part_path, "wb")
+                try:
+                    f.write(data)
+                except OSError:
+                    f.close()
+                    raise
+            except OSError as e:
+                self.finish(part_path, done, e)
+                continue
+            with self.stats_lock:
+                self.stats["bytes"] += len(data)
+                self.stats["write_seconds"] += time.perf_counter() - started
+            pending.append((f, part_path, path, done))
+            if len(pending) >= max(1, self.fsync_batch):
+                self.commit(pending)
+                pending = []
+
+    def commit(self, pending):
+        """Close (and with fsync_batch, fsync) written files and rename them into place"""
+        if not pending:
+            return
+        started = time.perf_counter()
+        results = []
+        directories = set()
+        for f, part_path, path, done in pending:
+            try:
+                if self.fsync_batch:
+                    f.flush()
+                    os.fsync(f.fileno())
+                f.close()
+                os.replace(part_path, path)
+                directories.add(os.path.dirname(path))
+                results.append((part_path, done, None))
+            except OSError as e:
+                f.close()
+                results.append((part_path, done, e))
+        fsyncs = 0
+        if self.fsync_batch:
+            fsyncs = len(pending) + sum(fsync_directory(directory) for directory in directories)
+        with self.stats_lock:
+            self.stats["write_seconds"] += time.perf_counter() - started
+            self.stats["fsyncs"] += fsyncs
+        for part_path, done, error in results:
+            self.finish(part_path, done, error)
+
+    def finish(self, part_path, done, error):
+        with self.partial_files_lock:
+            self.partial_files.discard(part_path)
+        if error is not None:
+            try:
+                os.remove(part_path)
+            except OSError:
+                pass
+        with self.stats_lock:
+            self.stats["errors" if error is not None else "files"] += 1
+        try:
+            done(error)
+        except Exception as e:
+            print(c_error(f"Error recording written file: {e!s}"))
+        finally:
+            self.jobs.task_done()
 
-            response.raise_for_status()
 
-            data = json.loads(response.text)
-            if "post" in data:
-                post = data["post"]
-                reset_adaptive_delay()  # Success, so we can reduce delay if it was increased
-                if i > 0:  # If this was a retry attempt
-                    log_message(
-                        f"Successfully retrieved post {post_id} after {i+1} attempts"
-                    )
-                remove_rate_limited_post(post_id)  # Remove from tracking if successful
-                return post if isinstance(post, list) else [post]
-            else:
-                reset_adaptive_delay()  # Success, so we can reduce delay if it was increased
-                remove_rate_limited_post(
-                    post_id
-                )  # Remove from tracking if request completed
-                debug_log(f"post {post_id} is no longer returned by the API (deleted or hidden)")
-                return POST_MISSING
+# Terminal redraws per second for progress lines, and seconds between plain-text
+# progress lines when stdout is not a terminal (piped, redirected to a file).
+PROGRESS_FPS = 10
+PLAIN_PROGRESS_INTERVAL = 5.0
+_ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
 
-        except requests.exceptions.RequestException as e:
-            if "Too Many Requests" in str(e):
-                handle_rate_limit_response()
-                add_rate_limited_post(post_id)  # Track rate-limited post
-                log_message(
-                    f"Rate limit hit for post {post_id:<8} - Attempt {i + 1}/{max_retries}"
-                )
 
-            if i < max_retries - 1:
-                delay = base_delay * (2**i)  # Exponential backoff
-                with stats_lock:
-                    rate_stats["retries"] += 1
-                debug_log(f"[post {post_id}] retry {i + 1}/{max_retries} in {delay}s: {str(e)[:60]}")
-                log_message(
-                    f"Post {post_id:<8}: {e!s}. Retrying after {delay}s (attempt {i + 1}/{max_retries})"
-                )
-                countdown_sleep(delay, f"Retry backoff for post {post_id}")
-            else:
-                log_message(
-                    f"Failed to get post {post_id:<8} after {max_retries} attempts: {e!s}"
-                )
-                # Save the post ID to the cache when it exceeds max retries
-                with failed_cache_lock:
-                    failed_posts_cache = load_failed_posts_cache()
-                    failed_posts_cache[str(post_id)] = {"error": str(e)[:100], "type": "api"}
-                    save_failed_posts_cache(failed_posts_cache)
-                remove_rate_limited_post(
-                    post_id
-                )  # Remove from tracking after max retries
-                return None
+class ConsoleOutput:
+    """Stand-in for sys.stdout that hands all writes to one output thread.
 
+    Worker threads only pay for a queue put. The thread writes whatever has
+    queued up in one go, and redraws the progress line (every set_progress slot
+    joined with " | ") at most PROGRESS_FPS times a second. When stdout is not a
+    terminal, progress is printed as a plain line every PLAIN_PROGRESS_INTERVAL
+    seconds instead of being redrawn with carriage returns.
+    """
 
-# Functions related to downloading and saving images
-# Global session for connection pooling
-download_session = requests.Session()
-download_session.headers.update(
-    {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-        # The image host's hotlink protection serves the HTML post page, not the bytes, without this.
-        "Referer": "https://gelbooru.com/",
-    }
-)
+    def __init__(self, stream):
+        self.stream = stream
+        try:
+            self.is_tty = stream.isatty()
+        except (AttributeError, ValueError):
+            self.is_tty = False
+        self.items = queue.SimpleQueue()
+        self.progress = {}  # slot -> text; only touched by the output thread
+        self.shown = False  # a progress line is on screen and must be cleared first
+        self.dirty = False
+        self.last_draw = 0.0
+        self.last_plain = ""
+        self.last_plain_at = 0.0
+        self.thread = threading.Thread(target=self._run, name="console", daemon=True)
+        self.thread.start()
+
+    # File-like interface used by print()
+    def write(self, text):
+        if text:
+            self.items.put(("text", text))
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return self.is_tty
+
+    @property
+    def encoding(self):
+        return getattr(self.stream, "encoding", "utf-8")
+
+    def set_progress(self, slot, text):
+        self.items.put(("progress", slot, text))
+
+    def clear_progress(self, slot, final=None):
+        self.items.put(("clear", slot, final))
+
+    def close(self):
+        self.items.put(("close",))
+        self.thread.join(timeout=5)
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self.dirty:
+                timeout = max(0.0, self.last_draw + 1 / PROGRESS_FPS - time.monotonic())
+            try:
+                batch = [self.items.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+            while True:
+                try:
+                    batch.append(self.items.get_nowait())
+                except queue.Empty:
+                    break
+
+            text = []
+            closing = False
+            for item in batch:
+                if item[0] == "text":
+                    text.append(item[1])
+                elif item[0] == "progress":
+                    self.progress[item[1]] = item[2]
+                    self.dirty = True
+                elif item[0] == "clear":
+                    self.progress.pop(item[1], None)
+                    if item[2] is not None:
+                        text.append(item[2] + "\n")
+                    self.dirty = True
+                else:
+                    closing = True
+
+            try:
+                self._write(text, closing)
+            except BrokenPipeError:
+                # The reader went away (e.g. `--changes | head`); drop the rest of the output.
+                self.stream = open(os.devnull, "w")
+            if closing:
+                return
+
+    def _write(self, text, closing):
+        if text:
+            if self.shown:
+                self.stream.write("\r\x1b[K")
+                self.shown = False
+                self.dirty = True
+            self.stream.write("".join(text))
+        if self.dirty and (closing or time.monotonic() - self.last_draw >= 1 / PROGRESS_FPS):
+            self._draw()
+        self.stream.flush()
+        if closing and self.shown:
+            self.stream.write("\n")
+            self.stream.flush()
+
+    def _draw(self):
+        line = " | ".join(self.progress.values())
+        self.dirty = False
+        self.last_draw = time.monotonic()
+        if self.is_tty:
+            self.stream.write("\r\x1b[K" + line)
+            self.shown = bool(line)
+            return
+        plain = _ANSI_ESCAPE.sub("", line).rstrip()
+        if plain and plain != self.last_plain and self.last_draw - self.last_plain_at >= PLAIN_PROGRESS_INTERVAL:
+            self.stream.write(plain + "\n")
+            self.last_plain = plain
+            self.last_plain_at = self.last_draw
+
+
+console = None  # ConsoleOutput installed over sys.stdout by main()
+
+
+def start_console():
+    global console
+    console = ConsoleOutput(sys.stdout)
+    sys.stdout = console
+
+
+def stop_console():
+    """Drain queued output and put the real stdout back; no-op if not installed"""
+    global console
+    if console is None:
+        return
+    active, console = console, None
+    active.close()
+    if sys.stdout is active:
+        sys.stdout = active.stream
+
+
+def set_progress(slot, text):
+    """Show text in the progress line under slot (one slot per bar or countdown)"""
+    if console is not None:
+        console.set_progress(slot, text)
+    else:
+        print(f"\r{text}  ", end="", flush=True)
+
+
+def clear_progress(slot, final=None):
+    """Remove slot from the progress line, printing final as a normal line if given"""
+    if console is not None:
+        console.clear_progress(slot, final)
+    else:
+        print(f"\r{final}" if final is not None else f"\r{' ' * 60}\r", end="\n" if final is not None else "", flush=True)
+
+
+# Functions related to fetching post data
+
+# Distinct from an empty list (end of favourites) so a failed fetch is not treated as the end.
+FETCH_FAILED = object()
+
+# Distinct from a fetch failure so a deleted post is not reported as an error.
+POST_MISSING = object()
+
+# A 429 during the priority pass: the post stays queued as rate-limited, not failed.
+POST_DEFERRED = object()
+
+
+def parse_favourite_thumbnails(page_html):
+    """Return (post id, thumbnail title) for each thumbnail on a favourites page.
+
+    The title is the post's tags followed by score:N and rating:R, or "" if the
+    thumbnail has none; parse_thumbnail_title() splits it up.
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(page_html, "html.parser")
+    thumbnails = []
+    for span in soup.find_all("span", class_="thumb"):
+        img = span.find("img")
+        title = img.get("title", "") if img is not None else ""
+        thumbnails.append((span.find("a")["href"].split("=")[-1], title))
+    return thumbnails
+
+
+def parse_thumbnail_title(title):
+    """The tags, score and rating a favourites thumbnail title gives, shaped like post JSON.
+
+    Fields the title doesn't carry are left out, so PostFilter leaves their rules alone.
+    """
+    tags = []
+    fields = {}
+    for token in title.split():
+        key, _, value = token.partition(":")
+        if key == "score" and value.lstrip("-").isdigit():
+            fields["score"] = int(value)
+        elif key == "rating" and value:
+            fields["rating"] = value.lower()
+        else:
+            tags.append(token)
+    fields["tags"] = " ".join(tags)
+    return fields
+
+
+def _url_host(url):
+    """netloc of an absolute URL; a cheap stand-in for urlparse(url).netloc on the hot path"""
+    scheme_sep = url.find("://")
+    if scheme_sep < 0:
+        return urlparse(url).netloc
+    rest = url[scheme_sep + 3:]
+    end = len(rest)
+    for sep in "/?#":
+        pos = rest.find(sep)
+        if 0 <= pos < end:
+            end = pos
+    return rest[:end]
 
 
 def resolve_download_url(post) -> tuple[str, str]:
@@ -442,55 +1126,139 @@ def resolve_download_url(post) -> tuple[str, str]:
     directory = post.get("directory")
     image = post.get("image")
     if preview_url and directory and image:
-        preview_host = urlparse(preview_url).netloc
-        if preview_host and urlparse(file_url).netloc != preview_host:
+        preview_host = _url_host(preview_url)
+        if preview_host and _url_host(file_url) != preview_host:
             return f"https://{preview_host}/images/{directory}/{image}", image
     return file_url, file_url.split("/")[-1]
 
 
-def is_retryable_download_error(error: Exception) -> bool:
-    """Transport faults and 5xx are worth retrying. A 4xx such as a 404 video-cdn URL is terminal."""
-    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
-        return True
-    response = getattr(error, "response", None)
-    return response is not None and 500 <= response.status_code < 600
+# The API gives dimensions but no file size, so downloads are ordered by a rough
+# estimate; only the ordering matters. Videos are far larger than an image of the
+# same dimensions.
+ESTIMATED_BYTES_PER_PIXEL = 0.5
+VIDEO_EXTENSIONS = (".mp4", ".webm", ".mkv", ".mov")
+VIDEO_SIZE_FACTOR = 20
+DEFAULT_PIXELS = 1920 * 1080
 
+# Image bodies are read in chunks of this size when the bandwidth cap is on
+DOWNLOAD_CHUNK_BYTES = 64 * 1024
 
-def download_image(url, file_path):
-    max_retries = 3
-    base_delay = 2
 
-    for attempt in range(max_retries):
-        rate_limit_api_call("download")
-        try:
-            response = download_session.get(url, timeout=30)
+def estimated_download_bytes(post):
+    """Rough size of a post's file, from its file_size if the API gave one, else its dimensions"""
+    if post.get("file_size"):
+        return int(post["file_size"])
+    try:
+        pixels = int(post.get("width") or 0) * int(post.get("height") or 0)
+    except (TypeError, ValueError):
+        pixels = 0
+    estimate = (pixels or DEFAULT_PIXELS) * ESTIMATED_BYTES_PER_PIXEL
+    name = (post.get("image") or post.get("file_url") or "").lower()
+    if name.endswith(VIDEO_EXTENSIONS):
+        estimate *= VIDEO_SIZE_FACTOR
+    return int(estimate)
+
+
+def _filter_values(values, strip=""):
+    """Lower-cased set of a filter list from config.yaml; a single string counts as one entry"""
+    if isinstance(values, str):
+        values = [values]
+    return frozenset(html.unescape(str(value)).strip().lstrip(strip).lower() for value in values or ())
+
+
+class PostFilter:
+    """The filters section of config.yaml, compiled for quick per-post checks.
+
+    skip_reason() takes whatever is known about a post so far: the fields
+    parse_thumbnail_title() gets from the favourites page (tags, score, rating)
+    before any detail request, then the post JSON before its tags are resolved.
+    A rule is only applied once its field is known, so a post is never skipped on
+    a guess. Tags are compared unescaped and case-insensitively.
+    """
 
-            # Check 429 before raise_for_status so it routes to backoff, not a generic HTTPError.
-            if response.status_code == 429:
-                handle_rate_limit_response()
-                if attempt < max_retries - 1:
-                    with stats_lock:
-                        rate_stats["retries"] += 1
-                    continue
+    def __init__(self, config=None):
+        config = config or {}
+        self.ratings = _filter_values(config.get("ratings"))
+        self.exclude_ratings = _filter_values(config.get("exclude_ratings"))
+        self.include_tags = _filter_values(config.get("include_tags"))
+        self.exclude_tags = _filter_values(config.get("exclude_tags"))
+        self.file_types = _filter_values(config.get("file_types"), strip=".")
+        self.exclude_file_types = _filter_values(config.get("exclude_file_types"), strip=".")
+        self.min_score = config.get("min_score")
+        self.max_file_bytes = config.get("max_file_bytes")
+        self.active = any((
+            self.ratings, self.exclude_ratings, self.include_tags, self.exclude_tags,
+            self.file_types, self.exclude_file_types,
+            self.min_score is not None, self.max_file_bytes is not None,
+        ))
+        self.fingerprint = self._fingerprint()
 
-            response.raise_for_status()
-        except Exception as e:
-            if attempt < max_retries - 1 and is_retryable_download_error(e):
-                delay = base_delay * (2**attempt)
-                with stats_lock:
-                    rate_stats["retries"] += 1
-                debug_log(
-                    f"download retry {attempt + 1}/{max_retries} in {delay}s: {str(e)[:60]}"
-                )
-                # Silent sleep, not countdown_sleep: this runs on a worker thread under the progress bar.
-                time.sleep(delay)
-                continue
-            raise Exception(f"Error downloading image: {e!s}") from e
+    def _fingerprint(self):
+        """Short digest of the rules, so a record of the posts they skipped expires with them"""
+        import hashlib
 
-        with open(file_path, "wb") as f:
-            f.write(response.content)
-        reset_adaptive_delay()
-        return
+        rules = [
+            sorted(self.ratings), sorted(self.exclude_ratings), sorted(self.include_tags), sorted(self.exclude_tags),
+            sorted(self.file_types), sorted(self.exclude_file_types), self.min_score, self.max_file_bytes,
+        ]
+        return hashlib.sha1(json.dumps(rules).encode("utf-8")).hexdigest()[:16]
+
+    def skip_reason(self, post):
+        """Why post should be skipped (a short description), or None to keep it"""
+        rating = post.get("rating")
+        if rating:
+            rating = rating.lower()
+            if self.ratings and rating not in self.ratings:
+                return f"rating {rating}"
+            if rating in self.exclude_ratings:
+                return f"rating {rating}"
+
+        if "score" in post and self.min_score is not None:
+            try:
+                score = int(post["score"])
+            except (TypeError, ValueError):
+                score = None
+            if score is not None and score < self.min_score:
+                return f"score {score}"
+
+        if (self.include_tags or self.exclude_tags) and "tags" in post:
+            tags = post["tags"]
+            tags = {html.unescape(tag).lower() if "&" in tag else tag.lower() for tag in tags.split()}
+            missing = self.include_tags - tags
+            if missing:
+                return f"missing tag {min(missing)}"
+            excluded = self.exclude_tags & tags
+            if excluded:
+                return f"tag {min(excluded)}"
+
+        name = post.get("image") or post.get("file_url")
+        if name and (self.file_types or self.exclude_file_types):
+            extension = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+            if self.file_types and extension not in self.file_types:
+                return f"file type {extension or '(none)'}"
+            if extension in self.exclude_file_types:
+                return f"file type {extension}"
+
+        if self.max_file_bytes is not None and (post.get("file_size") or (post.get("width") and post.get("height"))):
+            size = estimated_download_bytes(post)
+            if size > self.max_file_bytes:
+                return f"~{size / 1_000_000:.1f} MB"
+        return None
+
+
+def is_retryable_download_error(error: Exception) -> bool:
+    """Transport faults, bodies cut off mid-read and 5xx are worth retrying.
+
+    A 4xx such as a 404 video-cdn URL is terminal, as is an HTML page served in
+    place of the image.
+    """
+    import requests
+
+    retryable = (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError)
+    if isinstance(error, retryable):
+        return True
+    response = getattr(error, "response", None)
+    return response is not None and 500 <= response.status_code < 600
 
 
 def sanitize_for_path(name):
@@ -504,170 +1272,39 @@ def sanitize_for_path(name):
     return name
 
 
-def build_destination_dir(character_tags, copyright_tag, sensitivity) -> str:
-    """Return the destination directory for a post. Callers create it themselves."""
-    base_folder_name, specific_folder_name = get_folder_name(
-        character_tags, copyright_tag
-    )
-    base_folder_name = sanitize_for_path(base_folder_name)
-
-    if specific_folder_name:
-        specific_folder_name = sanitize_for_path(specific_folder_name)
-        return os.path.join(
-            BASE_DIR, base_folder_name, specific_folder_name, sensitivity
-        )
-    return os.path.join(BASE_DIR, base_folder_name, sensitivity)
-
-
-def download_and_save_image(post, character_tags, sensitivity, copyright_tag):
-    file_url, file_name = resolve_download_url(post)
-
-    path = build_destination_dir(character_tags, copyright_tag, sensitivity)
-
-    if not os.path.exists(path):
-        os.makedirs(path)
-
-    file_path = os.path.join(path, file_name)
-
-    if os.path.exists(file_path):
-        log_message(
-            f"Skipping download of image {file_name} for post {post['id']:<8} because it already exists"
-        )
-        return True  # Indicate success since file exists
-
-    try:
-        download_image(file_url, file_path)
-        return True  # Indicate successful download
-    except Exception as e:
-        log_message(
-            f"Error downloading image {file_name} for post {post['id']:<8}: {e!s}"
-        )
-        return False  # Indicate failed download
-
-
-# Optimized batch operations
-def flush_cache_buffers():
-    """Flush pending cache updates to disk"""
-    global pending_posts_cache, pending_tag_cache
-
-    with cache_update_lock:
-        if pending_posts_cache:
-            posts_cache = load_posts_cache()
-            posts_cache.update(pending_posts_cache)
-            save_posts_cache(posts_cache)
-            pending_posts_cache.clear()
-
-        if pending_tag_cache:
-            tag_cache = load_cache()
-            tag_cache.update(pending_tag_cache)
-            save_cache(tag_cache)
-            pending_tag_cache.clear()
-
-
 # Named so every post is accounted for in the per-page line, not just downloads.
 POST_DOWNLOADED = "downloaded"
+POST_LINKED = "linked"
 POST_ON_DISK = "on_disk"
 POST_ALREADY_CACHED = "already_cached"
 POST_DOWNLOAD_FAILED = "download_failed"
+POST_SKIPPED = "skipped"  # Left out by the filters section
 
 POST_OUTCOMES = (
     POST_DOWNLOADED,
+    POST_LINKED,
     POST_ON_DISK,
     POST_ALREADY_CACHED,
     POST_DOWNLOAD_FAILED,
+    POST_SKIPPED,
 )
 
 
-def batch_process_posts(post_ids):
-    """Process multiple posts in parallel, returning a count per POST_OUTCOMES key"""
-    download_results = dict.fromkeys(POST_OUTCOMES, 0)
-    failed_count = 0
-
-    # First, fetch all post details in parallel with dynamic worker count
-    total_posts = len(post_ids)
-    print(c_info("Fetching post details..."))
-    with workers_lock:
-        worker_count = current_max_workers
-    with ThreadPoolExecutor(max_workers=worker_count) as executor:
-        # Submit all post detail fetching tasks with staggered delays
-        future_to_post_id = {}
-        for i, post_id in enumerate(post_ids):
-            # Add small staggered delay to prevent simultaneous API hits
-            if i > 0:
-                time.sleep(0.1)  # 100ms delay between task submissions
-            future_to_post_id[executor.submit(get_post_details, post_id)] = post_id
-
-        posts_to_process = []
-        completed_count = 0
-        cached_count = 0
-        missing_count = 0
-
-        for future in as_completed(future_to_post_id):
-            post_id = future_to_post_id[future]
-            completed_count += 1
-            try:
-                post_details = future.result()
-                # POST_MISSING is checked first: it is truthy and not subscriptable.
-                if post_details is POST_MISSING:
-                    missing_count += 1
-                elif post_details == "SKIP":
-                    cached_count += 1
-                elif post_details and post_details[0]:
-                    posts_to_process.append(post_details[0])
-                else:
-                    failed_count += 1
-            except Exception as e:
-                if "Too Many Requests" not in str(e):
-                    failed_count += 1
-
-            # Update progress bar with colours
-            progress = int((completed_count / total_posts) * 20)
-            bar_done = Fore.GREEN + "=" * progress
-            bar_remaining = Fore.WHITE + "-" * (20 - progress)
-            bar = bar_done + bar_remaining + Style.RESET_ALL
-
-            new_count = c_success(f"new: {len(posts_to_process)}")
-            cached_str = c_dim(f"cached: {cached_count}") if cached_count > 0 else ""
-            missing_str = c_warning(f"missing: {missing_count}") if missing_count > 0 else ""
-            failed_str = c_error(f"failed: {failed_count}") if failed_count > 0 else ""
-            status_parts = [s for s in [new_count, cached_str, missing_str, failed_str] if s]
-            status = ", ".join(status_parts)
-
-            print(f"\r  [{bar}] {completed_count}/{total_posts} ({status})  ", end="", flush=True)
-
-        print()  # New line after progress
-
-    if not posts_to_process:
-        return download_results
-
-    # Collect all unique tags from all posts for batch processing
-    print(c_info("Processing tags..."))
-    all_tags = set()
-    for post in posts_to_process:
-        all_tags.update(post["tags"].split())
-    print(f"Found {len(all_tags)} unique tags to process...")
-
-    # Batch fetch tag details
-    batch_fetch_tag_details(list(all_tags))
-
-    # Process posts with image downloads in parallel
-    with workers_lock:
-        worker_count = current_max_workers
-    with ThreadPoolExecutor(max_workers=min(worker_count, DOWNLOAD_WORKERS)) as executor:
-        futures = [
-            executor.submit(process_post, post) for post in posts_to_process
-        ]
+# What a --plan expects a sync to do with each post, in summary order. "stale" failed
+# entries were downloaded since; "deferred" ones are past the priority pass budget.
+PLAN_ACTIONS = ("download", "link", "on_disk", "skip", "cached", "stale", "deferred")
 
-        for future in as_completed(futures):
-            try:
-                download_results[future.result()] += 1
-            except Exception as e:
-                download_results[POST_DOWNLOAD_FAILED] += 1
-                log_message(f"Error processing post: {e!s}")
 
-    # Flush cache updates
-    flush_cache_buffers()
-    return download_results
+def format_duration(seconds):
+    """Rough human duration for the --plan estimate, e.g. 42s, 3m 20s, 2h 05m"""
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes}m {seconds:02d}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m"
 
 
 def format_page_summary(download_results, elapsed):
@@ -675,12 +1312,16 @@ def format_page_summary(download_results, elapsed):
     downloaded_count = download_results[POST_DOWNLOADED]
 
     extras = []
+    if download_results[POST_LINKED] > 0:
+        extras.append(c_success(f"{download_results[POST_LINKED]} linked from another profile"))
     if download_results[POST_ON_DISK] > 0:
         extras.append(c_dim(f"{download_results[POST_ON_DISK]} already on disk"))
     if download_results[POST_ALREADY_CACHED] > 0:
         extras.append(c_dim(f"{download_results[POST_ALREADY_CACHED]} cached mid-run"))
     if download_results[POST_DOWNLOAD_FAILED] > 0:
         extras.append(c_error(f"{download_results[POST_DOWNLOAD_FAILED]} failed"))
+    if download_results[POST_SKIPPED] > 0:
+        extras.append(c_dim(f"{download_results[POST_SKIPPED]} skipped by filters"))
     extra_str = (", " + ", ".join(extras)) if extras else ""
 
     if downloaded_count > 0:
@@ -690,587 +1331,3610 @@ def format_page_summary(download_results, elapsed):
     return c_dim(f"No new images (all cached) - {elapsed:.1f}s")
 
 
-def batch_fetch_tag_details(tags):
-    """Fetch tag details in parallel batches"""
-    cache = load_cache()
-    tags_to_fetch = [
-        tag for tag in tags if tag not in cache and tag not in pending_tag_cache
-    ]
-
-    if not tags_to_fetch:
-        return
+# Gelbooru tag types used for folder names.
+TAG_TYPE_COPYRIGHT = 3
+TAG_TYPE_CHARACTER = 4
+_FOLDER_TAG_TYPES = (TAG_TYPE_COPYRIGHT, TAG_TYPE_CHARACTER)
 
-    # Process tags in batches to avoid overwhelming the API
-    total_tags = len(tags_to_fetch)
-    print(c_info(f"Fetching {total_tags} new tag details..."))
-    tags_completed = 0
 
-    for i in range(0, total_tags, TAG_BATCH_SIZE):
-        batch = tags_to_fetch[i : i + TAG_BATCH_SIZE]
+def _tag_type_entry(tag_details):
+    if not tag_details or "type" not in tag_details:
+        return None
+    tag_type = int(tag_details["type"])
+    if tag_type not in _FOLDER_TAG_TYPES:
+        return None
+    return (tag_type, html.unescape(tag_details["name"]))
 
-        with workers_lock:
-            worker_count = current_max_workers
-        with ThreadPoolExecutor(max_workers=min(len(batch), worker_count)) as executor:
-            future_to_tag = {
-                executor.submit(get_tag_details_single, tag): tag for tag in batch
-            }
 
-            for future in as_completed(future_to_tag):
-                tag = future_to_tag[future]
-                tags_completed += 1
-                try:
-                    tag_details = future.result()
-                    if tag_details:
-                        with cache_update_lock:
-                            pending_tag_cache[tag] = tag_details
-                except Exception:
-                    pass  # Silently skip tag errors
+# Functions related to cache handling
+# Seconds a memoised cache file is trusted before it is stat()ed again (see
+# Downloader._load_json_memoised).
+MEMO_REVALIDATE_SECONDS = 1.0
 
-                # Update progress bar with colours
-                progress = int((tags_completed / total_tags) * 20)
-                bar_done = Fore.CYAN + "=" * progress
-                bar_remaining = Fore.WHITE + "-" * (20 - progress)
-                bar = bar_done + bar_remaining + Style.RESET_ALL
-                print(f"\r  [{bar}] {tags_completed}/{total_tags} tags  ", end="", flush=True)
 
-        # Small delay between batches to respect rate limits
-        time.sleep(0.5)
+def _file_signature(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
 
-    print()  # New line after progress
 
+# Only the fields resolve_download_url, get_sensitivity, the tag lookups, the content
+# index and the download scheduler (estimated_download_bytes) read.
+FAILED_POST_FIELDS = (
+    "id", "md5", "file_url", "preview_url", "directory", "image", "rating", "tags", "width", "height",
+)
 
-def get_tag_details_single(tag):
-    """Fetch single tag details without caching logic"""
-    rate_limit_api_call("tag")
 
-    modified_tag = (
-        tag.replace("&#039;", "'")
-        .replace("&gt;", ">")
-        .replace("&lt;", "<")
-        .replace("&quot;", '"')
-        .replace("&amp;", "&")
-    )
-    encoded_tag = quote(modified_tag)
-    url = f"https://gelbooru.com/index.php?page=dapi&s=tag&q=index&json=1&name={encoded_tag}&api_key={API_KEY}&user_id={USER_ID}"
+def failed_post_metadata(post):
+    """Return the subset of a post dict needed to retry its download without an API call"""
+    return {field: post[field] for field in FAILED_POST_FIELDS if field in post}
 
-    max_retries = 3  # Reduced retries for batch operations
-    base_delay = 2
 
-    for i in range(max_retries):
-        try:
-            response = requests.get(url, timeout=10)
+# cache.backend: sqlite keeps the posts cache, tag cache and content index in one
+# SQLite file instead of JSON files that are loaded whole and rewritten on every
+# flush, so memory use stays flat however large the account grows. Each row is
+# keyed by the JSON file it stands in for, so profiles keep separate posts caches.
+CACHE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    cache TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (cache, key)
+) WITHOUT ROWID;
+"""
+CACHE_DB_PAGE_ROWS = 1000  # Rows per query when iterating a cache
+TAG_TYPE_LOOKUP_SIZE = 4096  # Tags whose folder type is remembered between lookups
 
-            # Check 429 before raise_for_status so it routes to backoff, not a generic HTTPError.
-            if response.status_code == 429:
-                handle_rate_limit_response()
-                raise requests.exceptions.RequestException("HTTP 429 rate limited")
 
-            response.raise_for_status()
+class CacheDatabase:
+    """The SQLite file behind cache.backend: sqlite.
 
-            data = json.loads(response.text)
-            if data and "tag" in data and data["tag"]:
-                reset_adaptive_delay()
-                tag_data = data["tag"][0]
-                tag_data["name"] = html.unescape(tag_data["name"])
-                return tag_data
-            else:
-                reset_adaptive_delay()
-                return None
+    One connection is shared by all threads behind a lock. SQLite's page cache is
+    capped at cache_mb, so memory doesn't grow with the number of rows. read_only
+    opens an existing file without creating, migrating or importing anything.
+    """
 
-        except requests.exceptions.RequestException as e:
-            if "Too Many Requests" in str(e):
-                handle_rate_limit_response()
-
-            if i < max_retries - 1:
-                delay = base_delay * (2**i)
-                with stats_lock:
-                    rate_stats["retries"] += 1
-                debug_log(f"[tag {tag}] retry {i + 1}/{max_retries} in {delay}s: {str(e)[:60]}")
-                time.sleep(delay)
-            else:
-                debug_log(f"[tag {tag}] gave up after {max_retries} attempts: {str(e)[:60]}")
-                return None
+    def __init__(self, path, cache_mb=8, read_only=False):
+        import sqlite3
+        from urllib.request import pathname2url
+
+        self.path = path
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        if read_only:
+            uri = f"file:{pathname2url(os.path.abspath(path))}?mode=ro"
+            self.conn = sqlite3.connect(uri, uri=True, timeout=60, isolation_level=None, check_same_thread=False)
+            self.conn.execute(f"PRAGMA cache_size=-{int(cache_mb * 1024)}")
+        else:
+            self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(f"PRAGMA cache_size=-{int(cache_mb * 1024)}")
+            self.conn.executescript(CACHE_DB_SCHEMA)
+        self.tables = {}
+        self._tables_lock = threading.Lock()
+
+    def table(self, name):
+        """The SqliteCacheTable standing in for JSON cache file name, imported from it on first use"""
+        with self._tables_lock:
+            table = self.tables.get(name)
+            if table is None:
+                table = self.tables[name] = SqliteCacheTable(self, name)
+                if not self.read_only:
+                    table.import_json(name)
+            return table
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class SqliteCacheTable:
+    """Dict-like view of one cache in a CacheDatabase.
+
+    Supports what the engine does with a loaded JSON cache (in, get, [], items,
+    update, len) without holding the entries in memory. update() writes through,
+    so there is nothing to save afterwards.
+    """
 
-    # Defensive: only reachable if max_retries ever becomes 0 or negative.
-    return None
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def _query(self, sql, params=()):
+        with self.db.lock:
+            return self.db.conn.execute(sql, (self.name, *params)).fetchall()
+
+    def __contains__(self, key):
+        return bool(self._query("SELECT 1 FROM entries WHERE cache = ? AND key = ?", (str(key),)))
+
+    def get(self, key, default=None):
+        rows = self._query("SELECT value FROM entries WHERE cache = ? AND key = ?", (str(key),))
+        return json.loads(rows[0][0]) if rows else default
+
+    def __getitem__(self, key):
+        rows = self._query("SELECT value FROM entries WHERE cache = ? AND key = ?", (str(key),))
+        if not rows:
+            raise KeyError(key)
+        return json.loads(rows[0][0])
+
+    def __len__(self):
+        return self._query("SELECT COUNT(*) FROM entries WHERE cache = ?")[0][0]
+
+    def is_empty(self):
+        return not self._query("SELECT 1 FROM entries WHERE cache = ? LIMIT 1")
+
+    def items(self):
+        """Iterate (key, value) in key order, CACHE_DB_PAGE_ROWS rows per query"""
+        last = ""
+        while True:
+            rows = self._query(
+                "SELECT key, value FROM entries WHERE cache = ? AND key > ? ORDER BY key LIMIT ?",
+                (last, CACHE_DB_PAGE_ROWS),
+            )
+            for key, value in rows:
+                yield key, json.loads(value)
+            if len(rows) < CACHE_DB_PAGE_ROWS:
+                return
+            last = rows[-1][0]
+
+    def __iter__(self):
+        return (key for key, _ in self.items())
+
+    def update(self, entries):
+        rows = [(self.name, str(key), json.dumps(value)) for key, value in entries.items()]
+        if not rows:
+            return
+        with self.db.lock:
+            self.db.conn.execute("BEGIN")
+            try:
+                self.db.conn.executemany("INSERT OR REPLACE INTO entries (cache, key, value) VALUES (?, ?, ?)", rows)
+                self.db.conn.execute("COMMIT")
+            except BaseException:
+                self.db.conn.execute("ROLLBACK")
+                raise
+
+    def import_json(self, path):
+        """Copy the JSON cache at path in if this cache is still empty; the file is left as it was"""
+        if not self.is_empty() or not os.path.exists(path):
+            return
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError) as e:
+            print(c_warning(f"Could not import {path} into {self.db.path}: {e!s}"))
+            return
+        keys = list(data)
+        for i in range(0, len(keys), CACHE_DB_PAGE_ROWS):
+            self.update({key: data[key] for key in keys[i : i + CACHE_DB_PAGE_ROWS]})
+        print(c_info(f"Imported {len(keys)} entries from {path} into {self.db.path}"))
+
+
+class SqliteTagTypes:
+    """Stand-in for the tag type index with the SQLite backend.
+
+    Looks each tag up when asked (remembering the last TAG_TYPE_LOOKUP_SIZE)
+    instead of building an index of the whole tag cache.
+    """
 
+    def __init__(self, table):
+        self.table = table
+        self.get = functools.lru_cache(maxsize=TAG_TYPE_LOOKUP_SIZE)(self._lookup)
 
-def process_post(post):
-    """Process post with buffered cache updates, returning one of POST_OUTCOMES"""
-    post_id = post["id"]
+    def _lookup(self, tag):
+        return _tag_type_entry(self.table.get(tag))
 
-    # Safety check in case this function is called directly
-    # Normally cached posts are filtered out earlier in batch_process_posts
-    posts_cache = load_posts_cache()
-    with cache_update_lock:
-        if post_id in posts_cache or post_id in pending_posts_cache:
-            log_message(f"Post {post_id:<8} found in cache during processing, skipping")
-            return POST_ALREADY_CACHED
+    def forget(self):
+        """Drop remembered lookups, e.g. a tag remembered as unknown that has since been cached"""
+        self.get.cache_clear()
 
-    file_url, file_name = resolve_download_url(post)
-    sensitivity = get_sensitivity(post)
 
-    character_tags = get_character_tags(post["tags"])
-    copyright_tag = get_copyright_tag(post["tags"])
+# Retry order: posts a stopped run had fetched but not downloaded, then download
+# failures (neither needs an API call), then API failures.
+FAILURE_TYPE_PRIORITY = {"interrupted": 0, "download": 1, "api": 2}
 
-    path = build_destination_dir(character_tags, copyright_tag, sensitivity)
 
-    file_path = os.path.join(path, file_name)
+def cancel_pending(futures):
+    """Cancel the futures that have not started yet; running ones are left to finish"""
+    for future in futures:
+        future.cancel()
 
-    if not os.path.exists(file_path):
-        try:
-            if not os.path.exists(path):
-                os.makedirs(path)
-            download_image(file_url, file_path)
-            outcome = POST_DOWNLOADED
-            # Format download message with colour
-            print(f"  {c_success('+')} {c_dim(file_name[:45])} {c_dim('post')} {post_id}")
-            # Only add to cache if download succeeded
-            with cache_update_lock:
-                pending_posts_cache[post_id] = True
-        except Exception as e:
-            print(f"  {c_error('x')} {c_error('Failed:')} {file_name[:30]} - {str(e)[:30]}")
-            outcome = POST_DOWNLOAD_FAILED
-            # Track download failures so they can be retried later
-            with failed_cache_lock:
-                failed_cache = load_failed_posts_cache()
-                failed_cache[str(post_id)] = {"error": str(e)[:100], "type": "download"}
-                save_failed_posts_cache(failed_cache)
-    else:
-        # File already exists, safe to cache
-        outcome = POST_ON_DISK
-        with cache_update_lock:
-            pending_posts_cache[post_id] = True
 
-    return outcome
+def failure_priority(error_info):
+    """Sort key for a failed-cache entry; unknown and legacy entries go last"""
+    if isinstance(error_info, dict):
+        return FAILURE_TYPE_PRIORITY.get(error_info.get("type"), len(FAILURE_TYPE_PRIORITY))
+    return len(FAILURE_TYPE_PRIORITY)
 
 
-def get_character_tags(tags):
-    """Retrieve character tags using cached data"""
-    character_tags = []
-    cache = load_cache()
+# Functions related to post processing
+SENSITIVITY_FOLDERS = {
+    "sensitive": "Sensitive",
+    "questionable": "Questionable",
+    "explicit": "Explicit",
+}
 
-    for tag in tags.split():
-        # Check both main cache and pending cache
-        tag_details = cache.get(tag)
-        if not tag_details:
-            with cache_update_lock:
-                tag_details = pending_tag_cache.get(tag)
 
-        if tag_details and "type" in tag_details and int(tag_details["type"]) == 4:
-            character_tags.append(html.unescape(tag_details["name"]))
+def get_sensitivity(post):
+    return SENSITIVITY_FOLDERS.get(post.get("rating"), "General")
 
-    return character_tags
 
+# Optional hashed sub-folders below each rating folder (settings.fanout_levels). Each
+# level is FANOUT_CHARS hex characters of the image's md5, so a folder never holds more
+# than 16 ** FANOUT_CHARS sub-folders, and the images spread evenly over the leaves.
+FANOUT_CHARS = 2
+MAX_FANOUT_LEVELS = 4
+_FANOUT_DIR = re.compile(f"[0-9a-f]{{{FANOUT_CHARS}}}")
+_MD5_STEM = re.compile(r"[0-9a-f]{32}")
+# --reshard suggests another level once the largest folder holds more images than this
+FANOUT_SUGGEST_ENTRIES = 5000
 
-def get_copyright_tag(tags):
-    """Retrieve copyright tag using cached data"""
-    cache = load_cache()
 
-    for tag in tags.split():
-        # Check both main cache and pending cache
-        tag_details = cache.get(tag)
-        if not tag_details:
-            with cache_update_lock:
-                tag_details = pending_tag_cache.get(tag)
+def fanout_subdirs(file_name, levels):
+    """Hashed sub-folders an image goes in below its rating folder, e.g. ["3f", "a2"] for 2 levels.
 
-        if tag_details and "type" in tag_details and int(tag_details["type"]) == 3:
-            return html.unescape(tag_details["name"])
+    Gelbooru names images after their md5, which is used as-is; any other name is hashed.
+    """
+    levels = min(levels, MAX_FANOUT_LEVELS)
+    if levels <= 0:
+        return []
+    digest = os.path.splitext(file_name)[0].lower()
+    if not _MD5_STEM.fullmatch(digest):
+        import hashlib
 
-    return None
+        digest = hashlib.md5(file_name.encode("utf-8")).hexdigest()
+    return [digest[i * FANOUT_CHARS : (i + 1) * FANOUT_CHARS] for i in range(levels)]
 
 
-# Functions for managing rate-limited posts
-def load_rate_limited_posts():
-    """Load the set of rate-limited posts from disk"""
-    try:
-        with open(RATE_LIMITED_POSTS_FILE, "r") as f:
-            return set(json.load(f))
-    except FileNotFoundError:
-        return set()
+def get_folder_name(character_tags, copyright_tag):
+    if not character_tags:
+        return ("No Character", None)
+    elif len(character_tags) == 1:
+        return (character_tags[0].replace(":", "-"), None)
+    else:
+        if copyright_tag:
+            return ("Multiple", copyright_tag.replace(":", "-"))
+        else:
+            return ("Multiple", None)
 
 
-def _save_rate_limited_posts_unlocked():
-    """Save rate-limited posts to disk. Must be called while holding rate_limited_lock."""
-    with open(RATE_LIMITED_POSTS_FILE, "w") as f:
-        json.dump(list(rate_limited_posts), f)
+# Rate-limited posts are revisited before failures: they were interrupted, not broken.
+PRIORITY_RATE_LIMITED = 0
+PRIORITY_FAILED = 1
 
 
-def add_rate_limited_post(post_id):
-    """Add a post to the rate-limited tracking set"""
-    with rate_limited_lock:
-        rate_limited_posts.add(post_id)
-        _save_rate_limited_posts_unlocked()
-        tracked = len(rate_limited_posts)
-    debug_log(f"now tracking rate-limited post {post_id} ({tracked} tracked)")
+def build_priority_queue(rate_limited, failed_cache):
+    """Return a heap of (priority, failure order, post_id) seeded from both sets.
 
+    A post in both sets is queued once, as rate-limited.
+    """
+    queue = []
+    for post_id in rate_limited:
+        heapq.heappush(queue, (PRIORITY_RATE_LIMITED, 0, str(post_id)))
+    for post_id, error_info in failed_cache.items():
+        if post_id not in rate_limited:
+            heapq.heappush(queue, (PRIORITY_FAILED, failure_priority(error_info), post_id))
+    return queue
+
+
+def profile_cache_path(path, profile_name):
+    """posts_cache.json -> posts_cache.<profile>.json"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{profile_name}{ext}"
+
+
+# Sharded backfill. Workers (possibly on several machines) share one SQLite file:
+# `pages` is the work table of favourites offsets, claimed under a lease that a
+# crashed worker lets expire; `posts` is the merged store of finished posts, and
+# a per-post claim keeps two workers from downloading the same post when page
+# boundaries shift during the backfill.
+SHARD_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS pages (
+    pid INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    post_count INTEGER
+);
+CREATE TABLE IF NOT EXISTS posts (
+    post_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL
+);
+"""
 
-def remove_rate_limited_post(post_id):
-    """Remove a post from the rate-limited tracking set"""
-    removed = False
-    with rate_limited_lock:
-        if post_id in rate_limited_posts:
-            rate_limited_posts.remove(post_id)
-            _save_rate_limited_posts_unlocked()
-            removed = True
-        tracked = len(rate_limited_posts)
-    if removed:
-        debug_log(f"cleared rate-limited post {post_id} ({tracked} still tracked)")
 
+# Trace analysis (--analyze-trace)
+# Endpoint -> stage whose wall time its requests run inside
+TRACE_ENDPOINT_STAGES = {"favourites": "scrape", "detail": "detail", "tag": "tag", "download": "download"}
 
-# Functions related to cache handling
-def load_cache():
-    try:
-        with open(CACHE_FILE, "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
+BOTTLENECK_HINTS = {
+    "throttle": "spacing gate; min_delay / learned limits decide this",
+    "cooldown": "429 cooldowns; the server is pushing back",
+    "ttfb": "waiting on the server before the first byte",
+    "transfer": "reading response bodies; bandwidth-bound",
+    "capped": "sleeping under max_download_bytes_per_second",
+    "local": "stage time with no request in flight (disk, parsing, scheduling)",
+}
 
 
-def save_cache(cache):
-    with open(CACHE_FILE, "w") as f:
-        json.dump(cache, f)
+def load_trace_records(path):
+    records = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                try:
+                    records.append(json.loads(line))
+                except json.decoder.JSONDecodeError:
+                    continue  # A torn last line from a killed run
+    return records
+
+
+def _covered_seconds(intervals):
+    """Total length of the union of (start, end) intervals"""
+    total = 0.0
+    current_start = current_end = None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+
+def _peak_overlap(intervals):
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    peak = level = 0
+    for _, step in events:
+        level += step
+        peak = max(peak, level)
+    return peak
+
+
+def analyze_trace(path):
+    """Print a timeline, per-endpoint concurrency and ranked bottlenecks for a --trace file"""
+    records = load_trace_records(path)
+    request_records = [r for r in records if r.get("kind") == "request"]
+    stages = [r for r in records if r.get("kind") == "stage"]
+    rate_limits = [r for r in records if r.get("kind") == "rate_limit"]
+    if not request_records:
+        print(c_warning(f"No request records in {path}"))
+        return
 
+    def held(r):
+        """Seconds a request held its connection: its latency plus any bandwidth-cap sleeps"""
+        return r.get("latency", 0) + r.get("bandwidth_wait", 0)
 
-def load_posts_cache():
-    try:
-        with open(POSTS_CACHE_FILE, "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
+    start = min(r["ts"] for r in records)
+    end = max(
+        [r["ts"] + held(r) for r in request_records] + [r["ts"] + r.get("duration", 0) for r in stages]
+    )
+    span = max(end - start, 1e-9)
 
+    print(c_header("\n" + "=" * 60))
+    print(c_header(f"  Trace {os.path.basename(path)}: {len(request_records)} requests over {span:.1f}s"))
+    print(c_header("=" * 60))
 
-def save_posts_cache(cache):
-    with open(POSTS_CACHE_FILE, "w") as f:
-        json.dump(cache, f)
+    # Timeline: at most ~24 rows
+    bucket = next((b for b in (1, 5, 10, 30, 60, 300, 600, 1800, 3600) if span / b <= 24), 3600 * 6)
+    rows = {}
+    for r in request_records:
+        row = rows.setdefault(int((r["ts"] - start) // bucket), {"count": {}, "429": 0, "bytes": 0, "busy": 0.0})
+        row["count"][r["endpoint"]] = row["count"].get(r["endpoint"], 0) + 1
+        row["429"] += r.get("status") == 429
+        row["bytes"] += r.get("bytes") or 0
+        row["busy"] += held(r)
+    print(c_info(f"\nTimeline ({bucket}s buckets; in-flight = mean concurrent requests)"))
+    for index in range(int(span // bucket) + 1):
+        row = rows.get(index)
+        offset = time.strftime("%H:%M:%S", time.gmtime(index * bucket))
+        if not row:
+            print(c_dim(f"  +{offset}  idle"))
+            continue
+        counts = " ".join(f"{endpoint} {n}" for endpoint, n in sorted(row["count"].items()))
+        limited = c_warning(f" | 429s {row['429']}") if row["429"] else ""
+        print(
+            f"  +{offset}  {counts}{limited} | {row['bytes'] / 1e6:.1f} MB | "
+            f"in-flight {row['busy'] / bucket:.1f}"
+        )
 
+    # Concurrency utilisation and time breakdown per endpoint
+    stage_intervals = {}
+    for r in stages:
+        stage_intervals.setdefault(r["stage"], []).append((r["ts"], r["ts"] + r["duration"]))
+    bottlenecks = []
+    print(c_info("\nConcurrency per endpoint (within its stage's wall time)"))
+    for endpoint in sorted({r["endpoint"] for r in request_records}):
+        reqs = [r for r in request_records if r["endpoint"] == endpoint]
+        intervals = [(r["ts"], r["ts"] + held(r)) for r in reqs]
+        busy = sum(held(r) for r in reqs)
+        stage = TRACE_ENDPOINT_STAGES.get(endpoint)
+        active = _covered_seconds(stage_intervals.get(stage, [])) or _covered_seconds(intervals)
+        peak = _peak_overlap(intervals)
+        mean = busy / active if active else 0.0
+        print(
+            f"  - {endpoint:<10s} mean {mean:4.1f} in flight, peak {peak}"
+            f" ({mean / peak * 100 if peak else 0:.0f}% of peak) over {active:.1f}s"
+        )
+        # Wall time is attributed in layers so nothing is counted twice: seconds with a
+        # request in flight, then seconds only waiting at the spacing gate, then seconds
+        # only in 429 cooldown, and whatever is left of the stage is local work.
+        waits = [(r["ts"] - r["wait"], r["ts"]) for r in reqs if r.get("wait")]
+        cooldowns = [
+            (r["ts"], r["ts"] + r.get("cooldown", 0)) for r in rate_limits if r.get("endpoint") == endpoint
+        ]
+        in_flight = _covered_seconds(intervals)
+        with_waits = _covered_seconds(intervals + waits)
+        with_cooldowns = _covered_seconds(intervals + waits + cooldowns)
+        ttfb_share = sum(r.get("ttfb") or 0 for r in reqs) / busy if busy else 0.0
+        capped_share = sum(r.get("bandwidth_wait", 0) for r in reqs) / busy if busy else 0.0
+        bottlenecks.append(("ttfb", endpoint, in_flight * ttfb_share))
+        bottlenecks.append(("transfer", endpoint, in_flight * (1 - ttfb_share - capped_share)))
+        bottlenecks.append(("capped", endpoint, in_flight * capped_share))
+        bottlenecks.append(("throttle", endpoint, with_waits - in_flight))
+        bottlenecks.append(("cooldown", endpoint, with_cooldowns - with_waits))
+        if stage in stage_intervals:
+            bottlenecks.append(("local", stage, max(0.0, active - with_cooldowns)))
+
+    merged = {}
+    for kind, where, seconds in bottlenecks:
+        merged[(kind, where)] = merged.get((kind, where), 0.0) + seconds
+    ranked = sorted(((seconds, kind, where) for (kind, where), seconds in merged.items() if seconds > 0), reverse=True)
+    print(c_info("\nBottlenecks (wall-clock seconds)"))
+    for seconds, kind, where in ranked[:8]:
+        print(f"  {seconds:8.1f}s {seconds / span * 100:5.1f}%  {kind:<8s} {where:<10s} {c_dim(BOTTLENECK_HINTS[kind])}")
+
+    errors = [r for r in request_records if r.get("status") is None or r["status"] >= 400]
+    if errors:
+        by_status = {}
+        for r in errors:
+            key = r.get("status") or "no response"
+            by_status[key] = by_status.get(key, 0) + 1
+        print(c_warning("\nErrors: " + ", ".join(f"{k}: {v}" for k, v in sorted(by_status.items(), key=str))))
+
+    print(c_info("\nSlowest requests"))
+    for r in sorted(request_records, key=lambda r: r.get("latency", 0), reverse=True)[:5]:
+        subject = r.get("post_id") or r.get("tag") or r.get("url") or f"pid={r.get('pid')}"
+        print(f"  {r.get('latency', 0):7.2f}s  {r['endpoint']:<10s} {r.get('status')}  {subject}")
 
-def load_failed_posts_cache():
-    file_lock.acquire()
-    try:
-        with open(FAILED_POSTS_CACHE_FILE, "r") as f:
-            if os.stat(FAILED_POSTS_CACHE_FILE).st_size == 0:
-                return {}
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
-    except json.decoder.JSONDecodeError:
-        with open(FAILED_POSTS_CACHE_FILE, "r") as f:
-            print(f"Error decoding JSON, file contents: {f.read()}")
-        return {}
-    finally:
-        file_lock.release()
 
+# =============================================================================
+# Download Engine
+# =============================================================================
+class LoginError(Exception):
+    """Gelbooru could not be reached to log in, or did not accept the username and password"""
 
-def save_failed_posts_cache(cache):
-    with open(FAILED_POSTS_CACHE_FILE, "w") as f:
-        json.dump(cache, f)
 
+class Downloader:
+    """The download engine: settings, credentials, sessions, caches, rate limiter and stats.
 
-# Functions related to post processing
-def get_sensitivity(post):
-    rating = post.get("rating")
-    if rating == "sensitive":
-        return "Sensitive"
-    elif rating == "questionable":
-        return "Questionable"
-    elif rating == "explicit":
-        return "Explicit"
-    else:
-        return "General"
+    Everything a run uses lives on the instance, so importing the module has no
+    side effects and several engines can share a process (each with its own
+    library, caches and rate limiter). The command line is a thin wrapper around:
 
+        engine = Downloader(load_config(), credentials=load_credentials())
+        result = engine.sync()            # what a plain run does
+        result = engine.retry_failed()    # what --retry-failed does
 
-def get_folder_name(character_tags, copyright_tag):
-    if not character_tags:
-        return ("No Character", None)
-    elif len(character_tags) == 1:
-        return (character_tags[0].replace(":", "-"), None)
-    else:
-        if copyright_tag:
-            return ("Multiple", copyright_tag.replace(":", "-"))
+    config is a parsed config.yaml; missing keys (or sections) fall back to the
+    defaults below. credentials is (api_key, user_id, username, password) and is
+    only needed by the paths that talk to Gelbooru. clock replaces the wall clock
+    for the rate limiter and retry backoff (see benchmarks/ratelimit_sim.py).
+    transport is a requests adapter mounted on every session the engine opens, in
+    place of the real HTTP connection (see benchmarks/fault_inject.py).
+    """
+
+    def __init__(self, config=None, credentials=None, clock=None, log_to_file=False, debug=False, transport=None):
+        config = config or {}
+        settings = config.get("settings") or {}
+        cache = config.get("cache") or {}
+        threads = config.get("threading") or {}
+        rate_limiting = config.get("rate_limiting") or {}
+
+        # General Settings
+        self.posts_per_page = settings.get("posts_per_page", 50)
+        self.max_consecutive_empty_pages = settings.get("max_consecutive_empty_pages", 10)
+        # Only changed to point the script at a local stand-in server (see benchmarks/).
+        self.site_url = settings.get("site_url", "https://gelbooru.com").rstrip("/")
+        self.base_dir = settings.get("base_dir", "") or SCRIPT_DIR
+        # Hashed sub-folder levels below each rating folder (0 = flat); see --reshard
+        self.fanout_levels = settings.get("fanout_levels", 0)
+        # After the first Ctrl+C, how long in-flight work gets to finish before the run is aborted
+        self.shutdown_grace_seconds = settings.get("shutdown_grace_seconds", 30)
+
+        # Cache Files
+        self.tag_cache_file = cache.get("tag_cache_file", "tag_cache.json")
+        self.posts_cache_file = cache.get("posts_cache_file", "posts_cache.json")
+        self.failed_posts_cache_file = cache.get("failed_posts_cache_file", "failed_posts_cache.json")
+        self.rate_limited_posts_file = cache.get("rate_limited_posts_file", "rate_limited_posts.json")
+        self.skipped_posts_file = cache.get("skipped_posts_file", "skipped_posts.json")
+        self.content_index_file = cache.get("content_index_file", "content_index.json")
+        self.rate_limit_state_file = cache.get("rate_limit_state_file", "rate_limit_state.json")
+        # "json", or "sqlite" to keep memory flat on very large accounts (see CacheDatabase)
+        self.cache_backend = cache.get("backend", "json")
+        if self.cache_backend not in ("json", "sqlite"):
+            raise ValueError(f"cache.backend must be json or sqlite, not {self.cache_backend!r}")
+        self.cache_db_file = cache.get("sqlite_file", "cache.sqlite3")
+        self.cache_db_cache_mb = cache.get("sqlite_cache_mb", 8)
+        # Set by plan(): sqlite_file is opened read-only and never created or imported into.
+        self.cache_read_only = False
+        # Buffered cache writes are flushed once a buffer holds this many entries, not
+        # only at the end of each page (0 = page end only)
+        self.flush_entries = cache.get("flush_entries", 500)
+        # Change feed of the files each run writes, links, moves or fails on ("" = off)
+        self.manifest_file = cache.get("manifest_file", "")
+
+        # Multi-account profiles (optional section), used with --profiles
+        self.profile_settings = config.get("profiles") or {}
+
+        # Watch mode (optional section)
+        watch = config.get("watch") or {}
+        self.watch_interval = watch.get("interval", 60)
+        self.watch_jitter = watch.get("jitter", 10)
+        # Whether the last favourites walk ended normally, not on a failed page or stop()
+        self.favourites_walk_complete = False
+
+        # Sharded backfill (optional section), used with --shard-db
+        sharding = config.get("sharding") or {}
+        self.shard_lease_seconds = sharding.get("lease_seconds", 900)
+        self.shard_max_page_attempts = sharding.get("max_page_attempts", 3)
+
+        # Which favourites to download at all (optional section); see PostFilter
+        self.post_filter = PostFilter(config.get("filters"))
+
+        # Threading and Performance Settings
+        self.max_workers = threads.get("max_workers", 4)
+        self.download_workers = threads.get("download_workers", 3)
+        self.tag_batch_size = threads.get("tag_batch_size", 20)
+        self.large_file_bytes = threads.get("large_file_bytes", 8_000_000)
+        self.large_file_workers = threads.get("large_file_workers", 1)
+        self.disk_writers = threads.get("disk_writers", 2)
+        self.disk_queue_size = threads.get("disk_queue_size", 16)
+        self.fsync_batch = threads.get("fsync_batch", 0)
+
+        # Rate Limiting Settings
+        self.min_delay = rate_limiting.get("min_delay", 0.25)
+        self.max_delay = rate_limiting.get("max_delay", 5.0)
+        self.delay_increase_factor = rate_limiting.get("delay_increase_factor", 1.5)
+        self.delay_decrease_factor = rate_limiting.get("delay_decrease_factor", 0.95)
+        self.success_threshold = rate_limiting.get("success_threshold", 15)
+        self.priority_429_budget = rate_limiting.get("priority_429_budget", 3)
+        self.priority_max_posts = rate_limiting.get("priority_max_posts", 200)
+        # The rate_limit_429s count that ends the running priority pass, None outside one.
+        self.priority_429_limit = None
+        self.remember_limits = rate_limiting.get("remember_limits", True)
+        self.learned_half_life_hours = rate_limiting.get("learned_half_life_hours", 2)
+        self.max_download_bytes_per_second = rate_limiting.get("max_download_bytes_per_second", 0)
+
+        # Replaced by activate_profile with a profile's own credentials
+        self.set_credentials(credentials)
+
+        self.clock = clock or SystemClock()
+        self.transport = transport
+        # Global cap on image bytes per second across all download workers (None = no cap)
+        self.download_bandwidth = (
+            TokenBucket(self.max_download_bytes_per_second, clock=self.clock)
+            if self.max_download_bytes_per_second else None
+        )
+        self.log_to_file = log_to_file  # Also append log.txt / debug_log.txt (-logtofile)
+        self.debug_enabled = debug  # Verbose rate-limit telemetry (--debug)
+        self.metrics_json_path = None  # print_rate_limit_summary also writes the metrics here
+        self.trace_writer = None  # Opened by open_trace (--trace)
+        self.manifest_writer = None  # Opened on first use by record_manifest
+        self._manifest_writer_lock = threading.Lock()
+        self.metrics_server = None  # Started by start_metrics_server (--metrics-port)
+        self.profiler = None  # Set by start_profiler (--profile)
+        self.profile_prefix = None
+
+        self.file_lock = threading.Lock()
+        self.failed_cache_lock = threading.Lock()
+
+        # Dynamic concurrency control: current_max_workers is reduced when we hit rate
+        # limits and adaptive_delay is the spacing between API calls. Both start from
+        # the configured floor.
+        self.workers_lock = threading.Lock()
+        self.current_max_workers = self.max_workers
+        self.adaptive_delay = self.min_delay
+
+        self.last_api_call_time = 0
+        self.api_call_lock = threading.Lock()
+        self.successful_requests = 0  # Counter for successful requests
+        self.rate_limited_posts = set()  # Track currently rate-limited posts
+        self.rate_limited_lock = threading.Lock()
+        self.skipped_posts = None  # Loaded on first use by get_skipped_posts()
+        self.skipped_posts_lock = threading.Lock()
+        self.state_loaded = False  # Set by load_state
+
+        # Set by stop(): nothing new is dispatched, in-flight requests finish and their
+        # outcomes are committed before the current call returns.
+        self.stop_event = threading.Event()
+
+        # endpoint -> {"delay", "workers", "updated"}. start_limits is what earlier runs learned
+        # (loaded from rate_limit_state_file, applied as a decaying floor by endpoint_limits);
+        # learned_limits is what this run's 429s taught, saved for the next one. Both are
+        # guarded by api_call_lock.
+        self.start_limits = {}
+        self.learned_limits = {}
+        self.learned_limits_dirty = False
+
+        # Cache buffers for batch operations
+        self.pending_posts_cache = {}
+        self.pending_tag_cache = {}
+        self.pending_content_index = {}
+        self.cache_update_lock = threading.Lock()
+
+        self.rate_stats = new_rate_stats(self.min_delay, self.max_workers)
+        self.request_metrics = new_request_metrics()
+        self.stats_lock = threading.Lock()
+
+        # Per-thread seconds the last rate_limit_api_call waited, attached to the next traced request.
+        self._request_context = threading.local()
+
+        # Set by activate_profile() in --profiles mode. The content index (md5 -> file path)
+        # is shared between profiles so a post favourited by several accounts downloads once.
+        self.active_profile_name = None
+        self.content_index_enabled = False
+
+        # Set in --shard-db worker mode: completed posts are committed to the shared work
+        # database instead of posts_cache.json (see merge_shard_results).
+        self.shard_db_path = None
+        self.shard_worker_id = None
+
+        # Sessions shared by the download workers and by the detail and tag workers, for
+        # connection pooling; created on first use so the Referer follows site_url.
+        self.download_session = None
+        self.api_session = None
+        self._download_session_lock = threading.Lock()
+
+        # Writes downloaded images off the network threads; started on first use (see
+        # get_disk_writer). Posts whose write failed, for download_posts_parallel.
+        self.disk_writer = None
+        self._disk_writer_lock = threading.Lock()
+        self.write_failed_ids = set()
+
+        # Opened on first use with cache.backend: sqlite (see get_cache_db)
+        self.cache_db = None
+        self.sqlite_tag_types = None
+        self._cache_db_lock = threading.Lock()
+
+        # post id -> thumbnail title from the favourites page fetched last, for the
+        # filters' first pass in batch_process_posts.
+        self.thumbnail_titles = {}
+
+        # Parsed tag and posts caches, keyed by path and validated against the file's
+        # (mtime, size), so lookups don't re-parse the JSON on every call while a change
+        # made by another process is still picked up. The stat itself is only repeated
+        # once per MEMO_REVALIDATE_SECONDS, since it costs more than the lookup it guards.
+        self._parsed_json_cache = {}  # path -> ((mtime_ns, size), data, checked_at)
+        self._parsed_json_cache_lock = threading.Lock()
+
+        # name -> (type, unescaped name) for the character and copyright tags of the loaded
+        # tag cache, so per-post lookups skip int() and html.unescape. Rebuilt whenever
+        # load_cache() hands back a different dict; flush_cache_buffers adds new tags to it.
+        self._tag_type_index = {}
+        self._tag_type_index_source = None
+        self._tag_type_index_lock = threading.Lock()
+
+    def set_credentials(self, credentials):
+        """Use (api_key, user_id, username, password), e.g. from load_credentials()"""
+        self.api_key, self.user_id, self.username, self.password = credentials or (None, None, None, None)
+
+    def load_state(self):
+        """Pick up where earlier runs left off: learned rate limits and rate-limited posts.
+
+        Returns the number of posts still rate-limited. sync() and retry_failed()
+        call this on first use.
+        """
+        self.load_rate_limit_state()
+        with self.rate_limited_lock:
+            self.rate_limited_posts = self.load_rate_limited_posts()
+            count = len(self.rate_limited_posts)
+        self.state_loaded = True
+        return count
+
+    def stop(self):
+        """Ask the running sync/retry/watch to wind down; safe to call from a signal handler.
+
+        No new pages, batches or downloads are started. Requests already in flight
+        finish, posts whose details were fetched but not downloaded are checkpointed
+        as "interrupted" failures (retried first next run), and the call returns with
+        "stopped" set in its result.
+        """
+        self.stop_event.set()
+
+    def stopping(self):
+        return self.stop_event.is_set()
+
+    def priority_budget_spent(self):
+        """True once the running priority pass has hit its priority_429_budget"""
+        limit = self.priority_429_limit
+        if limit is None:
+            return False
+        with self.stats_lock:
+            return self.rate_stats["rate_limit_429s"] >= limit
+
+    def remove_partial_files(self):
+        """Delete the .part files of downloads still being written; returns how many"""
+        writer = self.disk_writer
+        return writer.remove_partial_files() if writer is not None else 0
+
+    def sync(self, session=None):
+        """Priority pass, then page through the favourites; what a plain run does.
+
+        session is a logged-in session from login(); one is made if omitted. Returns
+        {"pages", "outcomes", "priority", "rate_limited", "stopped", "metrics"}: favourites
+        pages processed, a count per POST_OUTCOMES key for this call, the priority pass
+        totals (see process_priority_posts), posts still rate-limited, whether stop() cut
+        the run short, and a metrics_snapshot().
+        """
+        if not self.state_loaded:
+            self.load_state()
+        if session is None:
+            session = self.login()
+        with self.stats_lock:
+            outcomes_before = dict(self.request_metrics["outcomes"])
+
+        priority = self.process_priority_posts()
+        pages = self.sync_favourites(session)
+
+        with self.stats_lock:
+            outcomes = {
+                outcome: self.request_metrics["outcomes"].get(outcome, 0) - outcomes_before.get(outcome, 0)
+                for outcome in POST_OUTCOMES
+            }
+        with self.rate_limited_lock:
+            rate_limited = len(self.rate_limited_posts)
+        return {
+            "pages": pages,
+            "outcomes": outcomes,
+            "priority": priority,
+            "rate_limited": rate_limited,
+            "stopped": self.stopping(),
+            "metrics": self.metrics_snapshot(),
+        }
+
+    def close(self):
+        """Finish queued file writes, flush buffered caches, the trace and the manifest and stop the metrics server; safe to call twice"""
+        if self.disk_writer is not None:
+            self.disk_writer.close()
+        self.flush_cache_buffers()
+        db, self.cache_db = self.cache_db, None
+        if db is not None:
+            db.close()
+        self.close_trace()
+        manifest, self.manifest_writer = self.manifest_writer, None
+        if manifest is not None:
+            manifest.close()
+        server, self.metrics_server = self.metrics_server, None
+        if server is not None:
+            server.shutdown()
+
+    def close_trace(self):
+        writer, self.trace_writer = self.trace_writer, None
+        if writer is not None:
+            writer.close()
+
+    def record_request(self, endpoint, started, response=None, paused=0.0):
+        """Account one HTTP request that began at perf_counter() time started.
+
+        response is None when the request raised before a response arrived. paused
+        is time the request spent asleep under the bandwidth cap, which is left out
+        of its latency and transfer time so the cap doesn't read as a slow server.
+        Returns (latency, ttfb, bytes) for the trace; ttfb and bytes are None without a response.
+        """
+        latency = time.perf_counter() - started - paused
+        ttfb = size = None
+        with self.stats_lock:
+            ep = self.request_metrics["endpoints"].get(endpoint)
+            if ep is None:
+                ep = self.request_metrics["endpoints"][endpoint] = {
+                    "requests": 0,
+                    "errors": 0,
+                    "bytes": 0,
+                    "latency": LatencyHistogram(),
+                    "ttfb": LatencyHistogram(),
+                    "transfer": LatencyHistogram(),
+                }
+            ep["requests"] += 1
+            ep["latency"].record(latency)
+            if response is None or response.status_code >= 400:
+                ep["errors"] += 1
+            if response is not None:
+                ttfb = min(response.elapsed.total_seconds(), latency)
+                size = len(response.content)
+                ep["ttfb"].record(ttfb)
+                ep["transfer"].record(latency - ttfb)
+                ep["bytes"] += size
+        return latency, ttfb, size
+
+    def timed_get(self, endpoint, get, url, trace=None, **kwargs):
+        """get(url, **kwargs), recorded in request_metrics under endpoint.
+
+        trace holds extra fields for the --trace record (post id, attempt number, ...).
+        """
+        import requests
+
+        wall_started = time.time()
+        started = time.perf_counter()
+        wait = getattr(self._request_context, "throttle_wait", 0.0)
+        self._request_context.throttle_wait = 0.0
+        self._request_context.bandwidth_wait = 0.0  # Added to by fetch_image under the cap
+        trace = dict(trace or {})
+        try:
+            response = get(url, **kwargs)
+        except requests.exceptions.RequestException as e:
+            capped = self._request_context.bandwidth_wait
+            if capped:
+                trace["bandwidth_wait"] = round(capped, 4)
+            latency, _, _ = self.record_request(endpoint, started, paused=capped)
+            self.trace_event(
+                "request", ts=wall_started, endpoint=endpoint, status=None, error=str(e)[:120],
+                latency=round(latency, 4), wait=round(wait, 4), **trace,
+            )
+            raise
+        capped = self._request_context.bandwidth_wait
+        if capped:
+            trace["bandwidth_wait"] = round(capped, 4)
+        latency, ttfb, size = self.record_request(endpoint, started, response, paused=capped)
+        self.trace_event(
+            "request", ts=wall_started, endpoint=endpoint, status=response.status_code,
+            latency=round(latency, 4), ttfb=round(ttfb, 4), bytes=size, wait=round(wait, 4), **trace,
+        )
+        return response
+
+    def metrics_snapshot(self):
+        """JSON-ready copy of rate_stats and request_metrics, with throughput over the run so far"""
+        with self.stats_lock:
+            wall = time.perf_counter() - self.request_metrics["started"]
+            endpoints = {
+                name: {
+                    "requests": ep["requests"],
+                    "errors": ep["errors"],
+                    "bytes": ep["bytes"],
+                    "latency": ep["latency"].to_dict(),
+                    "ttfb": ep["ttfb"].to_dict(),
+                    "transfer": ep["transfer"].to_dict(),
+                }
+                for name, ep in self.request_metrics["endpoints"].items()
+            }
+            snapshot = {
+                "wall_seconds": wall,
+                "rate_stats": json.loads(json.dumps(self.rate_stats)),
+                "endpoints": endpoints,
+                "stage_seconds": dict(self.request_metrics["stage_seconds"]),
+                "stage_calls": dict(self.request_metrics["stage_calls"]),
+                "files_downloaded": self.request_metrics["files_downloaded"],
+                "outcomes": dict(self.request_metrics["outcomes"]),
+            }
+        writer = self.disk_writer
+        snapshot["disk"] = writer.snapshot() if writer is not None else None
+        bucket = self.download_bandwidth
+        snapshot["bandwidth"] = {
+            "limit_bytes_per_second": bucket.rate, "wait_seconds": bucket.wait_seconds,
+        } if bucket is not None else None
+        download_bytes = endpoints.get("download", {}).get("bytes", 0)
+        download_seconds = snapshot["stage_seconds"]["download"]
+        snapshot["throughput"] = {
+            "files_per_second": snapshot["files_downloaded"] / wall if wall else 0.0,
+            "bytes_per_second": download_bytes / wall if wall else 0.0,
+            # Rate while the download stage was actually running, without scrape/API time
+            "download_stage_bytes_per_second": download_bytes / download_seconds if download_seconds else 0.0,
+        }
+        return snapshot
+
+    def write_metrics_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.metrics_snapshot(), f, indent=2)
+
+    def set_queue_depth(self, stage, depth):
+        with self.stats_lock:
+            self.request_metrics["queue_depth"][stage] = depth
+
+    def render_prometheus(self):
+        """Current counters and gauges in the Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP gelbooru_{name} {help_text}")
+            lines.append(f"# TYPE gelbooru_{name} {kind}")
+            for labels, value in samples:
+                label_str = "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}" if labels else ""
+                lines.append(f"gelbooru_{name}{label_str} {value}")
+
+        with self.api_call_lock:
+            delay = self.adaptive_delay
+        with self.workers_lock:
+            workers = self.current_max_workers
+        with self.cache_update_lock:
+            pending = {"posts": len(self.pending_posts_cache), "tags": len(self.pending_tag_cache)}
+        with self.rate_limited_lock:
+            rate_limited = len(self.rate_limited_posts)
+        disk = self.disk_writer.snapshot() if self.disk_writer is not None else None
+        bucket = self.download_bandwidth
+
+        with self.stats_lock:
+            s = self.rate_stats
+            m = self.request_metrics
+            metric("uptime_seconds", "gauge", "Seconds since the metrics were started",
+                   [({}, round(time.perf_counter() - m["started"], 3))])
+            metric("adaptive_delay_seconds", "gauge", "Current spacing between API requests",
+                   [({}, delay)])
+            metric("max_workers", "gauge", "Current worker limit of the adaptive controller",
+                   [({}, workers)])
+            metric("queue_depth", "gauge", "Items submitted to a stage and not finished yet",
+                   [({"stage": k}, v) for k, v in m["queue_depth"].items()]
+                   + [({"stage": "write"}, disk["queued"] if disk else 0)])
+            metric("pending_cache_writes", "gauge", "Buffered cache entries not yet flushed to disk",
+                   [({"cache": k}, v) for k, v in pending.items()])
+            metric("rate_limited_posts", "gauge", "Posts currently queued for retry after a 429",
+                   [({}, rate_limited)])
+            metric("post_outcomes_total", "counter", "Posts by download outcome",
+                   [({"outcome": k}, m["outcomes"].get(k, 0)) for k in POST_OUTCOMES])
+            metric("files_downloaded_total", "counter", "Image files written",
+                   [({}, m["files_downloaded"])])
+            metric("rate_limit_responses_total", "counter", "429 responses received",
+                   [({}, s["rate_limit_429s"])])
+            metric("retries_total", "counter", "Request retries", [({}, s["retries"])])
+            metric("cooldown_seconds_total", "counter", "Seconds spent in post-429 cooldown",
+                   [({}, round(s["cooldown_seconds"], 3))])
+            metric("throttle_waits_total", "counter", "Waits imposed by the request spacing gate",
+                   [({"endpoint": k}, v) for k, v in s["waits_by_endpoint"].items()])
+            metric("throttle_wait_seconds_total", "counter", "Seconds spent waiting at the spacing gate",
+                   [({"endpoint": k}, round(v, 3)) for k, v in s["wait_seconds_by_endpoint"].items()])
+            metric("stage_seconds_total", "counter", "Wall time spent in each stage",
+                   [({"stage": k}, round(v, 3)) for k, v in m["stage_seconds"].items()])
+            if bucket is not None:
+                metric("download_bandwidth_limit_bytes", "gauge", "Global cap on image bytes per second",
+                       [({}, bucket.rate)])
+                metric("download_bandwidth_wait_seconds_total", "counter", "Seconds downloads slept to stay under the cap",
+                       [({}, round(bucket.wait_seconds, 3))])
+            if disk:
+                metric("disk_write_bytes_total", "counter", "Bytes written by the disk writer",
+                       [({}, disk["bytes"])])
+                metric("disk_write_errors_total", "counter", "Files the disk writer could not write",
+                       [({}, disk["errors"])])
+                metric("disk_write_seconds_total", "counter", "Seconds the disk writer spent writing, fsyncing and renaming",
+                       [({}, round(disk["write_seconds"], 3))])
+                metric("disk_fsyncs_total", "counter", "fsync calls on downloaded files and their directories",
+                       [({}, disk["fsyncs"])])
+                metric("disk_queue_blocked_seconds_total", "counter", "Seconds downloaders waited on a full disk write queue",
+                       [({}, round(disk["blocked_seconds"], 3))])
+
+            endpoints = m["endpoints"]
+            metric("requests_total", "counter", "HTTP requests sent",
+                   [({"endpoint": k}, ep["requests"]) for k, ep in endpoints.items()])
+            metric("request_errors_total", "counter", "Requests that failed or returned >= 400",
+                   [({"endpoint": k}, ep["errors"]) for k, ep in endpoints.items()])
+            metric("response_bytes_total", "counter", "Response body bytes received",
+                   [({"endpoint": k}, ep["bytes"]) for k, ep in endpoints.items()])
+
+            lines.append("# HELP gelbooru_request_duration_seconds Whole-request latency")
+            lines.append("# TYPE gelbooru_request_duration_seconds histogram")
+            for name, ep in endpoints.items():
+                hist = ep["latency"]
+                cumulative = 0
+                for i, bound in enumerate(LATENCY_BUCKETS):
+                    cumulative += hist.counts[i]
+                    if i % PROMETHEUS_BUCKET_STRIDE == 0:
+                        lines.append(f'gelbooru_request_duration_seconds_bucket{{endpoint="{name}",le="{bound:.4g}"}} {cumulative}')
+                lines.append(f'gelbooru_request_duration_seconds_bucket{{endpoint="{name}",le="+Inf"}} {hist.count}')
+                lines.append(f'gelbooru_request_duration_seconds_sum{{endpoint="{name}"}} {hist.total:.6f}')
+                lines.append(f'gelbooru_request_duration_seconds_count{{endpoint="{name}"}} {hist.count}')
+
+            for part, help_text in (("ttfb", "Time to first byte"), ("transfer", "Body transfer time")):
+                lines.append(f"# HELP gelbooru_request_{part}_seconds {help_text}")
+                lines.append(f"# TYPE gelbooru_request_{part}_seconds summary")
+                for name, ep in endpoints.items():
+                    hist = ep[part]
+                    for q in (50, 95, 99):
+                        lines.append(
+                            f'gelbooru_request_{part}_seconds{{endpoint="{name}",quantile="{q / 100}"}} '
+                            f"{hist.percentile(q):.6f}"
+                        )
+                    lines.append(f'gelbooru_request_{part}_seconds_sum{{endpoint="{name}"}} {hist.total:.6f}')
+                    lines.append(f'gelbooru_request_{part}_seconds_count{{endpoint="{name}"}} {hist.count}')
+
+        return "\n".join(lines) + "\n"
+
+    def start_metrics_server(self, port, host="127.0.0.1"):
+        """Serve /metrics on a daemon thread; work happens only when it is scraped"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        engine = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = engine.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes every few seconds would drown the progress output
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        print(c_dim(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics"))
+        self.metrics_server = server
+        return server
+
+    def start_profiler(self, prefix):
+        self.profile_prefix = prefix
+        self.profiler = SamplingProfiler()
+        self.profiler.start(self)
+        print(c_dim(f"Profiling; report goes to {prefix}.txt and {prefix}.folded"))
+
+    def stop_profiler(self):
+        """Stop sampling, restore the plain locks and write and print the report; no-op if not profiling"""
+        if self.profiler is None:
+            return
+        active, self.profiler = self.profiler, None
+        active.stop()
+        print(c_header("\n" + "=" * 60))
+        print(c_header("  Profile"))
+        print(c_header("=" * 60))
+        print(active.write(self.profile_prefix))
+
+    # Logging functions
+    def log_message(self, message, log_file="log.txt"):
+        print(message)
+        if self.log_to_file:
+            log_file_writer(log_file).write(message)
+
+    def debug_log(self, message):
+        """Emit verbose rate-limit telemetry, prefixed with time and thread. Gated on --debug."""
+        if not self.debug_enabled:
+            return
+        now = time.time()
+        timestamp = time.strftime("%H:%M:%S", time.localtime(now)) + f".{int((now % 1) * 1000):03d}"
+        line = f"[DEBUG {timestamp} {threading.current_thread().name}] {message}"
+        print(c_dim(line), flush=True)
+        if self.log_to_file:
+            log_file_writer("debug_log.txt").write(line)
+
+    def open_trace(self, path):
+        """Start writing one JSON record per request, 429 and stage to path (--trace)"""
+        self.trace_writer = BufferedLineWriter(path)
+
+    def record_manifest(self, event, file_path, post=None, **fields):
+        """Queue one change manifest entry (see MANIFEST_EVENTS); a no-op with manifest_file off"""
+        if not self.manifest_file:
+            return
+        entry = {
+            "ts": round(time.time(), 3),
+            "event": event,
+            "post_id": str(post["id"]) if post else None,
+            "md5": post.get("md5") if post else fields.pop("md5", None),
+            "path": os.path.abspath(file_path),
+        }
+        if event != "failed":
+            try:
+                entry["size"] = os.path.getsize(file_path)
+            except OSError:
+                entry["size"] = None
+        entry.update(fields)
+        with self._manifest_writer_lock:
+            if self.manifest_writer is None:
+                self.manifest_writer = BufferedLineWriter(self.manifest_file)
+            self.manifest_writer.write(json.dumps(entry))
+
+    def print_manifest_changes(self, cursor):
+        """Print the manifest entries after cursor as JSON lines, each with the cursor to resume from (--changes).
+
+        Raises ValueError if no manifest is kept or cursor is not on an entry boundary.
+        """
+        if not self.manifest_file:
+            raise ValueError("cache.manifest_file is empty, so no change manifest is kept")
+        for next_cursor, entry in read_manifest(self.manifest_file, cursor):
+            entry["cursor"] = next_cursor
+            print(json.dumps(entry))
+
+    def trace_event(self, kind, **fields):
+        """Queue one trace record; a no-op unless --trace is on"""
+        writer = self.trace_writer
+        if writer is None:
+            return
+        record = {"ts": fields.pop("ts", None) or time.time(), "kind": kind, "thread": threading.current_thread().name}
+        record.update(fields)
+        writer.write(json.dumps(record))
+
+    def countdown_sleep(self, seconds, reason="Waiting", show_done=True):
+        """Sleep with a visible countdown timer so users know the script is still working."""
+        total = int(seconds)
+        if total >= 1:
+            # Several workers can be cooling down at once; each gets its own progress slot.
+            slot = f"countdown-{threading.get_ident()}"
+            for remaining in range(total, 0, -1):
+                if self.stopping():
+                    break
+                set_progress(slot, f"{reason}: {remaining}s remaining...")
+                self.clock.sleep(1)
+            clear_progress(slot, f"{reason}: Done." if show_done and not self.stopping() else None)
+        # Sleep any fractional remainder (or full time if < 1 second)
+        remainder = seconds - total if total >= 1 else seconds
+        if remainder > 0 and not self.stopping():
+            self.clock.sleep(remainder)
+
+    # Login function
+    def login(self, username=None, password=None):
+        """Log in and return the session; defaults to the active credentials. Raises LoginError on failure."""
+        import requests
+
+        LOGIN_SUCCESS_MARKER = ">Logout</a>"
+        session = self.new_session()
+        login_url = f"{self.site_url}/index.php?page=account&s=login&code=00"
+        login_data = {
+            "user": username or self.username,
+            "pass": password or self.password,
+            "submit": "Log in",
+        }
+
+        try:
+            response = session.post(login_url, data=login_data, timeout=30)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            raise LoginError(f"Could not reach Gelbooru to log in: {e}") from e
+
+        if LOGIN_SUCCESS_MARKER not in response.text:
+            self.log_message(f"Login response (first 200 chars): {response.text[:200]}")
+            raise LoginError("Login failed: check GELBOORU_USERNAME / GELBOORU_PASSWORD in .env")
+
+        return session
+
+    @timed_stage("scrape")
+    def get_favorite_post_ids(self, session, pid):
+        """Scrape one page of favourite post ids starting at offset pid.
+
+        Returns a list of post id strings (empty when the page is past the last
+        favourite), or the FETCH_FAILED sentinel if the page could not be retrieved
+        after all retries. The empty-list and FETCH_FAILED cases are kept distinct so
+        a transient failure is not mistaken for the end of the favourites.
+        """
+        import requests
+
+        self.rate_limit_api_call("favourites")
+        url = f"{self.site_url}/index.php?page=favorites&s=view&id={self.user_id}&pid={pid}"
+        max_retries = 5
+        base_delay = 5
+
+        for i in range(max_retries):
+            try:
+                response = self.timed_get("favourites", session.get, url, trace={"pid": pid, "attempt": i}, timeout=30)
+                if response.status_code == 429:
+                    self.handle_rate_limit_response("favourites")
+                    raise requests.exceptions.RequestException("Too Many Requests")
+
+                response.raise_for_status()
+
+                thumbnails = parse_favourite_thumbnails(response.text)
+                self.thumbnail_titles = dict(thumbnails)
+                post_ids = [post_id for post_id, _ in thumbnails]
+                self.reset_adaptive_delay()
+                self.debug_log(f"[favourites pid={pid}] fetched {len(post_ids)} post ids on attempt {i + 1}")
+                if i > 0:
+                    self.log_message(
+                        f"Successfully retrieved favourite page pid={pid} after {i + 1} attempts"
+                    )
+                return post_ids
+
+            except requests.exceptions.RequestException as e:
+                # A 429 was already handled above, before it was raised.
+                if self.stopping():
+                    return FETCH_FAILED
+                if i < max_retries - 1:
+                    delay = base_delay * (2**i)
+                    with self.stats_lock:
+                        self.rate_stats["retries"] += 1
+                    self.debug_log(f"[favourites pid={pid}] retry {i + 1}/{max_retries} in {delay}s: {str(e)[:60]}")
+                    self.log_message(
+                        f"Favourite page pid={pid}: {e!s}. Retrying after {delay}s (attempt {i + 1}/{max_retries})"
+                    )
+                    self.countdown_sleep(delay, f"Retry backoff for favourite page pid={pid}")
+                else:
+                    self.debug_log(f"[favourites pid={pid}] gave up after {max_retries} attempts: {str(e)[:60]}")
+                    self.log_message(
+                        f"Failed to get favourite page pid={pid} after {max_retries} attempts: {e!s}"
+                    )
+                    return FETCH_FAILED
+
+        # Defensive: only reachable if max_retries ever becomes 0 or negative.
+        return FETCH_FAILED
+
+    def get_post_details(self, post_id):
+        """Fetch a post's details from the API.
+
+        Returns the string "SKIP" if the post is already in the posts cache, a
+        single-element list holding the post dict on success, the POST_MISSING
+        sentinel if the API no longer returns the post (deleted or hidden), or None
+        if it could not be fetched after all retries. POST_MISSING and None are kept
+        distinct so a deleted favourite is not counted as a fetch failure. During the
+        priority pass there are no in-request retries, and a 429 returns POST_DEFERRED
+        with the post left in the rate-limited queue.
+        """
+        import requests
+
+        posts_cache = self.load_posts_cache()
+
+        if post_id in posts_cache:
+            return "SKIP"
+
+        self.rate_limit_api_call("detail")
+        if self.priority_budget_spent():
+            # Another worker's 429 spent the budget while this one waited for its slot.
+            return POST_DEFERRED
+        url = f"{self.site_url}/index.php?page=dapi&s=post&q=index&id={post_id}&json=1&api_key={self.api_key}&user_id={self.user_id}"
+        max_retries = 1 if self.priority_429_limit is not None else 5
+        base_delay = 5  # Increased base delay for rate limiting
+
+        for i in range(max_retries):
+            try:
+                response = self.timed_get("detail", self.get_api_session().get, url, trace={"post_id": post_id, "attempt": i}, timeout=30)
+                if response.status_code == 429:
+                    self.handle_rate_limit_response("detail")
+                    self.add_rate_limited_post(post_id)  # Track rate-limited post
+                    raise requests.exceptions.RequestException("Too Many Requests")
+
+                response.raise_for_status()
+
+                data = json.loads(response.text)
+                if "post" in data:
+                    post = data["post"]
+                    self.reset_adaptive_delay()  # Success, so we can reduce delay if it was increased
+                    if i > 0:  # If this was a retry attempt
+                        self.log_message(
+                            f"Successfully retrieved post {post_id} after {i+1} attempts"
+                        )
+                    self.remove_rate_limited_post(post_id)  # Remove from tracking if successful
+                    return post if isinstance(post, list) else [post]
+                else:
+                    self.reset_adaptive_delay()  # Success, so we can reduce delay if it was increased
+                    self.remove_rate_limited_post(
+                        post_id
+                    )  # Remove from tracking if request completed
+                    self.debug_log(f"post {post_id} is no longer returned by the API (deleted or hidden)")
+                    return POST_MISSING
+
+            except requests.exceptions.RequestException as e:
+                # A 429 was already handled and the post tracked above, before it was raised.
+                if "Too Many Requests" in str(e):
+                    self.log_message(
+                        f"Rate limit hit for post {post_id:<8} - Attempt {i + 1}/{max_retries}"
+                    )
+                    if self.priority_429_limit is not None:
+                        return POST_DEFERRED
+
+                if self.stopping():
+                    # Not a failure of the post: the next run fetches it again.
+                    return None
+                if i < max_retries - 1:
+                    delay = base_delay * (2**i)  # Exponential backoff
+                    with self.stats_lock:
+                        self.rate_stats["retries"] += 1
+                    self.debug_log(f"[post {post_id}] retry {i + 1}/{max_retries} in {delay}s: {str(e)[:60]}")
+                    self.log_message(
+                        f"Post {post_id:<8}: {e!s}. Retrying after {delay}s (attempt {i + 1}/{max_retries})"
+                    )
+                    self.countdown_sleep(delay, f"Retry backoff for post {post_id}")
+                else:
+                    self.log_message(
+                        f"Failed to get post {post_id:<8} after {max_retries} attempts: {e!s}"
+                    )
+                    # Save the post ID to the cache when it exceeds max retries
+                    with self.failed_cache_lock:
+                        failed_posts_cache = self.load_failed_posts_cache()
+                        failed_posts_cache[str(post_id)] = {"error": str(e)[:100], "type": "api"}
+                        self.save_failed_posts_cache(failed_posts_cache)
+                    self.remove_rate_limited_post(
+                        post_id
+                    )  # Remove from tracking after max retries
+                    return None
+
+    def new_session(self):
+        """A requests session, going through the engine's transport adapter when it has one"""
+        import requests
+
+        session = requests.Session()
+        if self.transport is not None:
+            session.mount("http://", self.transport)
+            session.mount("https://", self.transport)
+        return session
+
+    def get_api_session(self):
+        with self._download_session_lock:
+            if self.api_session is None:
+                self.api_session = self.new_session()
+            return self.api_session
+
+    def get_download_session(self):
+        with self._download_session_lock:
+            if self.download_session is None:
+                session = self.new_session()
+                session.headers.update(
+                    {
+                        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+                        # The image host's hotlink protection serves the HTML post page, not the bytes, without this.
+                        "Referer": f"{self.site_url}/",
+                    }
+                )
+                self.download_session = session
+            return self.download_session
+
+    def get_disk_writer(self):
+        with self._disk_writer_lock:
+            if self.disk_writer is None:
+                self.disk_writer = DiskWriter(self.disk_writers, self.disk_queue_size, self.fsync_batch)
+            return self.disk_writer
+
+    def fetch_image(self, url, **kwargs):
+        """GET an image, reading the body through the bandwidth cap when one is set.
+
+        Under the cap the result is a CappedResponse. Error statuses and HTML pages
+        are returned as they came, without spending the cap on their bodies. The
+        seconds slept for the cap are added to the thread's bandwidth_wait, which
+        timed_get keeps out of the request's latency.
+        """
+        session = self.get_download_session()
+        bucket = self.download_bandwidth
+        if bucket is None:
+            return session.get(url, **kwargs)
+        response = session.get(url, stream=True, **kwargs)
+        # download_image retries or rejects these; only image bytes count against the cap.
+        if response.status_code >= 400 or response.headers.get("Content-Type", "").startswith("text/html"):
+            return response
+        context = self._request_context
+        chunks = []
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+            context.bandwidth_wait = getattr(context, "bandwidth_wait", 0.0) + bucket.consume(len(chunk))
+            chunks.append(chunk)
+        return CappedResponse(response, b"".join(chunks))
+
+    def download_image(self, url):
+        """Fetch an image and return its bytes; process_post hands them to the disk writer"""
+        max_retries = 3
+        base_delay = 2
+
+        for attempt in range(max_retries):
+            self.rate_limit_api_call("download")
+            try:
+                response = self.timed_get(
+                    "download", self.fetch_image, url, trace={"url": url, "attempt": attempt}, timeout=30
+                )
+
+                # Check 429 before raise_for_status so it routes to backoff, not a generic HTTPError.
+                if response.status_code == 429:
+                    self.handle_rate_limit_response("download")
+                    if attempt < max_retries - 1:
+                        with self.stats_lock:
+                            self.rate_stats["retries"] += 1
+                        continue
+
+                response.raise_for_status()
+                # Hotlink protection and some CDN errors answer 200 with a web page.
+                if response.headers.get("Content-Type", "").startswith("text/html"):
+                    raise ValueError("got an HTML page instead of the image")
+            except Exception as e:
+                if attempt < max_retries - 1 and is_retryable_download_error(e) and not self.stopping():
+                    delay = base_delay * (2**attempt)
+                    with self.stats_lock:
+                        self.rate_stats["retries"] += 1
+                    self.debug_log(
+                        f"download retry {attempt + 1}/{max_retries} in {delay}s: {str(e)[:60]}"
+                    )
+                    # Silent sleep, not countdown_sleep: this runs on a worker thread under the progress bar.
+                    self.clock.sleep(delay)
+                    continue
+                raise Exception(f"Error downloading image: {e!s}") from e
+
+            self.reset_adaptive_delay()
+            return response.content
+
+    def build_destination_dir(self, character_tags, copyright_tag, sensitivity) -> str:
+        """Return the destination directory for a post. Callers create it themselves."""
+        base_folder_name, specific_folder_name = get_folder_name(
+            character_tags, copyright_tag
+        )
+        base_folder_name = sanitize_for_path(base_folder_name)
+
+        if specific_folder_name:
+            specific_folder_name = sanitize_for_path(specific_folder_name)
+            return os.path.join(
+                self.base_dir, base_folder_name, specific_folder_name, sensitivity
+            )
+        return os.path.join(self.base_dir, base_folder_name, sensitivity)
+
+    def destination_path(self, directory, file_name):
+        """Full path of an image in a build_destination_dir folder, below any fan-out sub-folders"""
+        return os.path.join(directory, *fanout_subdirs(file_name, self.fanout_levels), file_name)
+
+    # Optimized batch operations
+    @timed_stage("flush")
+    def flush_cache_buffers(self, lock_timeout=None):
+        """Flush pending cache updates to disk.
+
+        With lock_timeout, gives up if cache_update_lock isn't free within that many
+        seconds. Returns whether the buffers were flushed.
+        """
+        if not self.cache_update_lock.acquire(timeout=-1 if lock_timeout is None else lock_timeout):
+            return False
+        try:
+            if self.pending_posts_cache and self.shard_db_path:
+                self.commit_shard_posts(list(self.pending_posts_cache))
+                self.pending_posts_cache.clear()
+            elif self.pending_posts_cache:
+                posts_cache = self.load_posts_cache()
+                posts_cache.update(self.pending_posts_cache)
+                self.save_posts_cache(posts_cache)
+                self.pending_posts_cache.clear()
+
+            if self.pending_tag_cache:
+                tag_cache = self.load_cache()
+                tag_cache.update(self.pending_tag_cache)
+                self.save_cache(tag_cache)
+                self.update_tag_type_index(self.pending_tag_cache)
+                self.pending_tag_cache.clear()
+
+            if self.pending_content_index:
+                content_index = self.load_content_index()
+                content_index.update(self.pending_content_index)
+                self.save_content_index(content_index)
+                self.pending_content_index.clear()
+        finally:
+            self.cache_update_lock.release()
+
+        self.save_rate_limit_state()
+        return True
+
+    def flush_if_buffers_full(self):
+        """Flush now if a pending cache buffer has reached cache.flush_entries"""
+        if not self.flush_entries:
+            return
+        with self.cache_update_lock:
+            largest = max(len(self.pending_posts_cache), len(self.pending_tag_cache), len(self.pending_content_index))
+        if largest >= self.flush_entries:
+            self.flush_cache_buffers()
+
+    @timed_stage("detail")
+    def fetch_post_details_parallel(self, post_ids):
+        """Fetch details for post_ids in parallel with a progress bar.
+
+        Returns (posts, cached_ids, missing_ids, failed_ids): the post dicts that still
+        need downloading, then the ids already in posts_cache, no longer returned by the
+        API, and that could not be fetched. Ids in none of them were not fetched because
+        of stop() or the priority pass's 429 budget, and stay queued.
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        posts = []
+        missing_ids = []
+        failed_ids = []
+
+        # Cached posts need no request, so don't spend a staggered worker slot on them.
+        posts_cache = self.load_posts_cache()
+        cached_ids = [post_id for post_id in post_ids if post_id in posts_cache]
+        post_ids = [post_id for post_id in post_ids if post_id not in posts_cache]
+        if not post_ids:
+            print(c_dim(f"All {len(cached_ids)} posts already cached"))
+            return posts, cached_ids, missing_ids, failed_ids
+
+        total_posts = len(post_ids)
+        print(c_info("Fetching post details..."))
+        worker_count = self.endpoint_worker_count("detail")
+        self.set_queue_depth("detail", total_posts)
+        with ThreadPoolExecutor(max_workers=worker_count) as executor:
+            # Submit all post detail fetching tasks with staggered delays
+            future_to_post_id = {}
+            for i, post_id in enumerate(post_ids):
+                # Add small staggered delay to prevent simultaneous API hits
+                if i > 0:
+                    self.clock.sleep(0.1)  # 100ms delay between task submissions
+                if self.stopping() or self.priority_budget_spent():
+                    break
+                future_to_post_id[executor.submit(self.get_post_details, post_id)] = post_id
+
+            completed_count = 0
+            progress_line = None
+
+            for future in as_completed(future_to_post_id):
+                if self.stopping() or self.priority_budget_spent():
+                    cancel_pending(future_to_post_id)
+                post_id = future_to_post_id[future]
+                completed_count += 1
+                self.set_queue_depth("detail", total_posts - completed_count)
+                if future.cancelled():
+                    continue
+                try:
+                    post_details = future.result()
+                    # POST_MISSING is checked first: it is truthy and not subscriptable.
+                    if post_details is POST_MISSING:
+                        missing_ids.append(post_id)
+                    elif post_details is POST_DEFERRED:
+                        pass
+                    elif post_details == "SKIP":
+                        cached_ids.append(post_id)
+                    elif post_details and post_details[0]:
+                        posts.append(post_details[0])
+                    else:
+                        failed_ids.append(post_id)
+                except Exception as e:
+                    if "Too Many Requests" not in str(e):
+                        failed_ids.append(post_id)
+
+                # Update progress bar with colours
+                progress = int((completed_count / total_posts) * 20)
+                bar_done = Fore.GREEN + "=" * progress
+                bar_remaining = Fore.WHITE + "-" * (20 - progress)
+                bar = bar_done + bar_remaining + Style.RESET_ALL
+
+                new_count = c_success(f"new: {len(posts)}")
+                cached_str = c_dim(f"cached: {len(cached_ids)}") if cached_ids else ""
+                missing_str = c_warning(f"missing: {len(missing_ids)}") if missing_ids else ""
+                failed_str = c_error(f"failed: {len(failed_ids)}") if failed_ids else ""
+                status_parts = [s for s in [new_count, cached_str, missing_str, failed_str] if s]
+                status = ", ".join(status_parts)
+
+                progress_line = f"  [{bar}] {completed_count}/{total_posts} ({status})"
+                set_progress("detail", progress_line)
+
+            clear_progress("detail", progress_line)
+
+        return posts, cached_ids, missing_ids, failed_ids
+
+    def fetch_tags_for_posts(self, posts):
+        """Batch fetch tag details for every unique tag across posts"""
+        print(c_info("Processing tags..."))
+        all_tags = set()
+        for post in posts:
+            all_tags.update(post["tags"].split())
+        print(f"Found {len(all_tags)} unique tags to process...")
+
+        self.batch_fetch_tag_details(list(all_tags))
+
+    def download_next_post(self, downloads):
+        """Pool task: download whichever post the DownloadQueue hands out next; returns (post, outcome)"""
+        post, large = downloads.take()
+        try:
+            return post, self.process_post(post)
+        except Exception as e:
+            self.log_message(f"Error processing post: {e!s}")
+            return post, POST_DOWNLOAD_FAILED
+        finally:
+            downloads.done(large)
+
+    @timed_stage("download")
+    def download_posts_parallel(self, posts):
+        """Download posts in parallel, returning {post_id: outcome} with one of POST_OUTCOMES per post.
+
+        Workers take small files smallest first while large ones run alongside them
+        (see DownloadQueue). After stop(), downloads that have not started are
+        checkpointed instead, and have no entry in the result.
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        outcomes = {}
+        self.set_queue_depth("download", len(posts))
+        worker_count = min(self.endpoint_worker_count("download"), self.download_workers)
+        downloads = DownloadQueue(posts, self.large_file_bytes, min(self.large_file_workers, worker_count - 1))
+        with ThreadPoolExecutor(max_workers=worker_count) as executor:
+            # One task per post; each takes the next post from the queue when it starts.
+            futures = [executor.submit(self.download_next_post, downloads) for _ in posts]
+
+            for future in as_completed(futures):
+                if self.stopping():
+                    cancel_pending(futures)
+                if future.cancelled():
+                    continue
+                post, outcome = future.result()
+                outcomes[str(post["id"])] = outcome
+                with self.stats_lock:
+                    self.request_metrics["queue_depth"]["download"] = len(posts) - len(outcomes)
+                    self.request_metrics["outcomes"][outcome] = self.request_metrics["outcomes"].get(outcome, 0) + 1
+
+        # A download only counts once the disk writer has put its file in place.
+        if self.disk_writer is not None:
+            self.disk_writer.drain()
+        with self.cache_update_lock:
+            write_failed = self.write_failed_ids & outcomes.keys()
+            self.write_failed_ids -= write_failed
+        if write_failed:
+            with self.stats_lock:
+                counts = self.request_metrics["outcomes"]
+                for post_id in write_failed:
+                    counts[outcomes[post_id]] -= 1
+                    counts[POST_DOWNLOAD_FAILED] = counts.get(POST_DOWNLOAD_FAILED, 0) + 1
+                    outcomes[post_id] = POST_DOWNLOAD_FAILED
+
+        self.checkpoint_interrupted(downloads.remaining())
+        return outcomes
+
+    def checkpoint_interrupted(self, posts):
+        """Queue posts fetched but not downloaded before stop() for the next run.
+
+        They go into the failed cache with their metadata, so the priority pass (or
+        --retry-failed) downloads them first, without another detail call.
+        """
+        if not posts:
+            return
+        with self.failed_cache_lock:
+            failed_cache = self.load_failed_posts_cache()
+            for post in posts:
+                failed_cache[str(post["id"])] = {
+                    "error": "Interrupted before download",
+                    "type": "interrupted",
+                    "post": failed_post_metadata(post),
+                }
+            self.save_failed_posts_cache(failed_cache)
+        self.log_message(f"Checkpointed {len(posts)} posts interrupted before download")
+
+    def batch_process_posts(self, post_ids):
+        """Process multiple posts in parallel, returning a count per POST_OUTCOMES key"""
+        download_results = dict.fromkeys(POST_OUTCOMES, 0)
+
+        # The filters go first on the thumbnail titles (no request needed), then on the
+        # post JSON, so a skipped post never costs a tag lookup or a download.
+        post_ids, skipped_ids = self.filter_thumbnails(post_ids)
+        posts_to_process, _, _, _ = self.fetch_post_details_parallel(post_ids)
+        posts_to_process, skipped_posts = self.filter_posts(posts_to_process)
+        download_results[POST_SKIPPED] = len(skipped_ids) + len(skipped_posts)
+        if not posts_to_process:
+            return download_results
+
+        if not self.stopping():
+            self.fetch_tags_for_posts(posts_to_process)
+
+        if self.stopping():
+            self.checkpoint_interrupted(posts_to_process)
         else:
-            return ("Multiple", None)
+            for outcome in self.download_posts_parallel(posts_to_process).values():
+                download_results[outcome] += 1
 
+        # Flush cache updates
+        self.flush_cache_buffers()
+        return download_results
 
-def rate_limit_api_call(endpoint="api"):
-    """Ensure we don't make API calls too frequently"""
-    global last_api_call_time, adaptive_delay
+    def filter_thumbnails(self, post_ids):
+        """Split post_ids by the filters, judging each by its favourites-page thumbnail title.
+
+        Returns (kept_ids, skipped_ids). Posts an earlier run skipped on their post
+        JSON under the same filters are skipped again. Posts already in posts_cache,
+        and posts with no thumbnail title on hand, are kept; the post JSON check
+        catches the rest.
+        """
+        if not self.post_filter.active:
+            return post_ids, []
+        posts_cache = self.load_posts_cache()
+        recorded = self.get_skipped_posts()
+        kept_ids = []
+        skipped_ids = []
+        for post_id in post_ids:
+            title = self.thumbnail_titles.get(post_id)
+            reason = None
+            if post_id in posts_cache:
+                pass
+            elif post_id in recorded:
+                reason = "skipped by an earlier run"
+            elif title:
+                reason = self.post_filter.skip_reason(parse_thumbnail_title(title))
+            if reason:
+                self.debug_log(f"[filter] skipped post {post_id} before its details: {reason}")
+                skipped_ids.append(post_id)
+            else:
+                kept_ids.append(post_id)
+        self.count_skipped(len(skipped_ids))
+        return kept_ids, skipped_ids
+
+    def filter_posts(self, posts):
+        """Split post dicts by the filters before their tags are resolved.
+
+        Returns (kept_posts, skipped_ids). The skipped ids are recorded in
+        skipped_posts_file, so the next run doesn't fetch their details again.
+        """
+        if not self.post_filter.active:
+            return posts, []
+        kept_posts = []
+        skipped_ids = []
+        for post in posts:
+            reason = self.post_filter.skip_reason(post)
+            if reason:
+                self.debug_log(f"[filter] skipped post {post['id']}: {reason}")
+                skipped_ids.append(str(post["id"]))
+            else:
+                kept_posts.append(post)
+        self.count_skipped(len(skipped_ids))
+        self.record_skipped_posts(skipped_ids)
+        return kept_posts, skipped_ids
+
+    def count_skipped(self, count):
+        if count:
+            with self.stats_lock:
+                outcomes = self.request_metrics["outcomes"]
+                outcomes[POST_SKIPPED] = outcomes.get(POST_SKIPPED, 0) + count
+
+    @timed_stage("tag")
+    def batch_fetch_tag_details(self, tags):
+        """Fetch tag details in parallel batches"""
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        cache = self.load_cache()
+        tags_to_fetch = [
+            tag for tag in tags if tag not in cache and tag not in self.pending_tag_cache
+        ]
+
+        if not tags_to_fetch:
+            return
+
+        # Process tags in batches to avoid overwhelming the API
+        total_tags = len(tags_to_fetch)
+        print(c_info(f"Fetching {total_tags} new tag details..."))
+        tags_completed = 0
+        progress_line = None
+        self.set_queue_depth("tag", total_tags)
+
+        for i in range(0, total_tags, self.tag_batch_size):
+            if self.stopping():
+                break
+            batch = tags_to_fetch[i : i + self.tag_batch_size]
+
+            worker_count = self.endpoint_worker_count("tag")
+            with ThreadPoolExecutor(max_workers=min(len(batch), worker_count)) as executor:
+                future_to_tag = {
+                    executor.submit(self.get_tag_details_single, tag): tag for tag in batch
+                }
+
+                for future in as_completed(future_to_tag):
+                    if self.stopping():
+                        cancel_pending(future_to_tag)
+                    tag = future_to_tag[future]
+                    tags_completed += 1
+                    self.set_queue_depth("tag", total_tags - tags_completed)
+                    if future.cancelled():
+                        continue
+                    try:
+                        tag_details = future.result()
+                        if tag_details:
+                            with self.cache_update_lock:
+                                self.pending_tag_cache[tag] = tag_details
+                    except Exception:
+                        pass  # Silently skip tag errors
+
+                    # Update progress bar with colours
+                    progress = int((tags_completed / total_tags) * 20)
+                    bar_done = Fore.CYAN + "=" * progress
+                    bar_remaining = Fore.WHITE + "-" * (20 - progress)
+                    bar = bar_done + bar_remaining + Style.RESET_ALL
+                    progress_line = f"  [{bar}] {tags_completed}/{total_tags} tags"
+                    set_progress("tag", progress_line)
+
+            self.flush_if_buffers_full()
+            # Small delay between batches to respect rate limits
+            self.clock.sleep(0.5)
+
+        clear_progress("tag", progress_line)
+
+    def get_tag_details_single(self, tag):
+        """Fetch single tag details without caching logic"""
+        import requests
+
+        self.rate_limit_api_call("tag")
+
+        modified_tag = (
+            tag.replace("&#039;", "'")
+            .replace("&gt;", ">")
+            .replace("&lt;", "<")
+            .replace("&quot;", '"')
+            .replace("&amp;", "&")
+        )
+        encoded_tag = quote(modified_tag)
+        url = f"{self.site_url}/index.php?page=dapi&s=tag&q=index&json=1&name={encoded_tag}&api_key={self.api_key}&user_id={self.user_id}"
 
-    with api_call_lock:
-        current_time = time.time()
-        earliest_allowed = last_api_call_time + adaptive_delay
+        max_retries = 3  # Reduced retries for batch operations
+        base_delay = 2
+
+        for i in range(max_retries):
+            try:
+                response = self.timed_get("tag", self.get_api_session().get, url, trace={"tag": tag, "attempt": i}, timeout=10)
 
-        if current_time >= earliest_allowed:
-            sleep_time = 0
-            last_api_call_time = current_time
+                # Check 429 before raise_for_status so it routes to backoff, not a generic HTTPError.
+                if response.status_code == 429:
+                    self.handle_rate_limit_response("tag")
+                    raise requests.exceptions.RequestException("HTTP 429 rate limited")
+
+                response.raise_for_status()
+
+                data = json.loads(response.text)
+                if data and "tag" in data and data["tag"]:
+                    self.reset_adaptive_delay()
+                    tag_data = data["tag"][0]
+                    tag_data["name"] = html.unescape(tag_data["name"])
+                    return tag_data
+                else:
+                    self.reset_adaptive_delay()
+                    return None
+
+            except requests.exceptions.RequestException as e:
+                # A 429 was already handled above, before it was raised.
+                if i < max_retries - 1:
+                    delay = base_delay * (2**i)
+                    with self.stats_lock:
+                        self.rate_stats["retries"] += 1
+                    self.debug_log(f"[tag {tag}] retry {i + 1}/{max_retries} in {delay}s: {str(e)[:60]}")
+                    self.clock.sleep(delay)
+                else:
+                    self.debug_log(f"[tag {tag}] gave up after {max_retries} attempts: {str(e)[:60]}")
+                    return None
+
+        # Defensive: only reachable if max_retries ever becomes 0 or negative.
+        return None
+
+    def process_post(self, post):
+        """Process post with buffered cache updates, returning one of POST_OUTCOMES"""
+        # str so the id matches posts_cache keys, which JSON always stores as strings.
+        post_id = str(post["id"])
+
+        # Safety check in case this function is called directly
+        # Normally cached posts are filtered out earlier in batch_process_posts
+        posts_cache = self.load_posts_cache()
+        with self.cache_update_lock:
+            if post_id in posts_cache or post_id in self.pending_posts_cache:
+                self.log_message(f"Post {post_id:<8} found in cache during processing, skipping")
+                return POST_ALREADY_CACHED
+
+        file_url, file_name = resolve_download_url(post)
+        sensitivity = get_sensitivity(post)
+
+        character_tags = self.get_character_tags(post["tags"])
+        copyright_tag = self.get_copyright_tag(post["tags"])
+
+        path = self.build_destination_dir(character_tags, copyright_tag, sensitivity)
+
+        file_path = self.destination_path(path, file_name)
+
+        if not os.path.exists(file_path):
+            try:
+                if self.link_indexed_content(post.get("md5"), file_path):
+                    outcome = POST_LINKED
+                    print(f"  {c_success('=')} {c_dim(file_name[:45])} {c_dim('post')} {post_id}")
+                    with self.cache_update_lock:
+                        self.pending_posts_cache[post_id] = True
+                    self.record_content(post.get("md5"), file_path)
+                    self.record_manifest("linked", file_path, post)
+                    self.flush_if_buffers_full()
+                else:
+                    data = self.download_image(file_url)
+                    # The post is only cached once the disk writer has the file in place.
+                    self.get_disk_writer().submit(file_path, data, functools.partial(self.file_written, post, file_path))
+                    outcome = POST_DOWNLOADED
+                    # Format download message with colour
+                    print(f"  {c_success('+')} {c_dim(file_name[:45])} {c_dim('post')} {post_id}")
+            except Exception as e:
+                outcome = POST_DOWNLOAD_FAILED
+                self.record_download_failure(post, file_path, e)
         else:
-            sleep_time = earliest_allowed - current_time
-            last_api_call_time = earliest_allowed
-        delay_snapshot = adaptive_delay
-
-    # Sleep OUTSIDE the lock so other threads aren't blocked
-    if sleep_time > 0:
-        with stats_lock:
-            rate_stats["throttle_waits"] += 1
-            rate_stats["throttle_wait_seconds"] += sleep_time
-            if endpoint in rate_stats["waits_by_endpoint"]:
-                rate_stats["waits_by_endpoint"][endpoint] += 1
-                rate_stats["wait_seconds_by_endpoint"][endpoint] += sleep_time
-        debug_log(f"throttle wait {sleep_time:.2f}s (adaptive_delay={delay_snapshot:.2f}s)")
-        if sleep_time >= 2:
-            countdown_sleep(sleep_time, "Rate limiting", show_done=False)
+            # File already exists, safe to cache
+            outcome = POST_ON_DISK
+            with self.cache_update_lock:
+                self.pending_posts_cache[post_id] = True
+            self.record_content(post.get("md5"), file_path)
+            self.record_manifest("on_disk", file_path, post)
+            self.flush_if_buffers_full()
+
+        return outcome
+
+    def file_written(self, post, file_path, error):
+        """Disk writer callback: cache the post once its file is in place, or record the failure"""
+        post_id = str(post["id"])
+        if error is not None:
+            with self.cache_update_lock:
+                self.write_failed_ids.add(post_id)
+            self.record_download_failure(post, file_path, error)
+            return
+        with self.stats_lock:
+            self.request_metrics["files_downloaded"] += 1
+        with self.cache_update_lock:
+            self.pending_posts_cache[post_id] = True
+        self.record_content(post.get("md5"), file_path)
+        self.record_manifest("written", file_path, post)
+        self.flush_if_buffers_full()
+
+    def record_download_failure(self, post, file_path, error):
+        file_name = os.path.basename(file_path)
+        print(f"  {c_error('x')} {c_error('Failed:')} {file_name[:30]} - {str(error)[:30]}")
+        self.record_manifest("failed", file_path, post, error=str(error)[:100])
+        # Track download failures so they can be retried later. The metadata lets
+        # --retry-failed go straight to the download without another detail call.
+        with self.failed_cache_lock:
+            failed_cache = self.load_failed_posts_cache()
+            failed_cache[str(post["id"])] = {
+                "error": str(error)[:100],
+                "type": "download",
+                "post": failed_post_metadata(post),
+            }
+            self.save_failed_posts_cache(failed_cache)
+
+    def record_content(self, md5, file_path):
+        """Buffer an md5 -> file path entry for the shared content index"""
+        if self.content_index_enabled and md5:
+            with self.cache_update_lock:
+                self.pending_content_index[md5] = os.path.abspath(file_path)
+
+    def link_indexed_content(self, md5, file_path):
+        """Hard-link (or copy, across filesystems) a file another profile already has.
+
+        Returns True if file_path was created from the content index.
+        """
+        if not self.content_index_enabled or not md5:
+            return False
+        with self.cache_update_lock:
+            source = self.pending_content_index.get(md5)
+        if not source:
+            source = self.load_content_index().get(md5)
+        if not source or not os.path.exists(source):
+            return False
+        self.get_disk_writer().ensure_dir(os.path.dirname(file_path))
+        try:
+            os.link(source, file_path)
+        except OSError:
+            shutil.copy2(source, file_path)
+        self.debug_log(f"linked {md5} from {source}")
+        return True
+
+    def update_tag_type_index(self, tag_details_by_name):
+        """Add newly cached tags to the index without a full rebuild"""
+        if self.cache_backend == "sqlite":
+            self.load_tag_type_index().forget()
+            return
+        with self._tag_type_index_lock:
+            for tag, tag_details in tag_details_by_name.items():
+                entry = _tag_type_entry(tag_details)
+                if entry:
+                    self._tag_type_index[tag] = entry
+
+    def load_tag_type_index(self):
+        """Return the character/copyright index for the current tag cache"""
+        cache = self.load_cache()
+        if self.cache_backend == "sqlite":
+            with self._tag_type_index_lock:
+                if self.sqlite_tag_types is None or self.sqlite_tag_types.table is not cache:
+                    self.sqlite_tag_types = SqliteTagTypes(cache)
+                return self.sqlite_tag_types
+        with self._tag_type_index_lock:
+            if self._tag_type_index_source is not cache:
+                index = {}
+                for tag, tag_details in cache.items():
+                    entry = _tag_type_entry(tag_details)
+                    if entry:
+                        index[tag] = entry
+                self._tag_type_index = index
+                self._tag_type_index_source = cache
+            return self._tag_type_index
+
+    def _pending_tag_type(self, tag, cache):
+        """(type, name) for a folder tag fetched this page but not yet flushed to the cache"""
+        if not self.pending_tag_cache or tag in cache:
+            return None
+        with self.cache_update_lock:
+            return _tag_type_entry(self.pending_tag_cache.get(tag))
+
+    def get_character_tags(self, tags):
+        """Retrieve character tags using cached data"""
+        character_tags = []
+        index = self.load_tag_type_index()
+        cache = self.load_cache()
+
+        for tag in tags.split():
+            entry = index.get(tag) or self._pending_tag_type(tag, cache)
+            if entry and entry[0] == TAG_TYPE_CHARACTER:
+                character_tags.append(entry[1])
+
+        return character_tags
+
+    def get_copyright_tag(self, tags):
+        """Retrieve copyright tag using cached data"""
+        index = self.load_tag_type_index()
+        cache = self.load_cache()
+
+        for tag in tags.split():
+            entry = index.get(tag) or self._pending_tag_type(tag, cache)
+            if entry and entry[0] == TAG_TYPE_COPYRIGHT:
+                return entry[1]
+
+        return None
+
+    # Functions for managing rate-limited posts
+    def load_rate_limited_posts(self):
+        """Load the set of rate-limited posts from disk"""
+        try:
+            with open(self.rate_limited_posts_file, "r") as f:
+                return set(json.load(f))
+        except FileNotFoundError:
+            return set()
+
+    def _save_rate_limited_posts_unlocked(self):
+        """Save rate-limited posts to disk. Must be called while holding rate_limited_lock."""
+        with open(self.rate_limited_posts_file, "w") as f:
+            json.dump(list(self.rate_limited_posts), f)
+
+    def add_rate_limited_post(self, post_id):
+        """Add a post to the rate-limited tracking set"""
+        with self.rate_limited_lock:
+            self.rate_limited_posts.add(post_id)
+            self._save_rate_limited_posts_unlocked()
+            tracked = len(self.rate_limited_posts)
+        self.debug_log(f"now tracking rate-limited post {post_id} ({tracked} tracked)")
+
+    def remove_rate_limited_post(self, post_id):
+        """Remove a post from the rate-limited tracking set"""
+        removed = False
+        with self.rate_limited_lock:
+            if post_id in self.rate_limited_posts:
+                self.rate_limited_posts.remove(post_id)
+                self._save_rate_limited_posts_unlocked()
+                removed = True
+            tracked = len(self.rate_limited_posts)
+        if removed:
+            self.debug_log(f"cleared rate-limited post {post_id} ({tracked} still tracked)")
+
+    # Functions for managing posts the filters skipped on their post details
+    def load_skipped_posts(self):
+        """Load the posts recorded as skipped under the current filters.
+
+        A record made under different filters is ignored, so changing them brings
+        its posts back.
+        """
+        try:
+            with open(self.skipped_posts_file, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return set()
+        if not isinstance(data, dict) or data.get("filters") != self.post_filter.fingerprint:
+            return set()
+        return set(data.get("posts", ()))
+
+    def get_skipped_posts(self):
+        with self.skipped_posts_lock:
+            if self.skipped_posts is None:
+                self.skipped_posts = self.load_skipped_posts()
+            return self.skipped_posts
+
+    def record_skipped_posts(self, post_ids):
+        """Add post_ids to the skipped record, so later runs skip them without a detail request"""
+        if not post_ids:
+            return
+        skipped_posts = self.get_skipped_posts()
+        with self.skipped_posts_lock:
+            skipped_posts.update(post_ids)
+            with open(self.skipped_posts_file, "w") as f:
+                json.dump({"filters": self.post_filter.fingerprint, "posts": sorted(skipped_posts)}, f)
+
+    def _load_json_memoised(self, path):
+        now = time.monotonic()
+        with self._parsed_json_cache_lock:
+            cached = self._parsed_json_cache.get(path)
+        if cached and now - cached[2] < MEMO_REVALIDATE_SECONDS:
+            return cached[1]
+        try:
+            signature = _file_signature(path)
+        except FileNotFoundError:
+            return {}
+        if cached and cached[0] == signature:
+            with self._parsed_json_cache_lock:
+                self._parsed_json_cache[path] = (signature, cached[1], now)
+            return cached[1]
+        with open(path, "r") as f:
+            data = json.load(f)
+        with self._parsed_json_cache_lock:
+            self._parsed_json_cache[path] = (signature, data, now)
+        return data
+
+    def _save_json_memoised(self, path, data):
+        with open(path, "w") as f:
+            json.dump(data, f)
+        with self._parsed_json_cache_lock:
+            # JSON turns non-str keys into str, so only keep data if it already matches the file.
+            if all(isinstance(key, str) for key in data):
+                self._parsed_json_cache[path] = (_file_signature(path), data, time.monotonic())
+            else:
+                self._parsed_json_cache.pop(path, None)
+
+    def get_cache_db(self):
+        with self._cache_db_lock:
+            if self.cache_db is None:
+                self.cache_db = CacheDatabase(self.cache_db_file, self.cache_db_cache_mb, read_only=self.cache_read_only)
+                self.sqlite_tag_types = None
+            return self.cache_db
+
+    def load_sqlite_cache(self, path):
+        """The SQLite backend's table for the JSON cache at path.
+
+        When read-only, a cache sqlite_file doesn't hold yet (or no sqlite_file at
+        all) is read from its JSON file, which the next sync imports.
+        """
+        if self.cache_read_only and not os.path.exists(self.cache_db_file):
+            return self._load_json_memoised(path)
+        table = self.get_cache_db().table(path)
+        if self.cache_read_only and table.is_empty():
+            return self._load_json_memoised(path)
+        return table
+
+    # With the SQLite backend the load_* methods return a SqliteCacheTable, which
+    # update() writes through, so the save_* methods have nothing left to do.
+    def load_cache(self):
+        if self.cache_backend == "sqlite":
+            return self.load_sqlite_cache(self.tag_cache_file)
+        return self._load_json_memoised(self.tag_cache_file)
+
+    def save_cache(self, cache):
+        if self.cache_backend == "json":
+            self._save_json_memoised(self.tag_cache_file, cache)
+
+    def load_posts_cache(self):
+        if self.cache_backend == "sqlite":
+            return self.load_sqlite_cache(self.posts_cache_file)
+        return self._load_json_memoised(self.posts_cache_file)
+
+    def save_posts_cache(self, cache):
+        if self.cache_backend == "json":
+            self._save_json_memoised(self.posts_cache_file, cache)
+
+    def load_content_index(self):
+        if self.cache_backend == "sqlite":
+            return self.load_sqlite_cache(self.content_index_file)
+        return self._load_json_memoised(self.content_index_file)
+
+    def save_content_index(self, index):
+        if self.cache_backend == "json":
+            self._save_json_memoised(self.content_index_file, index)
+
+    def load_failed_posts_cache(self):
+        self.file_lock.acquire()
+        try:
+            with open(self.failed_posts_cache_file, "r") as f:
+                if os.stat(self.failed_posts_cache_file).st_size == 0:
+                    return {}
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except json.decoder.JSONDecodeError:
+            with open(self.failed_posts_cache_file, "r") as f:
+                print(f"Error decoding JSON, file contents: {f.read()}")
+            return {}
+        finally:
+            self.file_lock.release()
+
+    def save_failed_posts_cache(self, cache):
+        with open(self.failed_posts_cache_file, "w") as f:
+            json.dump(cache, f)
+
+    def decayed_limits(self, learned, now):
+        """(minimum delay, worker cap) of a learned entry, relaxed by the time since its 429.
+
+        The gap to min_delay / max_workers halves every learned_half_life_hours, so the
+        controller slowly probes faster again instead of waiting for the next 429.
+        """
+        if not learned:
+            return self.min_delay, self.max_workers
+        age_hours = max(0.0, now - learned["updated"]) / 3600
+        remaining = 0.5 ** (age_hours / self.learned_half_life_hours) if self.learned_half_life_hours > 0 else 0.0
+        delay = self.min_delay + max(0.0, learned["delay"] - self.min_delay) * remaining
+        workers = self.max_workers - max(0, self.max_workers - learned["workers"]) * remaining
+        return delay, max(1, int(workers))
+
+    def endpoint_limits(self, endpoint, now):
+        """Floor for endpoint carried over from earlier runs. Caller must hold api_call_lock."""
+        return self.decayed_limits(self.start_limits.get(endpoint), now)
+
+    def endpoint_worker_count(self, endpoint):
+        """Pool size for a stage: the live worker count, capped by what the endpoint tolerated before"""
+        with self.api_call_lock:
+            _, learned_workers = self.endpoint_limits(endpoint, self.clock.time())
+        with self.workers_lock:
+            return min(self.current_max_workers, learned_workers)
+
+    def rate_limit_api_call(self, endpoint="api"):
+        """Ensure we don't make API calls too frequently"""
+
+        with self.api_call_lock:
+            current_time = self.clock.time()
+            learned_delay, _ = self.endpoint_limits(endpoint, current_time)
+            spacing = max(self.adaptive_delay, learned_delay)
+            earliest_allowed = self.last_api_call_time + spacing
+
+            if current_time >= earliest_allowed:
+                sleep_time = 0
+                self.last_api_call_time = current_time
+            else:
+                sleep_time = earliest_allowed - current_time
+                self.last_api_call_time = earliest_allowed
+            delay_snapshot = spacing
+
+        self._request_context.throttle_wait = sleep_time
+
+        # Sleep OUTSIDE the lock so other threads aren't blocked
+        if sleep_time > 0:
+            with self.stats_lock:
+                self.rate_stats["throttle_waits"] += 1
+                self.rate_stats["throttle_wait_seconds"] += sleep_time
+                if endpoint in self.rate_stats["waits_by_endpoint"]:
+                    self.rate_stats["waits_by_endpoint"][endpoint] += 1
+                    self.rate_stats["wait_seconds_by_endpoint"][endpoint] += sleep_time
+            self.debug_log(f"throttle wait {sleep_time:.2f}s (spacing={delay_snapshot:.2f}s)")
+            if sleep_time >= 2:
+                self.countdown_sleep(sleep_time, "Rate limiting", show_done=False)
+            else:
+                self.clock.sleep(sleep_time)
         else:
-            time.sleep(sleep_time)
-    else:
-        debug_log(f"no throttle wait (adaptive_delay={delay_snapshot:.2f}s)")
-
-
-def handle_rate_limit_response():
-    """Adjust rate limiting parameters when we hit a rate limit"""
-    global adaptive_delay, successful_requests, current_max_workers
-
-    with api_call_lock:
-        old_delay = adaptive_delay
-        adaptive_delay = min(adaptive_delay * DELAY_INCREASE_FACTOR, MAX_DELAY)
-        successful_requests = 0  # Reset success counter on rate limit
-
-        # Reduce concurrent workers when we hit rate limits
-        with workers_lock:
-            old_workers = current_max_workers
-            current_max_workers = max(
-                1, current_max_workers - 1
-            )  # Reduce workers but keep at least 1
-        new_workers = current_max_workers
-        new_delay = adaptive_delay
-
-        # Force a longer pause after rate limit
-        sleep_time = adaptive_delay * 2
-
-    with stats_lock:
-        rate_stats["rate_limit_429s"] += 1
-        rate_stats["cooldown_seconds"] += sleep_time
-        rate_stats["peak_delay_seconds"] = max(rate_stats["peak_delay_seconds"], new_delay)
-        rate_stats["min_workers"] = min(rate_stats["min_workers"], new_workers)
-        total_429s = rate_stats["rate_limit_429s"]
-
-    print(c_warning(f"\n! Rate limited - backing off ({new_delay:.1f}s delay)"), flush=True)
-    debug_log(
-        f"429 #{total_429s}: adaptive_delay {old_delay:.2f}s -> {new_delay:.2f}s, "
-        f"workers {old_workers} -> {new_workers}, cooldown {sleep_time:.2f}s"
-    )
+            self.debug_log(f"no throttle wait (spacing={delay_snapshot:.2f}s)")
+
+    def handle_rate_limit_response(self, endpoint="api"):
+        """Adjust rate limiting parameters when we hit a rate limit"""
+
+        with self.api_call_lock:
+            now = self.clock.time()
+            learned_delay, _ = self.endpoint_limits(endpoint, now)
+            old_delay = self.adaptive_delay
+            # The spacing in force was too fast for this endpoint: remember one step above it.
+            too_fast = max(self.adaptive_delay, learned_delay)
+            self.adaptive_delay = min(self.adaptive_delay * self.delay_increase_factor, self.max_delay)
+            self.successful_requests = 0  # Reset success counter on rate limit
+
+            # Reduce concurrent workers when we hit rate limits
+            with self.workers_lock:
+                old_workers = self.current_max_workers
+                self.current_max_workers = max(
+                    1, self.current_max_workers - 1
+                )  # Reduce workers but keep at least 1
+            new_workers = self.current_max_workers
+            new_delay = self.adaptive_delay
+            # Keep the fastest spacing that still drew a 429: later 429s at higher delays are
+            # usually the tail of the same burst, not evidence that the endpoint got stricter.
+            suggested = min(too_fast * self.delay_increase_factor, self.max_delay)
+            previous = self.learned_limits.get(endpoint)
+            if previous is None or suggested <= previous["delay"]:
+                self.learned_limits[endpoint] = {"delay": suggested, "workers": new_workers, "updated": now}
+            else:
+                previous["updated"] = now
+            self.learned_limits_dirty = True
+
+            # Force a longer pause after rate limit
+            sleep_time = self.adaptive_delay * 2
+
+        with self.stats_lock:
+            self.rate_stats["rate_limit_429s"] += 1
+            self.rate_stats["cooldown_seconds"] += sleep_time
+            self.rate_stats["peak_delay_seconds"] = max(self.rate_stats["peak_delay_seconds"], new_delay)
+            self.rate_stats["min_workers"] = min(self.rate_stats["min_workers"], new_workers)
+            total_429s = self.rate_stats["rate_limit_429s"]
+
+        print(c_warning(f"\n! Rate limited - backing off ({new_delay:.1f}s delay)"), flush=True)
+        self.debug_log(
+            f"429 #{total_429s} on {endpoint}: adaptive_delay {old_delay:.2f}s -> {new_delay:.2f}s, "
+            f"workers {old_workers} -> {new_workers}, cooldown {sleep_time:.2f}s"
+        )
+        self.trace_event(
+            "rate_limit", endpoint=endpoint, delay=round(new_delay, 4), workers=new_workers,
+            cooldown=round(sleep_time, 4),
+        )
 
-    # Countdown outside the lock so other threads aren't blocked
-    countdown_sleep(sleep_time, c_warning("Rate limit cooldown"))
-
-
-def reset_adaptive_delay():
-    """Reset adaptive delay to normal when requests are successful"""
-    global adaptive_delay, successful_requests, current_max_workers
-    decreased = False
-    ramped = False
-    with api_call_lock:
-        successful_requests += 1
-
-        if successful_requests >= SUCCESS_THRESHOLD:
-            if adaptive_delay > MIN_DELAY:
-                old_delay = adaptive_delay
-                adaptive_delay = max(adaptive_delay * DELAY_DECREASE_FACTOR, MIN_DELAY)
-                new_delay = adaptive_delay
-                decreased = True
-
-            # ramp independently of the delay, else a 429 burst pins workers for the session
-            with workers_lock:
-                if current_max_workers < MAX_WORKERS:
-                    old_workers = current_max_workers
-                    current_max_workers += 1
-                    new_workers = current_max_workers
-                    ramped = True
-
-            successful_requests = 0  # Reset counter after adjustment
-
-    if decreased:
-        debug_log(
-            f"{SUCCESS_THRESHOLD} clean requests: adaptive_delay {old_delay:.2f}s -> {new_delay:.2f}s"
+        # Countdown outside the lock so other threads aren't blocked
+        self.countdown_sleep(sleep_time, c_warning("Rate limit cooldown"))
+
+    def reset_adaptive_delay(self):
+        """Reset adaptive delay to normal when requests are successful"""
+        decreased = False
+        ramped = False
+        with self.api_call_lock:
+            self.successful_requests += 1
+
+            if self.successful_requests >= self.success_threshold:
+                if self.adaptive_delay > self.min_delay:
+                    old_delay = self.adaptive_delay
+                    self.adaptive_delay = max(self.adaptive_delay * self.delay_decrease_factor, self.min_delay)
+                    new_delay = self.adaptive_delay
+                    decreased = True
+
+                # ramp independently of the delay, else a 429 burst pins workers for the session
+                with self.workers_lock:
+                    if self.current_max_workers < self.max_workers:
+                        old_workers = self.current_max_workers
+                        self.current_max_workers += 1
+                        new_workers = self.current_max_workers
+                        ramped = True
+
+                self.successful_requests = 0  # Reset counter after adjustment
+
+        if decreased:
+            self.debug_log(
+                f"{self.success_threshold} clean requests: adaptive_delay {old_delay:.2f}s -> {new_delay:.2f}s"
+            )
+        if ramped:
+            self.debug_log(
+                f"{self.success_threshold} clean requests: workers {old_workers} -> {new_workers}"
+            )
+
+    def reset_rate_limit_state(self):
+        """Return the adaptive controller to its starting point and clear rate_stats.
+
+        Re-reads min_delay and max_workers, so callers that change those (the
+        simulator's grid search) can start each run from a clean slate.
+        """
+        with self.api_call_lock:
+            self.last_api_call_time = 0
+            self.adaptive_delay = self.min_delay
+            self.successful_requests = 0
+            with self.workers_lock:
+                self.current_max_workers = self.max_workers
+            self.start_limits.clear()
+            self.learned_limits.clear()
+        with self.stats_lock:
+            self.rate_stats = new_rate_stats(self.min_delay, self.max_workers)
+            self.request_metrics = new_request_metrics()
+
+    def load_rate_limit_state(self):
+        """Restore learned per-endpoint limits from rate_limit_state_file (no-op if remember_limits is off)"""
+        if not self.remember_limits:
+            return
+        try:
+            with open(self.rate_limit_state_file, "r") as f:
+                saved = json.load(f)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return
+        with self.api_call_lock:
+            for endpoint, learned in saved.get("endpoints", {}).items():
+                self.start_limits[endpoint] = learned
+        restored = ", ".join(
+            f"{endpoint} >= {learned['delay']:.2f}s/{learned['workers']} workers"
+            for endpoint, learned in sorted(saved.get("endpoints", {}).items())
         )
-    if ramped:
-        debug_log(
-            f"{SUCCESS_THRESHOLD} clean requests: workers {old_workers} -> {new_workers}"
+        if restored:
+            self.debug_log(f"restored learned rate limits: {restored}")
+
+    def save_rate_limit_state(self):
+        """Persist learned limits if a 429 changed them this run.
+
+        Entries are merged with the file by their update time, so concurrent shard
+        workers or profiles sharing the file keep each other's newer observations.
+        """
+        if not self.remember_limits:
+            return
+        with self.api_call_lock:
+            if not self.learned_limits_dirty:
+                return
+            ours = {endpoint: dict(learned) for endpoint, learned in self.learned_limits.items()}
+            self.learned_limits_dirty = False
+        try:
+            with open(self.rate_limit_state_file, "r") as f:
+                merged = json.load(f).get("endpoints", {})
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            merged = {}
+        for endpoint, learned in ours.items():
+            if learned["updated"] >= merged.get(endpoint, {}).get("updated", 0):
+                merged[endpoint] = learned
+        with open(self.rate_limit_state_file, "w") as f:
+            json.dump({"endpoints": merged}, f, indent=2)
+
+    def print_rate_limit_summary(self):
+        """Print accumulated rate-limit telemetry; helps evaluate and tune config.yaml."""
+        with self.stats_lock:
+            s = dict(self.rate_stats)
+        print(c_header("\n" + "=" * 60))
+        print(c_header("  Rate-limit summary"))
+        print(c_header("=" * 60))
+        print(f"  429 responses hit:      {s['rate_limit_429s']}")
+        print(f"  Retry attempts:         {s['retries']}")
+        print(f"  Throttle spacing waits: {s['throttle_waits']} ({s['throttle_wait_seconds']:.1f}s total)")
+        for ep in ("favourites", "detail", "tag", "download"):
+            print(
+                f"    - {ep:<10s} {s['waits_by_endpoint'][ep]} "
+                f"({s['wait_seconds_by_endpoint'][ep]:.1f}s)"
+            )
+        print(f"  429 cooldown time:      {s['cooldown_seconds']:.1f}s total")
+        print(f"  Peak adaptive delay:    {s['peak_delay_seconds']:.2f}s (config max {self.max_delay:.2f}s)")
+        print(f"  Min concurrent workers: {s['min_workers']} (config start {self.max_workers})")
+        print(f"  Final adaptive delay:   {self.adaptive_delay:.2f}s")
+        with self.api_call_lock:
+            now = self.clock.time()
+            learned = {
+                endpoint: self.decayed_limits(self.learned_limits.get(endpoint) or self.start_limits[endpoint], now)
+                for endpoint in sorted(set(self.start_limits) | set(self.learned_limits))
+            }
+        if learned:
+            print("  Learned limits (next run starts here):")
+            for endpoint, (delay, workers) in learned.items():
+                print(f"    - {endpoint:<10s} >= {delay:.2f}s spacing, <= {workers} workers")
+
+        m = self.metrics_snapshot()
+        if m["endpoints"]:
+            print(
+                f"  {'Latency (ms)':<15s}{'count':>5s} {'p50':>6s} {'p95':>6s} {'p99':>6s} "
+                f"{'ttfb50':>8s} {'xfer50':>7s} {'MB':>7s}"
+            )
+            for endpoint, ep in m["endpoints"].items():
+                lat = ep["latency"]
+                print(
+                    f"    - {endpoint:<10s} {ep['requests']:>5d} {lat['p50'] * 1000:6.0f} {lat['p95'] * 1000:6.0f} "
+                    f"{lat['p99'] * 1000:6.0f} {ep['ttfb']['p50'] * 1000:8.0f} {ep['transfer']['p50'] * 1000:7.0f} "
+                    f"{ep['bytes'] / 1e6:7.1f}"
+                    + (c_warning(f"  ({ep['errors']} errors)") if ep["errors"] else "")
+                )
+        t = m["throughput"]
+        print(
+            f"  Downloads:              {m['files_downloaded']} files in {m['wall_seconds']:.1f}s "
+            f"({t['files_per_second']:.2f} files/s, {t['bytes_per_second'] / 1e6:.2f} MB/s; "
+            f"{t['download_stage_bytes_per_second'] / 1e6:.2f} MB/s within the download stage)"
         )
+        if m["bandwidth"]:
+            print(
+                f"  Bandwidth cap:          {m['bandwidth']['limit_bytes_per_second'] / 1e6:.2f} MB/s "
+                f"(downloads waited {m['bandwidth']['wait_seconds']:.1f}s for it)"
+            )
+        disk = m["disk"]
+        if disk and (disk["files"] or disk["errors"]):
+            print(
+                f"  Disk writes:            {disk['files']} files, {disk['bytes'] / 1e6:.1f} MB in "
+                f"{disk['write_seconds']:.1f}s across {disk['workers']} writers"
+                + (f", {disk['fsyncs']} fsyncs" if disk["fsyncs"] else "")
+                + (c_warning(f" (downloaders waited {disk['blocked_seconds']:.1f}s on a full queue)")
+                   if disk["blocked_submits"] else "")
+                + (c_warning(f" ({disk['errors']} failed)") if disk["errors"] else "")
+            )
+        print("  Stage wall time:        " + ", ".join(
+            f"{stage} {seconds:.1f}s" for stage, seconds in m["stage_seconds"].items()
+        ))
 
+        if self.metrics_json_path:
+            self.write_metrics_json(self.metrics_json_path)
+
+    def commit_retry_results(self, recovered_ids):
+        """Flush buffered caches and drop recovered posts from the failed cache in one write"""
+        self.flush_cache_buffers()
+        if not recovered_ids:
+            return
+        with self.failed_cache_lock:
+            failed_cache = self.load_failed_posts_cache()
+            for post_id in recovered_ids:
+                failed_cache.pop(post_id, None)
+            self.save_failed_posts_cache(failed_cache)
+
+    def retry_posts_in_chunks(self, posts):
+        """Resolve tags and download posts a chunk at a time, committing caches per chunk.
+
+        Returns (recovered_ids, still_failed_ids). After stop(), the chunks not yet
+        started are checkpointed for the next run instead.
+        """
+        recovered_ids = []
+        still_failed_ids = []
+        for i in range(0, len(posts), self.posts_per_page):
+            chunk = posts[i : i + self.posts_per_page]
+            if not self.stopping():
+                self.fetch_tags_for_posts(chunk)
+            if self.stopping():
+                self.checkpoint_interrupted(posts[i:])
+                break
+            outcomes = self.download_posts_parallel(chunk)
+            chunk_recovered = [
+                post_id for post_id, outcome in outcomes.items() if outcome != POST_DOWNLOAD_FAILED
+            ]
+            still_failed_ids.extend(
+                post_id for post_id, outcome in outcomes.items() if outcome == POST_DOWNLOAD_FAILED
+            )
+            self.commit_retry_results(chunk_recovered)
+            recovered_ids.extend(chunk_recovered)
+        return recovered_ids, still_failed_ids
+
+    def retry_post_ids(self, post_ids, failed_cache):
+        """Run post_ids through the retry pipeline, in the order given.
+
+        Download failures whose post metadata is in failed_cache go first and need no
+        detail call; the rest are re-fetched. Posts already in posts_cache are cleared
+        from the failed cache without any request, and so are posts the filters now
+        leave out or the API no longer returns. Returns (recovered_ids, still_failed_ids, missing_ids, stale_ids,
+        skipped_ids, deferred_ids), deferred ones being left queued by stop() or the
+        priority pass's 429 budget.
+        """
+        # Already in posts_cache => recovered in a prior run.
+        posts_cache = self.load_posts_cache()
+        stale_ids = [post_id for post_id in post_ids if post_id in posts_cache]
+        if stale_ids:
+            self.commit_retry_results(stale_ids)
+            for post_id in stale_ids:
+                self.remove_rate_limited_post(post_id)
+
+        cached_posts = []
+        post_ids_to_fetch = []
+        for post_id in post_ids:
+            if post_id in posts_cache:
+                continue
+            error_info = failed_cache.get(post_id)
+            cached_post = error_info.get("post") if isinstance(error_info, dict) else None
+            if cached_post and "file_url" in cached_post and "tags" in cached_post:
+                cached_posts.append(cached_post)
+            else:
+                post_ids_to_fetch.append(post_id)
+
+        cached_posts, skipped_ids = self.filter_posts(cached_posts)
+        recovered_ids = []
+        still_failed_ids = []
+
+        if cached_posts:
+            print(c_info(f"Retrying {len(cached_posts)} downloads from cached post metadata..."))
+            recovered, still_failed = self.retry_posts_in_chunks(cached_posts)
+            recovered_ids.extend(recovered)
+            still_failed_ids.extend(still_failed)
+
+        # Details are fetched a page's worth at a time, so a long failed list doesn't
+        # hold every post (and every future) in memory at once.
+        missing_ids = []
+        deferred_ids = []
+        for i in range(0, len(post_ids_to_fetch), self.posts_per_page):
+            chunk_ids = post_ids_to_fetch[i : i + self.posts_per_page]
+            if self.stopping() or self.priority_budget_spent():
+                deferred_ids.extend(post_ids_to_fetch[i:])
+                break
+            posts, cached_ids, chunk_missing, failed_ids = self.fetch_post_details_parallel(chunk_ids)
+            fetched = set(cached_ids).union(chunk_missing, failed_ids, (str(post["id"]) for post in posts))
+            deferred_ids.extend(post_id for post_id in chunk_ids if post_id not in fetched)
+            # Recovered concurrently (e.g. by another run) since posts_cache was read above.
+            self.commit_retry_results(cached_ids)
+            stale_ids.extend(cached_ids)
+            missing_ids.extend(chunk_missing)
+            still_failed_ids.extend(failed_ids)
+            posts, skipped = self.filter_posts(posts)
+            skipped_ids.extend(skipped)
+            recovered, still_failed = self.retry_posts_in_chunks(posts)
+            recovered_ids.extend(recovered)
+            still_failed_ids.extend(still_failed)
+
+        # Neither is going to download, so neither stays queued for another retry.
+        settled_ids = skipped_ids + missing_ids
+        if settled_ids:
+            self.commit_retry_results(settled_ids)
+            for post_id in settled_ids:
+                self.remove_rate_limited_post(post_id)
+        return recovered_ids, still_failed_ids, missing_ids, stale_ids, skipped_ids, deferred_ids
+
+    def retry_failed(self):
+        """Retry downloading posts that previously failed.
+
+        Uses the same parallel detail, tag and download stages as a normal run, with
+        download failures ordered first. Cache writes are committed once per chunk.
+        Returns {"recovered", "still_failed", "missing", "stale", "skipped", "stopped",
+        "metrics"}: lists of post ids (stale ones were already downloaded by an earlier
+        run, skipped ones are left out by the filters section),
+        whether stop() cut the retry short, and a metrics_snapshot().
+        """
+        if not self.state_loaded:
+            self.load_state()
+        failed_cache = self.load_failed_posts_cache()
+
+        if not failed_cache:
+            print(c_info("No failed posts to retry."))
+            return {
+                "recovered": [], "still_failed": [], "missing": [], "stale": [], "skipped": [],
+                "stopped": self.stopping(), "metrics": self.metrics_snapshot(),
+            }
 
-def print_rate_limit_summary():
-    """Print accumulated rate-limit telemetry; helps evaluate and tune config.yaml."""
-    with stats_lock:
-        s = dict(rate_stats)
-    print(c_header("\n" + "=" * 60))
-    print(c_header("  Rate-limit summary"))
-    print(c_header("=" * 60))
-    print(f"  429 responses hit:      {s['rate_limit_429s']}")
-    print(f"  Retry attempts:         {s['retries']}")
-    print(f"  Throttle spacing waits: {s['throttle_waits']} ({s['throttle_wait_seconds']:.1f}s total)")
-    for ep in ("detail", "tag", "download"):
-        print(
-            f"    - {ep:<8s} {s['waits_by_endpoint'][ep]} "
-            f"({s['wait_seconds_by_endpoint'][ep]:.1f}s)"
+        failed_post_ids = sorted(failed_cache, key=lambda post_id: failure_priority(failed_cache[post_id]))
+        print(c_header(f"\n{'='*60}"))
+        print(c_header(f"  Retrying {len(failed_post_ids)} previously failed posts"))
+        print(c_header(f"{'='*60}"))
+
+        recovered_ids, still_failed_ids, missing_post_ids, stale_post_ids, skipped_ids, _ = self.retry_post_ids(
+            failed_post_ids, failed_cache
         )
-    print(f"  429 cooldown time:      {s['cooldown_seconds']:.1f}s total")
-    print(f"  Peak adaptive delay:    {s['peak_delay_seconds']:.2f}s (config max {MAX_DELAY:.2f}s)")
-    print(f"  Min concurrent workers: {s['min_workers']} (config start {MAX_WORKERS})")
-    print(f"  Final adaptive delay:   {adaptive_delay:.2f}s")
 
+        if stale_post_ids:
+            print(c_info(f"Cleared {len(stale_post_ids)} stale entries already downloaded"))
+        if skipped_ids:
+            print(c_info(f"Cleared {len(skipped_ids)} entries the filters now skip"))
+        if recovered_ids:
+            print(c_success(f"\nRecovered {len(recovered_ids)} posts"))
+        if missing_post_ids:
+            print(c_warning(f"{len(missing_post_ids)} posts no longer exist on Gelbooru (deleted or hidden)"))
+            print(c_dim(f"  {', '.join(missing_post_ids)}"))
+        if still_failed_ids:
+            print(c_warning(f"{len(still_failed_ids)} posts still failing"))
+
+        if self.stopping():
+            print(c_warning("\nRetry stopped early - the remaining posts stay queued."))
+        else:
+            print(c_success("\n" + "="*60))
+            print(c_success("  Retry complete!"))
+            print(c_success("="*60))
+        return {
+            "recovered": recovered_ids,
+            "still_failed": still_failed_ids,
+            "missing": missing_post_ids,
+            "stale": stale_post_ids,
+            "skipped": skipped_ids,
+            "stopped": self.stopping(),
+            "metrics": self.metrics_snapshot(),
+        }
+
+    def process_priority_posts(self):
+        """Work through previously rate-limited and failed posts before normal pagination.
+
+        The pass has its own budget: no detail request is sent once priority_429_budget
+        new 429s have been hit, or once priority_max_posts posts have been tried, and the
+        rest stay queued on disk for the next run. Requests are not retried within the
+        pass: a post that hits a 429 goes back to the queue instead of backing off.
+        Returns post counts: {"recovered", "still_failed", "missing", "skipped",
+        "deferred"}, skipped being those the filters now leave out and deferred those
+        left queued.
+        """
+        totals = {"recovered": 0, "still_failed": 0, "missing": 0, "skipped": 0, "deferred": 0}
+        with self.rate_limited_lock:
+            rate_limited = set(self.rate_limited_posts)
+        failed_cache = self.load_failed_posts_cache()
+        queue = build_priority_queue(rate_limited, failed_cache)
+        if not queue:
+            return totals
 
-def signal_handler(sig, frame):
-    """Handle Ctrl+C gracefully by saving caches before exiting"""
-    # Print immediately to confirm signal received
-    print(c_warning("\n\nInterrupted! Saving progress..."))
-    sys.stdout.flush()
+        print(c_header(f"\n{'='*60}"))
+        print(c_header(f"  Priority pass - {len(queue)} rate-limited/failed posts"))
+        print(c_header(f"{'='*60}"))
 
-    # Save any pending cached data
-    try:
-        flush_cache_buffers()
-        print(c_success("Progress saved."))
-    except Exception as e:
-        print(c_error(f"Warning: Error saving caches: {e!s}"))
+        with self.stats_lock:
+            start_429s = self.rate_stats["rate_limit_429s"]
+        # Checked before each detail request, not just between chunks.
+        self.priority_429_limit = start_429s + self.priority_429_budget
+        attempted = 0
+        try:
+            while queue and not self.stopping():
+                if self.priority_budget_spent() or attempted >= self.priority_max_posts:
+                    break
+
+                chunk_size = min(self.posts_per_page, self.priority_max_posts - attempted, len(queue))
+                chunk = [heapq.heappop(queue)[2] for _ in range(chunk_size)]
+                attempted += len(chunk)
+
+                recovered, still_failed, missing, _, skipped, deferred = self.retry_post_ids(chunk, failed_cache)
+                totals["recovered"] += len(recovered)
+                totals["still_failed"] += len(still_failed)
+                totals["missing"] += len(missing)
+                totals["skipped"] += len(skipped)
+                totals["deferred"] += len(deferred)
+        finally:
+            self.priority_429_limit = None
+
+        totals["deferred"] += len(queue)
+        summary = (
+            f"Priority pass: {totals['recovered']} recovered, "
+            f"{totals['still_failed']} still failing, {totals['missing']} missing"
+        )
+        print(c_success(summary) if totals["recovered"] else c_dim(summary))
+        if totals["deferred"] and self.stopping():
+            print(c_warning(f"Stopped - {totals['deferred']} posts left queued for the next run"))
+        elif totals["deferred"]:
+            print(c_warning(
+                f"Priority budget spent - {totals['deferred']} posts left queued for the next run"
+            ))
+        return totals
+
+    def sync_favourites(self, session, max_empty_pages=None, first_page_ids=None):
+        """Page through the favourites from the newest, downloading anything not yet cached.
+
+        Stops after max_empty_pages consecutive pages with no new downloads (default
+        max_consecutive_empty_pages), at the last page, or on a page that could not be
+        fetched. first_page_ids, if given, is used for pid=0 instead of fetching it again.
+        Returns the number of pages processed.
+        """
+        pages = sum(1 for _ in self.favourite_page_steps(session, max_empty_pages, first_page_ids))
+        self.flush_cache_buffers()
+        return pages
+
+    def favourite_page_steps(self, session, max_empty_pages=None, first_page_ids=None):
+        """Generator behind sync_favourites, yielding after each processed page.
+
+        Lets sync_profiles interleave several accounts a page at a time. Sets
+        favourites_walk_complete once the walk ends, True unless it was cut short by
+        a page that could not be fetched or by stop().
+        """
+        if max_empty_pages is None:
+            max_empty_pages = self.max_consecutive_empty_pages
+        self.favourites_walk_complete = False
+
+        pid = 0
+        consecutive_empty_pages = (
+            0  # Counter for consecutive pages without downloaded images
+        )
 
-    try:
-        print_rate_limit_summary()
-    except Exception:
-        pass
+        while consecutive_empty_pages < max_empty_pages and not self.stopping():
+            if pid == 0 and first_page_ids is not None:
+                post_ids = first_page_ids
+            else:
+                post_ids = self.get_favorite_post_ids(session, pid)
+            if self.stopping():
+                break
+            if post_ids is FETCH_FAILED:
+                print(c_error(f"Could not fetch favourite page (pid={pid}) after retries; stopping to avoid missing posts."))
+                break
+            if not post_ids:
+                print(c_info("No more favourite posts found."))
+                self.favourites_walk_complete = True
+                break
+
+            page_num = (pid // self.posts_per_page) + 1
+            profile_label = f"[{self.active_profile_name}] " if self.active_profile_name else ""
+            print(c_header(f"\n{'='*60}"))
+            print(c_header(f"  {profile_label}Page {page_num} - {len(post_ids)} favourite posts"))
+            print(c_header(f"{'='*60}"))
+
+            # Process posts in batches
+            start_time = time.time()
+            download_results = self.batch_process_posts(post_ids)
+            end_time = time.time()
+
+            elapsed = end_time - start_time
+            print(format_page_summary(download_results, elapsed))
+            if self.stopping():
+                yield page_num
+                break
+            downloaded_images = download_results[POST_DOWNLOADED] + download_results[POST_LINKED] > 0
+
+            if not downloaded_images:
+                consecutive_empty_pages += 1
+            else:
+                consecutive_empty_pages = 0
 
-    print(c_info("Goodbye!"))
-    sys.stdout.flush()
-    # Use os._exit() to forcefully terminate all threads immediately
-    os._exit(0)
+            yield page_num
 
+            if len(post_ids) < self.posts_per_page:
+                print(c_info("\nReached the last page of favourite posts."))
+                self.favourites_walk_complete = True
+                break
 
-def retry_failed_posts():
-    """Retry downloading posts that previously failed."""
-    failed_cache = load_failed_posts_cache()
+            pid += self.posts_per_page
 
-    if not failed_cache:
-        print(c_info("No failed posts to retry."))
-        return
+        if self.stopping():
+            print(c_warning("\nStopped - no further favourite pages will be fetched."))
+        elif consecutive_empty_pages >= max_empty_pages:
+            print(c_info(f"\nNo new images for {max_empty_pages} consecutive pages."))
+            self.favourites_walk_complete = True
 
-    failed_post_ids = list(failed_cache.keys())
-    print(c_header(f"\n{'='*60}"))
-    print(c_header(f"  Retrying {len(failed_post_ids)} previously failed posts"))
-    print(c_header(f"{'='*60}"))
-
-    # First, fetch all post details to gather tags
-    print(c_info("Fetching post details..."))
-    posts_to_retry = []
-    stale_post_ids = []  # "SKIP" => already in posts_cache, i.e. recovered in a prior run.
-    missing_post_ids = []
-    for post_id in failed_post_ids:
-        rate_limit_api_call("detail")
-        post_details = get_post_details(post_id)
-        if post_details is POST_MISSING:
-            missing_post_ids.append(post_id)
-        elif post_details == "SKIP":
-            stale_post_ids.append(post_id)
-        elif post_details and post_details[0]:
-            posts_to_retry.append((post_id, post_details[0]))
-
-    if stale_post_ids:
-        for post_id in stale_post_ids:
-            failed_cache.pop(post_id, None)
-        save_failed_posts_cache(failed_cache)
-        print(c_info(f"Cleared {len(stale_post_ids)} stale entries already downloaded"))
-
-    # Batch fetch all tags
-    if posts_to_retry:
-        all_tags = set()
-        for _, post in posts_to_retry:
-            all_tags.update(post["tags"].split())
-        print(c_info(f"Fetching {len(all_tags)} unique tags..."))
-        batch_fetch_tag_details(list(all_tags))
-
-    success_count = 0
-    still_failed = 0
-
-    for i, (post_id, post) in enumerate(posts_to_retry):
-        progress = int(((i + 1) / len(posts_to_retry)) * 20)
-        bar_done = Fore.CYAN + "=" * progress
-        bar_remaining = Fore.WHITE + "-" * (20 - progress)
-        bar = bar_done + bar_remaining + Style.RESET_ALL
-        print(f"\r  [{bar}] {i + 1}/{len(posts_to_retry)} - Post {post_id}  ", end="", flush=True)
-
-        # Get tags for this post
-        character_tags = get_character_tags(post["tags"])
-        copyright_tag = get_copyright_tag(post["tags"])
-        sensitivity = get_sensitivity(post)
+    @timed_stage("scrape")
+    def poll_favourites_first_page(self, session, poll_state):
+        """Cheaply check whether the first favourites page changed since the last poll.
 
-        # Try to download
-        if download_and_save_image(post, character_tags, sensitivity, copyright_tag):
-            # Success! Remove from failed cache
-            del failed_cache[post_id]
-            save_failed_posts_cache(failed_cache)
+        Sends the ETag / Last-Modified validators from the previous poll so an unchanged
+        page can come back as a bodyless 304, and otherwise compares a fingerprint of the
+        page's post ids. Returns the post id list when the page changed, or None when it
+        did not (or could not be fetched; the next poll simply tries again). The new
+        validators and fingerprint are left in poll_state["pending"] until the caller
+        commits them with commit_favourites_poll(), so a sync cut short is retried.
+        """
+        import hashlib
 
-            # Add to posts cache
-            posts_cache = load_posts_cache()
-            posts_cache[post_id] = True
-            save_posts_cache(posts_cache)
+        import requests
 
-            success_count += 1
-            print(f"\r  {c_success('+')} Post {post_id} - recovered successfully{' '*20}")
-        else:
-            still_failed += 1
+        url = f"{self.site_url}/index.php?page=favorites&s=view&id={self.user_id}&pid=0"
+        headers = {}
+        if poll_state.get("etag"):
+            headers["If-None-Match"] = poll_state["etag"]
+        if poll_state.get("last_modified"):
+            headers["If-Modified-Since"] = poll_state["last_modified"]
 
-    # Handle posts that couldn't be fetched (stale and missing entries are not failures).
-    for post_id in failed_post_ids:
-        if post_id in stale_post_ids or post_id in missing_post_ids:
-            continue
-        if not any(pid == post_id for pid, _ in posts_to_retry):
-            still_failed += 1
+        try:
+            response = self.timed_get("favourites", session.get, url, trace={"pid": 0, "watch": True}, headers=headers, timeout=30)
+            if response.status_code == 304:
+                self.debug_log("[watch] first page not modified (304)")
+                return None
+            if response.status_code == 429:
+                self.handle_rate_limit_response("favourites")
+                return None
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            self.log_message(c_warning(f"Watch poll failed: {e!s}"))
+            return None
+
+        thumbnails = parse_favourite_thumbnails(response.text)
+        post_ids = [post_id for post_id, _ in thumbnails]
+        fingerprint = hashlib.sha1(" ".join(post_ids).encode("utf-8")).hexdigest()
+        poll_state["pending"] = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fingerprint": fingerprint,
+        }
+        if fingerprint == poll_state.get("fingerprint"):
+            self.debug_log(f"[watch] first page fingerprint unchanged ({fingerprint[:12]})")
+            self.commit_favourites_poll(poll_state)
+            return None
+        self.thumbnail_titles = dict(thumbnails)
+        return post_ids
+
+    def commit_favourites_poll(self, poll_state):
+        """Make the last poll's validators and fingerprint the ones the next poll compares against"""
+        poll_state.update(poll_state.pop("pending", {}))
+
+    def has_priority_posts(self):
+        """True if any post is rate-limited or in the failed cache, i.e. the priority pass has work"""
+        with self.rate_limited_lock:
+            if self.rate_limited_posts:
+                return True
+        return bool(self.load_failed_posts_cache())
+
+    def watch_favourites(self, session):
+        """Keep the session and caches warm and sync whenever new favourites appear.
+
+        Polls the first favourites page every watch_interval seconds (+/- watch_jitter).
+        The detail, tag and download stages only run when that page holds posts that are
+        not yet in posts_cache, and then only as far back as the first page with nothing new.
+        Rate-limited and failed posts get a priority pass each cycle, within its 429 budget,
+        and a sync that ends early is picked up again by the next poll. Runs until stop()
+        is called (Ctrl+C).
+        """
+        print(c_info(f"Watching for new favourites every ~{self.watch_interval}s..."))
+        poll_state = {}
+        while not self.stopping():
+            if self.has_priority_posts():
+                self.process_priority_posts()
+            if self.stopping():
+                break
+            post_ids = self.poll_favourites_first_page(session, poll_state)
+            if post_ids is not None:
+                posts_cache = self.load_posts_cache()
+                new_count = sum(1 for post_id in post_ids if post_id not in posts_cache)
+                # After a sync cut short, the first page may be done while later ones aren't,
+                # so the resumed walk doesn't stop at the first page with nothing new.
+                resume = poll_state.get("resume")
+                if new_count or resume:
+                    print(c_info(f"\n{new_count} new favourites on the first page"))
+                    self.sync_favourites(session, max_empty_pages=None if resume else 1, first_page_ids=post_ids)
+                    poll_state["resume"] = not self.favourites_walk_complete
+                    if poll_state["resume"]:
+                        self.log_message(c_warning("Sync ended early - the next poll will try again"))
+                    else:
+                        self.commit_favourites_poll(poll_state)
+                else:
+                    self.debug_log("[watch] first page changed but holds no uncached posts")
+                    self.commit_favourites_poll(poll_state)
+
+            delay = max(1.0, self.watch_interval + random.uniform(-self.watch_jitter, self.watch_jitter))
+            self.debug_log(f"[watch] next poll in {delay:.1f}s")
+            self.stop_event.wait(delay)
+
+    def find_library_images(self):
+        """Yield (rating folder, path) for every image under base_dir.
+
+        Images are looked for in <folder>/<rating> and Multiple/<copyright>/<rating>,
+        and in fan-out sub-folders below those; anything else is left alone.
+        """
+        rating_folders = set(SENSITIVITY_FOLDERS.values()) | {"General"}
+        for root, _, names in os.walk(self.base_dir):
+            parts = os.path.relpath(root, self.base_dir).split(os.sep)
+            if len(parts) >= 2 and parts[1] in rating_folders:
+                depth = 2
+            elif len(parts) >= 3 and parts[2] in rating_folders:
+                depth = 3
+            else:
+                continue
+            if not all(_FANOUT_DIR.fullmatch(part) for part in parts[depth:]):
+                continue
+            rating_dir = os.path.join(self.base_dir, *parts[:depth])
+            for name in names:
+                if not name.endswith(".part"):
+                    yield rating_dir, os.path.join(root, name)
+
+    def reshard_library(self):
+        """Move existing images into the folder layout for the current fanout_levels.
+
+        Images are renamed within their rating folder, so this is quick, safe to stop
+        (Ctrl+C) and run again, and needs no network. Content index entries follow the
+        moved files every 500 moves, so even a forced exit leaves at most one batch
+        pointing at old paths. Emptied fan-out folders are removed. Returns {"images",
+        "moved", "conflicts", "largest_folder"}, the last being the most images left
+        in any one folder.
+        """
+        levels = min(self.fanout_levels, MAX_FANOUT_LEVELS)
+        print(c_info(f"Resharding {self.base_dir} into {levels} fan-out levels..."))
+        plan = []
+        folder_sizes = {}
+        rating_dirs = set()
+        for rating_dir, path in self.find_library_images():
+            rating_dirs.add(rating_dir)
+            target = self.destination_path(rating_dir, os.path.basename(path))
+            folder = os.path.dirname(target)
+            folder_sizes[folder] = folder_sizes.get(folder, 0) + 1
+            if target != path:
+                plan.append((path, target))
+
+        def commit(batch):
+            """Point the content index and manifest at a batch of moved files"""
+            with self.cache_update_lock:
+                content_index = self.load_content_index()
+                updated = {md5: batch[path] for md5, path in content_index.items() if path in batch}
+                if updated:
+                    content_index.update(updated)
+                    self.save_content_index(content_index)
+            md5_by_path = {path: md5 for md5, path in updated.items()}
+            for path, target in batch.items():
+                self.record_manifest("moved", target, md5=md5_by_path.get(target), previous_path=path)
+
+        moved = 0
+        batch = {}
+        conflicts = 0
+        for i, (path, target) in enumerate(plan, 1):
+            if self.stopping():
+                break
+            if os.path.exists(target):
+                # Same image in both places (e.g. an earlier interrupted reshard); keep both.
+                conflicts += 1
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+            batch[os.path.abspath(path)] = os.path.abspath(target)
+            moved += 1
+            if len(batch) >= 500:
+                commit(batch)
+                batch = {}
+                set_progress("reshard", f"  Moved {i}/{len(plan)} images...")
+        if batch:
+            commit(batch)
+        clear_progress("reshard")
+
+        # Fan-out folders emptied by the moves
+        for rating_dir in rating_dirs:
+            for root, _, _ in os.walk(rating_dir, topdown=False):
+                if root == rating_dir or not _FANOUT_DIR.fullmatch(os.path.basename(root)):
+                    continue
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass  # Not empty
+
+        images = sum(folder_sizes.values())
+        largest = max(folder_sizes.values(), default=0)
+        print(c_success(f"Moved {moved} of {images} images"))
+        if conflicts:
+            print(c_warning(f"{conflicts} images were left in place because the destination already exists"))
+        if moved < len(plan) - conflicts:
+            print(c_warning("Stopped early - run --reshard again to finish"))
+        print(c_dim(f"Largest folder now holds {largest} images"))
+        if largest > FANOUT_SUGGEST_ENTRIES and levels < MAX_FANOUT_LEVELS:
+            print(c_dim(f"  (settings.fanout_levels: {levels + 1} would spread them further)"))
+        return {"images": images, "moved": moved, "conflicts": conflicts, "largest_folder": largest}
+
+    def plan(self, session=None, output=None):
+        """Work out what a sync would do, from the caches and the favourites pages alone.
+
+        Only logs in and fetches favourites pages: no detail, tag or image requests,
+        and nothing is written except output, a JSONL file with one line per post and
+        a final summary line. Posts whose metadata is in the failed cache are planned
+        exactly. The rest are planned from their thumbnail titles, so their file name
+        and on-disk state are unknown and their size is a rough estimate. Returns the
+        summary dict.
+        """
+        # With the SQLite backend, sqlite_file is only read: not created, and nothing imported into it.
+        read_only = self.cache_backend == "sqlite" and self.cache_db is None
+        self.cache_read_only = read_only
+        try:
+            return self._plan(session, output)
+        finally:
+            if read_only:
+                self.cache_read_only = False
+                with self._cache_db_lock:
+                    db, self.cache_db = self.cache_db, None
+                if db is not None:
+                    db.close()
+
+    def _plan(self, session, output):
+        if not self.state_loaded:
+            self.load_state()
+        if session is None:
+            session = self.login()
+
+        posts_cache = self.load_posts_cache()
+        failed_cache = self.load_failed_posts_cache()
+        skipped_posts = self.get_skipped_posts()
+        retry_ids = set()  # Planned by the priority pass, so not again from the favourites
+        calls = {"favourites": 0, "detail": 0, "tag": 0, "download": 0}
+        # Entries are tallied (and written out) as they are planned rather than kept.
+        tally = {"actions": dict.fromkeys(PLAN_ACTIONS, 0), "folders": {}, "unresolved_tags": set(), "download_bytes": 0}
+        plan_file = open(output, "w", encoding="utf-8") if output else None
+
+        def record(entry):
+            self.tally_plan_entry(tally, entry)
+            if plan_file is not None:
+                plan_file.write(json.dumps(entry) + "\n")
 
-    print()  # New line after progress
+        try:
+            print(c_header(f"\n{'='*60}"))
+            print(c_header("  Planning sync (no downloads, nothing written)"))
+            print(c_header(f"{'='*60}"))
+
+            # The priority pass goes first, within its post budget, as in sync()
+            with self.rate_limited_lock:
+                rate_limited = set(self.rate_limited_posts)
+            queue = build_priority_queue(rate_limited, failed_cache)
+            attempted = 0
+            while queue:
+                post_id = heapq.heappop(queue)[2]
+                retry_ids.add(post_id)
+                if post_id in posts_cache:
+                    record({"post_id": post_id, "source": "retry", "action": "stale"})
+                    continue
+                if attempted >= self.priority_max_posts:
+                    record({"post_id": post_id, "source": "retry", "action": "deferred"})
+                    continue
+                attempted += 1
+                error_info = failed_cache.get(post_id)
+                cached_post = error_info.get("post") if isinstance(error_info, dict) else None
+                if cached_post and "file_url" in cached_post and "tags" in cached_post:
+                    record(self.plan_post(post_id, "retry", cached_post, exact=True))
+                else:
+                    calls["detail"] += 1
+                    record({
+                        "post_id": post_id, "source": "retry", "action": "download",
+                        "estimated_bytes": estimated_download_bytes({}), "exact": False,
+                    })
 
-    if success_count > 0:
-        print(c_success(f"\nRecovered {success_count} posts"))
-    if missing_post_ids:
-        print(c_warning(f"{len(missing_post_ids)} posts no longer exist on Gelbooru (deleted or hidden)"))
-        print(c_dim(f"  {', '.join(missing_post_ids)}"))
-    if still_failed > 0:
-        print(c_warning(f"{still_failed} posts still failing"))
+            pid = 0
+            consecutive_empty_pages = 0
+            end = None
+            while not self.stopping():
+                post_ids = self.get_favorite_post_ids(session, pid)
+                calls["favourites"] += 1
+                if post_ids is FETCH_FAILED:
+                    end = f"favourites page pid={pid} could not be fetched"
+                    break
+                if not post_ids:
+                    end = "end of favourites"
+                    break
+
+                new_posts = 0
+                for post_id in post_ids:
+                    if post_id in retry_ids:
+                        continue
+                    if post_id in posts_cache:
+                        record({"post_id": post_id, "source": "favourites", "page": pid, "action": "cached"})
+                        continue
+                    if self.post_filter.active and post_id in skipped_posts:
+                        record({
+                            "post_id": post_id, "source": "favourites", "page": pid,
+                            "action": "skip", "reason": "skipped by an earlier run",
+                        })
+                        continue
+                    fields = parse_thumbnail_title(self.thumbnail_titles.get(post_id, ""))
+                    entry = self.plan_post(post_id, "favourites", fields, exact=False)
+                    entry["page"] = pid
+                    if entry["action"] != "skip":
+                        calls["detail"] += 1
+                    if entry["action"] in ("download", "link"):
+                        new_posts += 1
+                    record(entry)
+                print(c_dim(f"Page {pid // self.posts_per_page + 1}: {len(post_ids)} posts, {new_posts} new"))
+
+                consecutive_empty_pages = 0 if new_posts else consecutive_empty_pages + 1
+                if consecutive_empty_pages >= self.max_consecutive_empty_pages:
+                    end = f"no new images for {consecutive_empty_pages} consecutive pages"
+                    break
+                if len(post_ids) < self.posts_per_page:
+                    end = "end of favourites"
+                    break
+                pid += self.posts_per_page
+            if end is None:
+                end = "stopped"
+
+            # A 429 while planning should not change what the next real run starts from.
+            with self.api_call_lock:
+                self.learned_limits_dirty = False
+
+            summary = self.plan_summary(tally, calls, end)
+            self.print_plan(summary)
+            if plan_file is not None:
+                plan_file.write(json.dumps({"summary": summary}) + "\n")
+                print(c_dim(f"Plan written to {output}"))
+        finally:
+            if plan_file is not None:
+                plan_file.close()
+        return summary
+
+    def plan_post(self, post_id, source, post, exact):
+        """Plan entry for one uncached post, from its metadata (exact) or thumbnail title fields"""
+        entry = {"post_id": post_id, "source": source}
+        reason = self.post_filter.skip_reason(post) if self.post_filter.active else None
+        if reason:
+            entry.update(action="skip", reason=reason)
+            return entry
+
+        tags = post.get("tags", "")
+        tag_cache = self.load_cache()
+        directory = self.build_destination_dir(
+            self.get_character_tags(tags), self.get_copyright_tag(tags), get_sensitivity(post)
+        )
+        entry.update(
+            action="download",
+            folder=os.path.relpath(directory, self.base_dir),
+            estimated_bytes=estimated_download_bytes(post),
+            exact=exact,
+            unresolved_tags=[tag for tag in tags.split() if tag not in tag_cache],
+        )
+        if exact:
+            _, file_name = resolve_download_url(post)
+            file_path = self.destination_path(directory, file_name)
+            entry["destination"] = file_path
+            if os.path.exists(file_path):
+                entry["action"] = "on_disk"
+            elif self.content_index_enabled and post.get("md5"):
+                source_path = self.load_content_index().get(post["md5"])
+                if source_path and os.path.exists(source_path):
+                    entry["action"] = "link"
+        else:
+            entry["destination"] = directory
+        return entry
+
+    def tally_plan_entry(self, tally, entry):
+        """Add one plan() entry to the running totals plan_summary() reports"""
+        tally["actions"][entry["action"]] += 1
+        if entry["action"] in ("download", "link", "on_disk"):
+            tally["unresolved_tags"].update(entry.get("unresolved_tags", ()))
+        if entry["action"] == "download":
+            tally["download_bytes"] += entry["estimated_bytes"]
+            folder = entry.get("folder")
+            if folder:
+                tally["folders"][folder] = tally["folders"].get(folder, 0) + 1
+
+    def plan_summary(self, tally, calls, end):
+        """Totals for plan(): post counts per action, bytes, API calls and a duration estimate"""
+        actions = tally["actions"]
+        folders = tally["folders"]
+        download_bytes = tally["download_bytes"]
+        calls = dict(calls, tag=len(tally["unresolved_tags"]), download=actions["download"])
+
+        # Every request waits its turn behind the shared spacing, so at the current
+        # settings (and the limits earlier runs learned) a sync takes at least this long.
+        now = self.clock.time()
+        with self.api_call_lock:
+            spacing = {
+                endpoint: max(self.adaptive_delay, self.endpoint_limits(endpoint, now)[0]) for endpoint in calls
+            }
+        api_seconds = sum(count * spacing[endpoint] for endpoint, count in calls.items())
+        bandwidth_seconds = None
+        estimated_seconds = api_seconds
+        if self.max_download_bytes_per_second:
+            bandwidth_seconds = download_bytes / self.max_download_bytes_per_second
+            non_download_seconds = api_seconds - calls["download"] * spacing["download"]
+            estimated_seconds = max(api_seconds, non_download_seconds + bandwidth_seconds)
+
+        return {
+            "end": end,
+            "actions": actions,
+            "download_bytes": download_bytes,
+            "api_calls": calls,
+            "spacing_seconds": {endpoint: round(seconds, 3) for endpoint, seconds in spacing.items()},
+            "bandwidth_seconds": None if bandwidth_seconds is None else round(bandwidth_seconds, 1),
+            "estimated_seconds": round(estimated_seconds, 1),
+            "folders": dict(sorted(folders.items(), key=lambda item: -item[1])),
+        }
+
+    def print_plan(self, summary):
+        actions = summary["actions"]
+        calls = summary["api_calls"]
+        print(c_header(f"\n{'='*60}"))
+        print(c_header("  Sync plan"))
+        print(c_header(f"{'='*60}"))
+        print(c_dim(f"Favourites scan ends at: {summary['end']}"))
+        print(c_success(f"{actions['download']} posts to download (~{summary['download_bytes'] / 1_000_000:.1f} MB)"))
+        others = [
+            f"{actions[action]} {label}" for action, label in (
+                ("link", "to link from another profile"), ("on_disk", "already on disk"),
+                ("skip", "skipped by filters"), ("cached", "cached"),
+                ("stale", "stale failed entries"), ("deferred", "deferred past the priority budget"),
+            ) if actions[action]
+        ]
+        if others:
+            print(c_dim(", ".join(others)))
+        print(c_info(
+            f"API calls: {calls['favourites']} favourites, {calls['detail']} post details, "
+            f"{calls['tag']} tags, {calls['download']} images"
+        ))
+        estimate = f"Estimated time: at least {format_duration(summary['estimated_seconds'])} at the current request spacing"
+        if summary["bandwidth_seconds"] is not None:
+            estimate += f" ({format_duration(summary['bandwidth_seconds'])} of downloads at the bandwidth cap)"
+        print(c_info(estimate))
+        if summary["folders"]:
+            print(c_info("Busiest destination folders:"))
+            for folder, count in list(summary["folders"].items())[:10]:
+                print(c_dim(f"  {count:>6}  {folder}"))
+
+    def load_profiles(self, names):
+        """Build profile dicts for the named entries of the profiles section of config.yaml.
+
+        Each profile has its own credentials (from its env_file) and its own posts,
+        failed and rate-limited caches; the tag cache, content index and rate limiter
+        are shared. Raises ValueError for an undefined profile, a missing env file or
+        missing credentials.
+        """
+        from dotenv import dotenv_values
+
+        profiles = []
+        for name in names:
+            if name not in self.profile_settings:
+                raise ValueError(f"profile '{name}' is not defined under profiles in config.yaml")
+            settings = self.profile_settings[name] or {}
+            env_file = os.path.join(SCRIPT_DIR, settings.get("env_file", f".env.{name}"))
+            if not os.path.exists(env_file):
+                raise ValueError(f"env file for profile '{name}' not found: {env_file}")
+            api_key, user_id, username, password = load_credentials(dotenv_values(env_file), env_file)
+            profiles.append({
+                "name": name,
+                "weight": max(1, int(settings.get("weight", 1))),
+                "api_key": api_key,
+                "user_id": user_id,
+                "username": username,
+                "password": password,
+                "base_dir": settings.get("base_dir") or self.base_dir,
+                "posts_cache_file": profile_cache_path(self.posts_cache_file, name),
+                "failed_posts_cache_file": profile_cache_path(self.failed_posts_cache_file, name),
+                "rate_limited_posts_file": profile_cache_path(self.rate_limited_posts_file, name),
+                "skipped_posts_file": profile_cache_path(self.skipped_posts_file, name),
+                "session": None,
+                "steps": None,
+                "pages": 0,
+            })
+        return profiles
+
+    def activate_profile(self, profile):
+        """Point the engine's credentials, caches and download folder at profile.
+
+        Pending cache buffers are flushed first so they land in the previous
+        profile's files.
+        """
+
+        self.flush_cache_buffers()
+        self.api_key = profile["api_key"]
+        self.user_id = profile["user_id"]
+        self.username = profile["username"]
+        self.password = profile["password"]
+        self.base_dir = profile["base_dir"]
+        self.posts_cache_file = profile["posts_cache_file"]
+        self.failed_posts_cache_file = profile["failed_posts_cache_file"]
+        self.rate_limited_posts_file = profile["rate_limited_posts_file"]
+        with self.rate_limited_lock:
+            self.rate_limited_posts = self.load_rate_limited_posts()
+        self.skipped_posts_file = profile["skipped_posts_file"]
+        with self.skipped_posts_lock:
+            self.skipped_posts = None
+        self.active_profile_name = profile["name"]
+
+    def sync_profiles(self, profiles):
+        """Sync several accounts in one process with weighted fair scheduling.
+
+        Each profile's favourites walk is a work queue of pages. The next page always
+        goes to the profile with the lowest pages-done-to-weight ratio, so a profile
+        with weight 2 gets two pages for every one of a weight-1 profile, and no
+        account's backlog can starve the others.
+        """
+        self.content_index_enabled = True
+
+        for profile in profiles:
+            self.activate_profile(profile)
+            print(c_header(f"\nProfile {profile['name']}: logging in"))
+            profile["session"] = self.login()
+            self.process_priority_posts()
+            profile["steps"] = self.favourite_page_steps(profile["session"])
+
+        active = list(profiles)
+        while active and not self.stopping():
+            profile = min(active, key=lambda p: (p["pages"] + 1) / p["weight"])
+            self.activate_profile(profile)
+            try:
+                next(profile["steps"])
+                profile["pages"] += 1
+            except StopIteration:
+                active.remove(profile)
+                print(c_info(f"Profile {profile['name']} done after {profile['pages']} pages"))
 
-    print(c_success("\n" + "="*60))
-    print(c_success("  Retry complete!"))
-    print(c_success("="*60))
+        self.flush_cache_buffers()
 
+    def _shard_connect(self):
+        import sqlite3
 
-# Main function
-def main():
-    parser = argparse.ArgumentParser(
-        description="Download favourite images from Gelbooru"
-    )
-    parser.add_argument("-logtofile", help="log output to file", action="store_true")
-    parser.add_argument(
-        "-r", "--retry-failed",
-        help="retry previously failed posts instead of normal operation",
-        action="store_true"
-    )
-    parser.add_argument(
-        "--list-failed",
-        help="list all failed posts without retrying",
-        action="store_true"
-    )
-    parser.add_argument(
-        "--debug",
-        help="emit verbose rate-limit telemetry (per-event timing, backoff, retries)",
-        action="store_true"
-    )
-    args = parser.parse_args()
+        # Autocommit mode; writers take the lock explicitly with BEGIN IMMEDIATE.
+        return sqlite3.connect(self.shard_db_path, timeout=60, isolation_level=None)
+
+    def init_shard_db(self, path):
+        """Create the work tables if needed and check the page size matches this worker's; raises ValueError if not"""
+        self.shard_db_path = path
+        conn = self._shard_connect()
+        try:
+            conn.executescript(SHARD_SCHEMA)
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('posts_per_page', ?)",
+                (str(self.posts_per_page),),
+            )
+            stored = conn.execute("SELECT value FROM meta WHERE key = 'posts_per_page'").fetchone()[0]
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        if int(stored) != self.posts_per_page:
+            raise ValueError(
+                f"{path} was created with posts_per_page={stored}, "
+                f"but config.yaml has {self.posts_per_page}"
+            )
+
+    def claim_favourites_page(self, worker_id):
+        """Claim the next favourites offset, or return None when the backfill is done.
+
+        Pending pages and pages whose lease has expired are reclaimed first (lowest
+        pid first); otherwise the frontier is extended by one page, up to the last
+        page once some worker has found it.
+        """
+        now = time.time()
+        conn = self._shard_connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT pid FROM pages WHERE state = 'pending' "
+                "OR (state = 'claimed' AND lease_expires < ?) ORDER BY pid LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row:
+                pid = row[0]
+                conn.execute(
+                    "UPDATE pages SET state = 'claimed', worker = ?, lease_expires = ?, "
+                    "attempts = attempts + 1 WHERE pid = ?",
+                    (worker_id, now + self.shard_lease_seconds, pid),
+                )
+            else:
+                end = conn.execute("SELECT value FROM meta WHERE key = 'end_pid'").fetchone()
+                last = conn.execute("SELECT MAX(pid) FROM pages").fetchone()[0]
+                pid = 0 if last is None else last + self.posts_per_page
+                if end is not None and pid > int(end[0]):
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute(
+                    "INSERT INTO pages (pid, state, worker, lease_expires, attempts) "
+                    "VALUES (?, 'claimed', ?, ?, 1)",
+                    (pid, worker_id, now + self.shard_lease_seconds),
+                )
+            conn.execute("COMMIT")
+            return pid
+        finally:
+            conn.close()
+
+    def finish_favourites_page(self, pid, worker_id, post_count):
+        """Mark a claimed page done, recording the end of the favourites if this page is short"""
+        conn = self._shard_connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE pages SET state = 'done', post_count = ?, lease_expires = NULL "
+                "WHERE pid = ? AND worker = ?",
+                (post_count, pid, worker_id),
+            )
+            if post_count < self.posts_per_page:
+                # An empty page means the previous offset was the last one.
+                end_pid = pid if post_count else pid - self.posts_per_page
+                conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('end_pid', ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value = MIN(CAST(value AS INTEGER), excluded.value)",
+                    (end_pid,),
+                )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
 
-    global log_to_file, rate_limited_posts, debug_enabled
-    log_to_file = args.logtofile
-    debug_enabled = args.debug
+    def release_favourites_page(self, pid, worker_id, interrupted=False):
+        """Hand a page that could not be fetched back to the pool, or give up on it.
 
-    # Handle --list-failed
-    if args.list_failed:
-        failed_cache = load_failed_posts_cache()
-        rate_limited = load_rate_limited_posts()
+        An interrupted page (the worker was stopped part way through) always goes back
+        to the pool, and the attempt is not counted against it.
+        """
+        conn = self._shard_connect()
+        try:
+            if interrupted:
+                conn.execute(
+                    "UPDATE pages SET state = 'pending', attempts = MAX(attempts - 1, 0), "
+                    "worker = NULL, lease_expires = NULL WHERE pid = ? AND worker = ?",
+                    (pid, worker_id),
+                )
+                return
+            conn.execute(
+                "UPDATE pages SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "worker = NULL, lease_expires = NULL WHERE pid = ? AND worker = ?",
+                (self.shard_max_page_attempts, pid, worker_id),
+            )
+        finally:
+            conn.close()
+
+    def claim_shard_posts(self, post_ids, worker_id):
+        """Return the subset of post_ids this worker now owns.
+
+        Posts already finished by any worker, or claimed under a live lease by
+        another worker, are left out.
+        """
+        now = time.time()
+        owned = []
+        conn = self._shard_connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for post_id in post_ids:
+                row = conn.execute(
+                    "SELECT state, worker, lease_expires FROM posts WHERE post_id = ?", (post_id,)
+                ).fetchone()
+                if row is None:
+                    conn.execute(
+                        "INSERT INTO posts (post_id, state, worker, lease_expires) VALUES (?, 'claimed', ?, ?)",
+                        (post_id, worker_id, now + self.shard_lease_seconds),
+                    )
+                elif row[0] == "done" or (row[1] != worker_id and (row[2] or 0) >= now):
+                    continue
+                else:
+                    conn.execute(
+                        "UPDATE posts SET worker = ?, lease_expires = ? WHERE post_id = ?",
+                        (worker_id, now + self.shard_lease_seconds, post_id),
+                    )
+                owned.append(post_id)
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        return owned
+
+    def commit_shard_posts(self, post_ids):
+        """Record finished posts in the shared posts store"""
+        conn = self._shard_connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO posts (post_id, state, worker) VALUES (?, 'done', ?) "
+                "ON CONFLICT(post_id) DO UPDATE SET state = 'done', lease_expires = NULL",
+                [(str(post_id), self.shard_worker_id) for post_id in post_ids],
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def release_shard_posts(self, worker_id):
+        """Drop this worker's unfinished post claims (failures stay in the failed cache)"""
+        conn = self._shard_connect()
+        try:
+            conn.execute("DELETE FROM posts WHERE worker = ? AND state = 'claimed'", (worker_id,))
+        finally:
+            conn.close()
+
+    def renew_shard_leases(self, worker_id):
+        """Extend the leases on everything this worker holds"""
+        expires = time.time() + self.shard_lease_seconds
+        conn = self._shard_connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE pages SET lease_expires = ? WHERE worker = ? AND state = 'claimed'",
+                (expires, worker_id),
+            )
+            conn.execute(
+                "UPDATE posts SET lease_expires = ? WHERE worker = ? AND state = 'claimed'",
+                (expires, worker_id),
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def _shard_heartbeat(self, worker_id, stop_event):
+        """Renew leases at a third of the lease length until stop_event is set"""
+        import sqlite3
+
+        while not stop_event.wait(self.shard_lease_seconds / 3):
+            try:
+                self.renew_shard_leases(worker_id)
+            except sqlite3.Error as e:
+                self.debug_log(f"[shard] lease renewal failed: {e}")
+
+    def run_shard_worker(self, session, worker_id):
+        """Claim favourites pages from the shared work table until none are left"""
+        self.shard_worker_id = worker_id
+        print(c_info(f"Shard worker {worker_id} using {self.shard_db_path}"))
+
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._shard_heartbeat, args=(worker_id, stop_heartbeat), name="shard-heartbeat", daemon=True
+        )
+        heartbeat.start()
+        pages_done = 0
+        try:
+            while not self.stopping():
+                pid = self.claim_favourites_page(worker_id)
+                if pid is None:
+                    break
+                post_ids = self.get_favorite_post_ids(session, pid)
+                if self.stopping():
+                    self.release_favourites_page(pid, worker_id, interrupted=True)
+                    break
+                if post_ids is FETCH_FAILED:
+                    print(c_error(f"Could not fetch favourite page (pid={pid}); returning it to the pool."))
+                    self.release_favourites_page(pid, worker_id)
+                    continue
+                if not post_ids:
+                    self.finish_favourites_page(pid, worker_id, 0)
+                    continue
+
+                owned = self.claim_shard_posts(post_ids, worker_id)
+                page_num = (pid // self.posts_per_page) + 1
+                print(c_header(f"\n{'='*60}"))
+                print(c_header(
+                    f"  [{worker_id}] Page {page_num} - {len(post_ids)} favourite posts, "
+                    f"{len(owned)} claimed"
+                ))
+                print(c_header(f"{'='*60}"))
+
+                start_time = time.time()
+                download_results = self.batch_process_posts(owned) if owned else dict.fromkeys(POST_OUTCOMES, 0)
+                print(format_page_summary(download_results, time.time() - start_time))
+
+                self.flush_cache_buffers()
+                self.release_shard_posts(worker_id)
+                if self.stopping():
+                    # Posts finished so far are committed; the page goes back for whoever runs next.
+                    self.release_favourites_page(pid, worker_id, interrupted=True)
+                    break
+                self.finish_favourites_page(pid, worker_id, len(post_ids))
+                pages_done += 1
+        finally:
+            stop_heartbeat.set()
+            self.flush_cache_buffers()
+            self.release_shard_posts(worker_id)
+
+        if self.stopping():
+            print(c_warning(f"\nShard worker {worker_id} stopped after {pages_done} pages."))
+        else:
+            print(c_info(f"\nShard worker {worker_id} finished after {pages_done} pages."))
 
-        print(c_header("\nFailed Posts Status"))
+    def merge_shard_results(self):
+        """Fold every finished post in the shared work database into posts_cache.json"""
+        conn = self._shard_connect()
+        try:
+            done_ids = [row[0] for row in conn.execute("SELECT post_id FROM posts WHERE state = 'done'")]
+            page_states = dict(conn.execute("SELECT state, COUNT(*) FROM pages GROUP BY state").fetchall())
+        finally:
+            conn.close()
+
+        with self.cache_update_lock:
+            posts_cache = self.load_posts_cache()
+            new_ids = [post_id for post_id in done_ids if post_id not in posts_cache]
+            posts_cache.update(dict.fromkeys(new_ids, True))
+            self.save_posts_cache(posts_cache)
+
+        print(c_success(f"Merged {len(new_ids)} new posts into {self.posts_cache_file}"))
+
+        # Per-worker failure files in this folder go back into the main failed cache.
+        root, ext = os.path.splitext(self.failed_posts_cache_file)
+        worker_failed_files = glob.glob(f"{glob.escape(root)}.shard-*{ext}")
+        if worker_failed_files:
+            with self.failed_cache_lock:
+                failed_cache = self.load_failed_posts_cache()
+                for path in worker_failed_files:
+                    with open(path, "r") as f:
+                        failed_cache.update(json.load(f))
+                for post_id in done_ids:
+                    failed_cache.pop(post_id, None)
+                self.save_failed_posts_cache(failed_cache)
+            for path in worker_failed_files:
+                os.remove(path)
+            print(c_dim(f"Folded {len(worker_failed_files)} worker failure files into {self.failed_posts_cache_file}"))
+        states = ", ".join(f"{count} {state}" for state, count in sorted(page_states.items()))
+        print(c_dim(f"Pages: {states or 'none'}"))
+        if page_states.get("failed"):
+            print(c_warning("Some pages failed repeatedly; reset them to 'pending' or run a normal sync."))
+
+    def print_failed_posts_status(self):
+        """Print the failed and rate-limited posts of the active profile"""
+        failed_cache = self.load_failed_posts_cache()
+        rate_limited = self.load_rate_limited_posts()
+
+        profile_label = f" [{self.active_profile_name}]" if self.active_profile_name else ""
+        print(c_header(f"\nFailed Posts Status{profile_label}"))
         print(c_header("="*40))
 
         if failed_cache:
@@ -1294,79 +4958,327 @@ def main():
             print(c_dim("\nNo rate-limited posts."))
 
         print()
-        return
 
-    # Load any previously rate-limited posts
-    rate_limited_posts = load_rate_limited_posts()
-    if rate_limited_posts:
-        print(c_warning(f"Found {len(rate_limited_posts)} previously rate-limited posts to retry"))
 
-    # Register signal handler for graceful exit
-    signal.signal(signal.SIGINT, signal_handler)
-    print(c_dim("Press Ctrl+C to gracefully exit the program."))
+# =============================================================================
+# Command Line
+# =============================================================================
+# How long the grace-deadline abort waits for a worker to finish writing a cache
+# before it gives up on saving and exits anyway
+ABORT_LOCK_TIMEOUT_SECONDS = 5
 
-    # Handle --retry-failed mode
-    if args.retry_failed:
-        retry_failed_posts()
-        print_rate_limit_summary()
-        return
 
-    session = login()
+class InterruptHandler:
+    """Two-stage Ctrl+C for the command line.
+
+    The first Ctrl+C calls engine.stop(): no new work is dispatched, in-flight
+    downloads finish and every outcome is committed before the run returns
+    normally. If that takes longer than shutdown_grace_seconds, or Ctrl+C is
+    pressed again, the run is aborted: buffered caches are flushed (deadline only,
+    and skipped if a worker holds a cache lock for ABORT_LOCK_TIMEOUT_SECONDS),
+    half-written downloads are deleted and the process exits straight away.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.timer = None
+
+    def __call__(self, sig, frame):
+        if self.engine.stopping():
+            self.abort("Interrupted again - aborting.", flush=False)
+        print(c_warning(
+            f"\n\nInterrupted! Finishing in-flight downloads and saving progress "
+            f"(up to {self.engine.shutdown_grace_seconds}s)..."
+        ))
+        print(c_dim("Press Ctrl+C again to abort immediately."))
+        self.engine.stop()
+        self.timer = threading.Timer(
+            self.engine.shutdown_grace_seconds, self.abort, ("Shutdown grace period expired - aborting.", True)
+        )
+        self.timer.daemon = True
+        self.timer.start()
+
+    def disarm(self):
+        """Cancel the grace-period deadline once the run has wound down"""
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def abort(self, reason, flush):
+        print(c_error(f"\n{reason}"))
+        if flush:
+            # Runs on the Timer thread while workers may still be writing: wait for them
+            # only so long, so the exit below is always reached. failed_cache_lock is kept
+            # until then, so no failed-cache write is cut off halfway.
+            try:
+                if not self.engine.failed_cache_lock.acquire(timeout=ABORT_LOCK_TIMEOUT_SECONDS):
+                    print(c_warning("The failed cache is still being written - skipped saving progress."))
+                elif self.engine.flush_cache_buffers(lock_timeout=ABORT_LOCK_TIMEOUT_SECONDS):
+                    print(c_success("Progress saved."))
+                else:
+                    print(c_warning("The caches are still being written - skipped saving progress."))
+            except Exception as e:
+                print(c_error(f"Warning: Error saving caches: {e!s}"))
+        removed = self.engine.remove_partial_files()
+        if removed:
+            print(c_dim(f"Removed {removed} partially downloaded files."))
+        try:
+            self.engine.print_rate_limit_summary()
+        except Exception:
+            pass
+        self.engine.stop_profiler()
+        self.engine.close_trace()  # os._exit skips the finally in run_cli
+        close_log_writers()  # ...and atexit
+        stop_console()
+        # Worker threads may be blocked in a request; don't wait for them.
+        os._exit(130)
 
-    pid = 0
-    consecutive_empty_pages = (
-        0  # Counter for consecutive pages without downloaded images
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Download favourite images from Gelbooru"
+    )
+    parser.add_argument("-logtofile", help="log output to file", action="store_true")
+    parser.add_argument(
+        "-r", "--retry-failed",
+        help="retry previously failed posts instead of normal operation",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--list-failed",
+        help="list all failed posts without retrying",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--debug",
+        help="emit verbose rate-limit telemetry (per-event timing, backoff, retries)",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--profiles",
+        help="comma-separated profiles from config.yaml to sync in one process ('all' for every profile)",
+    )
+    parser.add_argument(
+        "--shard-db",
+        help="run as a backfill worker claiming favourites pages from this shared SQLite file",
+    )
+    parser.add_argument(
+        "--worker-id",
+        help="name of this backfill worker (default: hostname-pid)",
+    )
+    parser.add_argument(
+        "--shard-merge",
+        help="fold finished posts from --shard-db into posts_cache.json, then exit",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--metrics-json",
+        help="also write the end-of-run metrics (latency percentiles, throughput, stage times) to this JSON file",
+    )
+    parser.add_argument(
+        "--trace",
+        help="write one JSON line per HTTP request, 429 and stage to this file",
+    )
+    parser.add_argument(
+        "--analyze-trace",
+        metavar="TRACE",
+        help="print a timeline, concurrency and bottleneck report for a --trace file, then exit",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="profile",
+        metavar="PREFIX",
+        help="sample the run and write a per-stage CPU and lock-wait report to PREFIX.txt "
+             "plus flamegraph stacks to PREFIX.folded (default prefix: profile)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics while running",
+    )
+    parser.add_argument(
+        "--reshard",
+        help="move existing images into the folder layout set by settings.fanout_levels, then exit",
+        action="store_true"
     )
+    parser.add_argument(
+        "--plan",
+        nargs="?",
+        const="",
+        metavar="FILE",
+        help="print what a sync would download, where to and roughly how long it would take, without "
+             "downloading or changing anything; FILE also gets the per-post plan as JSONL",
+    )
+    parser.add_argument(
+        "--changes",
+        type=int,
+        nargs="?",
+        const=0,
+        metavar="CURSOR",
+        help="print the change manifest entries recorded after CURSOR (default: all) as JSON lines, "
+             "each with the cursor to resume from, then exit; with --worker-id, that backfill worker's manifest",
+    )
+    parser.add_argument(
+        "--watch",
+        help="keep running and sync whenever new favourites appear (see the watch section of config.yaml)",
+        action="store_true"
+    )
+    args = parser.parse_args()
 
-    while consecutive_empty_pages < MAX_CONSECUTIVE_EMPTY_PAGES:
-        post_ids = get_favorite_post_ids(session, pid)
-        if post_ids is FETCH_FAILED:
-            print(c_error(f"Could not fetch favourite page (pid={pid}) after retries; stopping to avoid missing posts."))
-            break
-        if not post_ids:
-            print(c_info("No more favourite posts found."))
-            break
+    # Initialise colorama for Windows compatibility
+    from colorama import init
 
-        page_num = (pid // POSTS_PER_PAGE) + 1
-        print(c_header(f"\n{'='*60}"))
-        print(c_header(f"  Page {page_num} - {len(post_ids)} favourite posts"))
-        print(c_header(f"{'='*60}"))
+    init(autoreset=True)
+    # All console output goes through one thread from here on (see ConsoleOutput).
+    start_console()
+    try:
+        status = run_cli(parser, args)
+    finally:
+        stop_console()
+    if status:
+        sys.exit(status)
 
-        # Process posts in batches
-        start_time = time.time()
-        download_results = batch_process_posts(post_ids)
-        end_time = time.time()
 
-        elapsed = end_time - start_time
-        print(format_page_summary(download_results, elapsed))
-        downloaded_images = download_results[POST_DOWNLOADED] > 0
+def run_cli(parser, args):
+    """Carry out the mode selected on the command line; returns the exit status"""
+    if args.analyze_trace:
+        analyze_trace(args.analyze_trace)
+        return
 
-        if not downloaded_images:
-            consecutive_empty_pages += 1
-        else:
-            consecutive_empty_pages = 0
+    if args.shard_merge and not args.shard_db:
+        parser.error("--shard-merge requires --shard-db")
+    if args.shard_db and (args.profiles or args.watch or args.retry_failed):
+        parser.error("--shard-db cannot be combined with --profiles, --watch or --retry-failed")
+    if args.profiles and args.watch:
+        parser.error("--profiles cannot be combined with --watch")
 
-        if len(post_ids) < POSTS_PER_PAGE:
-            print(c_info("\nReached the last page of favourite posts."))
-            break
+    try:
+        engine = Downloader(load_config(), log_to_file=args.logtofile, debug=args.debug)
+    except ValueError as e:
+        print(c_error(f"Error: {e!s}"))
+        return 1
+    engine.metrics_json_path = args.metrics_json
+    if args.trace:
+        engine.open_trace(args.trace)
+    if args.profile:
+        engine.start_profiler(args.profile)
+    if args.metrics_port is not None:
+        engine.start_metrics_server(args.metrics_port)
+    interrupt_handler = InterruptHandler(engine)
+    signal.signal(signal.SIGINT, interrupt_handler)
+    try:
+        run_mode(engine, args)
+    except (LoginError, ValueError) as e:
+        print(c_error(f"Error: {e!s}"))
+        return 1
+    finally:
+        interrupt_handler.disarm()
+        engine.stop_profiler()
+        engine.close()
 
-        pid += POSTS_PER_PAGE
 
-    if consecutive_empty_pages >= MAX_CONSECUTIVE_EMPTY_PAGES:
-        print(c_info(f"\nNo new images for {MAX_CONSECUTIVE_EMPTY_PAGES} consecutive pages."))
+def run_mode(engine, args):
+    """The part of run_cli that runs once the engine is set up"""
+    profiles = None
+    if args.profiles:
+        names = list(engine.profile_settings) if args.profiles == "all" else [
+            name.strip() for name in args.profiles.split(",") if name.strip()
+        ]
+        profiles = engine.load_profiles(names)
+
+    # Handle --list-failed
+    if args.list_failed:
+        for profile in profiles or [None]:
+            if profile:
+                engine.activate_profile(profile)
+            engine.print_failed_posts_status()
+        return
+
+    if args.changes is not None:
+        if args.worker_id and engine.manifest_file:
+            engine.manifest_file = profile_cache_path(engine.manifest_file, f"shard-{args.worker_id}")
+        engine.print_manifest_changes(args.changes)
+        return
+
+    if args.reshard:
+        for profile in profiles or [None]:
+            if profile:
+                engine.activate_profile(profile)
+            engine.reshard_library()
+        return
+
+    # Profiles bring their own credentials, and merging shard results needs none
+    if not profiles and not args.shard_merge:
+        engine.set_credentials(load_credentials())
+
+    # Start from the limits earlier runs learned, and any previously rate-limited posts
+    rate_limited_count = engine.load_state()
+    if rate_limited_count:
+        print(c_warning(f"Found {rate_limited_count} previously rate-limited posts to retry"))
+
+    if args.plan is not None:
+        for profile in profiles or [None]:
+            output = args.plan or None
+            if profile:
+                engine.activate_profile(profile)
+                output = output and profile_cache_path(output, profile["name"])
+            engine.plan(output=output)
+        return
+
+    print(c_dim("Press Ctrl+C to stop after the downloads in progress (twice to abort)."))
+
+    # Handle --retry-failed mode
+    if args.retry_failed:
+        for profile in profiles or [None]:
+            if engine.stopping():
+                break
+            if profile:
+                engine.activate_profile(profile)
+            engine.retry_failed()
+        engine.print_rate_limit_summary()
+        return
+
+    if profiles:
+        engine.sync_profiles(profiles)
+        engine.print_rate_limit_summary()
+        return
+
+    if args.shard_db:
+        engine.init_shard_db(args.shard_db)
+        if args.shard_merge:
+            engine.merge_shard_results()
+            return
+        import socket
+
+        worker_id = args.worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        # Failures are kept per worker so workers sharing a folder don't overwrite each other.
+        engine.failed_posts_cache_file = profile_cache_path(engine.failed_posts_cache_file, f"shard-{worker_id}")
+        engine.rate_limited_posts_file = profile_cache_path(engine.rate_limited_posts_file, f"shard-{worker_id}")
+        engine.skipped_posts_file = profile_cache_path(engine.skipped_posts_file, f"shard-{worker_id}")
+        if engine.manifest_file:
+            engine.manifest_file = profile_cache_path(engine.manifest_file, f"shard-{worker_id}")
+        with engine.rate_limited_lock:
+            engine.rate_limited_posts = engine.load_rate_limited_posts()
+        engine.run_shard_worker(engine.login(), worker_id)
+        engine.print_rate_limit_summary()
+        return
+
+    if args.watch:
+        session = engine.login()
+        # Each watch cycle gives previously rate-limited and failed posts a priority pass first.
+        engine.watch_favourites(session)
+        return
 
-    # Final cleanup - flush any remaining cache updates
-    flush_cache_buffers()
+    result = engine.sync()
 
     # Report on any remaining rate-limited posts
-    remaining_rate_limited = len(rate_limited_posts)
-    if remaining_rate_limited > 0:
-        print(c_warning(f"\n{remaining_rate_limited} posts still rate-limited (will retry next run)"))
+    if result["rate_limited"]:
+        print(c_warning(f"\n{result['rate_limited']} posts still rate-limited (will retry next run)"))
 
-    print_rate_limit_summary()
+    engine.print_rate_limit_summary()
 
     print(c_success("\n" + "="*60))
-    print(c_success("  Complete! All progress saved."))
+    print(c_success("  Stopped early - all progress saved." if result["stopped"] else "  Complete! All progress saved."))
     print(c_success("="*60))
 
 